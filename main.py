@@ -1,28 +1,29 @@
 import os
+import time
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from pathlib import Path
 from PIL import Image
-from predicthq import Client
 
-from src.openai_utils import (get_gpt4_campaign_response,
-                              get_gpt4_insta_response,
-                              get_openai_creds)
-
-from src.streamlit_utils import parse_insta_posts, parse_user_input_for_gpt4
+from src.openai_utils import get_openai_creds
 from src.gcp_utils import get_gcp_project_id_from_env_var
-from src.stable_utils import (add_details_for_stable, get_stable_image,
-                              get_stable_creds_and_set_as_env_vars)
-from src.predict_utils import (find_events_by_city,
-                               get_list_of_events_from_df,
-                               get_event_recommendations)
-
-from src.segmind_utils import get_segmind_image
+from src.cache_utils import shared_cache_stats
+from src.endpoint_utils import endpoint_stats
+from src.job_utils import FAILED, get_job_manager, make_job_key
+from src.log_utils import configure_logging
+from src.memory_utils import get_artefact_store
+from src.scheduler_utils import scheduler_stats
+from src.semantic_cache_utils import get_semantic_cache
+from src.pipeline_utils import run_campaign_pipeline
+from src.profile_utils import (PROFILE_ALL_RUNS, profiling_allowed,
+                               read_profile_files)
 
 st.set_page_config(
     page_title="Campaign Genie",
     page_icon="",
     layout="wide",
 )
+configure_logging()
 
 
 @st.cache_data
@@ -35,6 +36,20 @@ open_ai_creds = st.secrets.openai
 predict_creds = st.secrets.predict_hq
 replicate_creds = st.secrets.replicate
 
+POLL_SECONDS = 1
+# A run always finishes within this, dropping what does not fit
+RUN_BUDGET_SECONDS = 60
+FORMAT_LABELS = {'square': '1:1', 'portrait': '4:5', 'story': '9:16'}
+
+
+@st.cache_resource
+def load_logo():
+    path = Path(__file__).parent / Path("assets") / \
+        "piecrust.png"
+    img = Image.open(path)
+    img.load()
+    return img
+
 
 def render_app():
     # When using azure uncomment these lines
@@ -44,10 +59,7 @@ def render_app():
     creds = st.secrets.openai
     st.title('Campaign Genie 🧞‍♂️')
     with st.sidebar:
-        path = Path(__file__).parent / Path("assets") / \
-            "piecrust.png"
-        img = Image.open(path)
-        st.image(img, width=200)
+        st.image(load_logo(), width=200)
         brand = st.text_input('Brand')
         tags = st.text_area(
             'Taglines, broader ideas, references',
@@ -62,139 +74,215 @@ def render_app():
         #                   ('Stable Diffusion SDXL',
         #                    'Stable Diffusion',
         #                    'DALL-E'))
-        location = st.text_input('If wanting event recommendations, provide a\
-                                  campaign location/city')
+        multi_city = st.checkbox('Regional campaign (several cities)')
+        if multi_city:
+            location = ''
+            cities = [c.strip() for c in st.text_area(
+                'Campaign cities, one per line').splitlines() if c.strip()]
+        else:
+            location = st.text_input('If wanting event recommendations, \
+                                      provide a campaign location/city')
+            cities = []
         button = st.button('Ask the genie!')
 
     if button:
-        with st.spinner(f'Building {brand} campaign'):
-            user_query = parse_user_input_for_gpt4(brand=brand, tags=tags)
-            campaign = get_gpt4_campaign_response(user_query,
-                                                  gpt4_creds_dict=creds.api_key)
-
-        if location is not None and not insta:
-            with st.spinner(f'Genie is finding event recommendations on \
-                            Predict HQ'):
-                st.success(campaign)
-                events_df = find_events_by_city(city_name=location)
-                events_list = get_list_of_events_from_df(events_df)
-                recommendation = get_event_recommendations(
-                    city=location,
-                    campaign=campaign,
-                    events_list=','.join(events_list),
-                    gpt4_creds_dict=creds)
-                st.markdown(f'### PredictHQ event recommendations for \
-                            {brand} in {location}')
-                st.info(recommendation['text'])
-
-                with st.expander(f"See PredictHQ events table for {location}"):
-                    st.table(events_df[['category',
-                                        'title',
-                                        'description',
-                                        'phq_attendance',
-                                        'end']][:20])
-
-        elif insta is not None and not location:
-            col1, col2 = st.columns(2)
-            with col1:
-                st.markdown(f"## Brand Platform for {brand}")
-                st.success(campaign)
-
-            with col2:
-                st.markdown("## Instagram posts")
-                with st.spinner('Gathering posts'):
-                    insta_posts = get_gpt4_insta_response(user_query,
-                                                          campaign,
-                                                          creds.api_key)
-
-                    parsed_list = parse_insta_posts(insta_posts)
-
-                    for i, post in enumerate(parsed_list):
-                        expander = st.expander(f"Post {i+1}", expanded=True)
-                        expander.write(post['Caption'])
-                        with st.spinner('Collecting Image...'):
-                            # if images == 'DALL-E':
-                            #     prompt = add_details_for_dalle(
-                            #         post['Image Description'])
-                            #     image = get_dalle_image(
-                            #         prompt,
-                            #         dalle_creds=creds)
-                            #     expander.image(image,
-                            #                    caption=post['Image Description'])
-
-                            # else:
-                            # get_stable_creds_and_set_as_env_vars()
-                            prompt = add_details_for_stable(
-                                post['Image Description'])
-                            # image = get_stable_image(prompt)
-                            image = get_segmind_image(prompt)
-                            expander.image(image,
-                                           caption=post['Image Description'])
-        elif all([insta, location]):
-            col1, col2 = st.columns(2)
-            with col1:
-                st.markdown(f"## Brand Platform for {brand}")
-                st.success(campaign)
-                with st.spinner(f'Genie is finding event recommendations on \
-                            Predict HQ'):
-                    events_df = find_events_by_city(city_name=location)
-                    events_list = get_list_of_events_from_df(events_df)
-                    recommendation = get_event_recommendations(
-                        city=location,
-                        campaign=campaign,
-                        events_list=','.join(events_list),
-                        gpt4_creds_dict=creds)
-                    st.markdown(f'### PredictHQ event recommendations for \
-                                {brand} in {location}')
-                    st.info(recommendation.content)
-
-                    with st.expander(f"See PredictHQ events table for {location}\
-                                     happening in the next year"):
-                        st.table(events_df[['category',
-                                            'title',
-                                            'phq_attendance',
-                                            'end']][:20])
-
-            with col2:
-                st.markdown("## Instagram posts")
-                with st.spinner('Gathering posts'):
-                    insta_posts = get_gpt4_insta_response(user_query,
-                                                          campaign,
-                                                          creds.api_key)
-
-                    parsed_list = parse_insta_posts(insta_posts)
-
-                    for i, post in enumerate(parsed_list):
-                        expander = st.expander(f"Post {i+1}", expanded=True)
-                        expander.write(post['Caption'])
-                        with st.spinner('Collecting Image...'):
-                            # if images == 'DALL-E':
-                            #     prompt = add_details_for_dalle(
-                            #         post['Image Description'])
-                            #     image = get_dalle_image(
-                            #         prompt,
-                            #         dalle_creds=creds)
-                            #     expander.image(image,
-                            #                    caption=post['Image Description'])
-                            # get_stable_creds_and_set_as_env_vars()
-
-                            prompt = add_details_for_stable(
-                                    post['Image Description'])
-                            # image = get_stable_image(
-                            #         prompt, model='normal')
-                            image = get_segmind_image(prompt)
-                            expander.image(image,
-                                           caption=post['Image Description'])
-
-                            # get_stable_creds_and_set_as_env_vars()
-                            #     prompt = add_details_for_stable(
-                            #         post['Image Description'])
-                            #     image = get_stable_image(prompt)
-                            #     expander.image(image,
-                            #                    caption=post['Image Description'])
+        submit_job({'brand': brand, 'tags': tags, 'insta': insta,
+                    'location': location, 'cities': cities,
+                    'semantic_cache': True}, creds)
 
-        else:
-            st.success(campaign)
+    job_key = st.session_state.get(
+        'job_key', st.experimental_get_query_params().get('job', [None])[0])
+    job = (get_job_manager().attach(job_key, get_session_id())
+           if job_key else None)
+    if job is not None:
+        st.session_state['job_key'] = job_key
+        render_job(job, creds)
+
+    if st.experimental_get_query_params().get('admin') == ['1']:
+        with st.expander('Memory report'):
+            st.json(get_artefact_store().report())
+        with st.expander('API queues'):
+            st.json(scheduler_stats())
+        with st.expander('OpenAI endpoints'):
+            st.json(endpoint_stats())
+        with st.expander('Shared cache'):
+            st.json(shared_cache_stats())
+
+
+def submit_job(inputs, creds):
+    """Start the pipeline for a set of sidebar inputs, or re-attach to the
+    run already going for them, and remember it for this tab.
+
+    Args:
+        inputs (dict): brand, tags, insta, location, cities and
+            semantic_cache, see run_campaign_pipeline.
+        creds (dict): OpenAI creds.
+    """
+    job_key = make_job_key(**inputs)
+    _cancel_previous_job(job_key)
+    get_job_manager().submit(job_key, inputs, run_campaign_pipeline,
+                             creds=dict(creds),
+                             budget_seconds=RUN_BUDGET_SECONDS,
+                             owner=get_session_id(),
+                             profile=_profiling_requested(), **inputs)
+    st.session_state['job_key'] = job_key
+    # Keeping the key in the URL lets a reloaded tab re-attach to the job
+    st.experimental_set_query_params(job=job_key)
+
+
+def _profiling_requested():
+    return (PROFILE_ALL_RUNS
+            or profiling_allowed(st.experimental_get_query_params()))
+
+
+def render_profile(profile):
+    """Summary of a profiled run with its files to download, stacks.folded
+    opens in speedscope or goes through flamegraph.pl"""
+    with st.expander('Run profile'):
+        st.caption(profile['directory'])
+        st.json(profile['summary'])
+        files = read_profile_files(profile['directory'])
+        for col, (name, (data, mime)) in zip(st.columns(len(files)),
+                                             files.items()):
+            col.download_button(name, data, file_name=name, mime=mime,
+                                key=f'profile_{name}')
+
+
+def get_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def _cancel_previous_job(job_key):
+    # The user moved on to new inputs: stop spending on the old run, unless
+    # other sessions are still showing it
+    previous_key = st.session_state.get('job_key')
+    if previous_key and previous_key != job_key:
+        get_job_manager().detach(previous_key, get_session_id())
+
+
+def render_city_results(brand, cities, results):
+    city_results = results.get('city_results', {})
+    st.markdown(f'### PredictHQ event recommendations for {brand} in \
+                {len(city_results)} of {len(cities)} cities')
+    # Cities show up in the order they finish
+    for city, result in city_results.items():
+        with st.expander(city, expanded=False):
+            if 'error' in result:
+                st.error(result['error'])
+            else:
+                st.info(result['recommendation'])
+    if results.get('cross_city_events') is not None:
+        with st.expander('Top events across all cities'):
+            st.table(results['cross_city_events'][['city',
+                                                   'category',
+                                                   'title',
+                                                   'phq_attendance',
+                                                   'city_rank',
+                                                   'end']][:30])
+
+
+def _render_cache_hit(job, creds):
+    st.caption('Served from a campaign generated for a similar brief')
+    if st.button('Not what I asked for'):
+        inputs = job.inputs
+        # Withdrawn so no one else gets it for this brief either
+        get_semantic_cache().report_false_hit(inputs['brand'],
+                                              inputs['tags'],
+                                              inputs['location'])
+        submit_job(dict(inputs, semantic_cache=False), creds)
+        st.experimental_rerun()
+
+
+def render_job(job, creds):
+    """Render whatever the job has produced so far, then poll again while it
+    is still running.
+
+    Args:
+        job (Job): Job returned by the job manager.
+        creds (dict): OpenAI creds, to ask again for a new campaign.
+    """
+    snapshot = job.snapshot()
+    results = snapshot['results']
+    brand = job.inputs['brand']
+    location = job.inputs['location']
+
+    if job.inputs['insta']:
+        col1, col2 = st.columns(2)
+    else:
+        col1 = col2 = st.container()
+
+    with col1:
+        if job.inputs['insta']:
+            st.markdown(f"## Brand Platform for {brand}")
+        if 'campaign' in results:
+            st.success(results['campaign'])
+            if snapshot['metadata'].get('semantic_cache', {}).get('hit'):
+                _render_cache_hit(job, creds)
+        if results.get('hero_image') is not None:
+            st.image(results['hero_image'],
+                     caption=results.get('hero_description'))
+        elif 'hero_description' in results:
+            st.caption('Rendering the principal image...')
+        if 'recommendation' in results:
+            st.markdown(f'### PredictHQ event recommendations for \
+                        {brand} in {location}')
+            st.info(results['recommendation'])
+        if results.get('events_df') is not None:
+            with st.expander(f"See PredictHQ events table for {location}\
+                             happening in the next year"):
+                st.table(results['events_df'][['category',
+                                               'title',
+                                               'phq_attendance',
+                                               'end']][:20])
+
+        if job.inputs['cities']:
+            render_city_results(brand, job.inputs['cities'], results)
+
+    if job.inputs['insta']:
+        with col2:
+            st.markdown("## Instagram posts")
+            images = results.get('images', {})
+            image_passes = results.get('image_passes', {})
+            image_progress = results.get('image_progress', {})
+            image_formats = results.get('image_formats', {})
+            for i, post in enumerate(results.get('posts', [])):
+                expander = st.expander(f"Post {i+1}", expanded=True)
+                expander.write(post['Caption'])
+                if images.get(i) is not None:
+                    caption = post['Image Description']
+                    if image_passes.get(i) == 'preview':
+                        caption = f'(preview) {caption}'
+                    expander.image(images[i], caption=caption)
+                if i in image_formats:
+                    for col, (name, data) in zip(
+                            expander.columns(len(image_formats[i])),
+                            image_formats[i].items()):
+                        col.download_button(
+                            FORMAT_LABELS.get(name, name), data,
+                            file_name=f'{brand or "post"}_{i+1}_{name}.jpg',
+                            mime='image/jpeg', key=f'format_{i}_{name}')
+                elif i in image_progress:
+                    expander.progress(image_progress[i]['progress'] / 100)
+                    expander.caption(image_progress[i]['logs'][-200:])
+                else:
+                    expander.caption('Collecting Image...')
+
+    for message in snapshot['metadata'].get('degraded', []):
+        st.warning(message)
+
+    if snapshot['status'] == FAILED:
+        st.error(f"The genie ran into a problem: {snapshot['error']}")
+
+    with st.expander('Run metadata'):
+        st.json(snapshot['metadata'])
+    if snapshot['metadata'].get('profile'):
+        render_profile(snapshot['metadata']['profile'])
+
+    if not job.finished:
+        with st.spinner(snapshot['progress']):
+            time.sleep(POLL_SECONDS)
+        st.experimental_rerun()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,503 @@
+import functools
+import hashlib
+import inspect
+import io
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import orjson
+import pandas as pd
+from loguru import logger
+
+from src.deadline_utils import call_timeout
+from src.replay_utils import IGNORED_ARGS, OFF, call_key, replay_mode
+
+
+# 'off', 'sqlite' (this host only) or a redis:// URL shared by every replica
+CACHE_BACKEND = os.environ.get('CAMPAIGN_POC_CACHE', 'sqlite')
+CACHE_DIR = Path(__file__).parent.parent / '.cache' / 'shared'
+# Values larger than this go to files next to the SQLite database
+INLINE_BYTES = 64 * 1024
+REDIS_TIMEOUT = 2.0
+# Bump to invalidate everything written by older code
+KEY_VERSION = 'v1'
+LLM_TTL = 7 * 24 * 60 * 60
+EVENTS_TTL = 6 * 60 * 60
+IMAGE_TTL = 30 * 24 * 60 * 60
+
+JSON = 'json'
+RECORDS = 'records'
+DATAFRAME = 'dataframe'
+IMAGE = 'image'
+# Generated images are stored as JPEG: visually lossless at this quality and
+# several times smaller and faster to decode than PNG
+JPEG_QUALITY = 95
+
+
+class CacheBackendError(RuntimeError):
+    """Raised by a backend that could not serve a request"""
+
+
+class CacheBackend:
+    """Byte store shared by the caches. Values are opaque bytes with an
+    optional time to live; a miss returns None.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class SQLiteBackend(CacheBackend):
+    """SQLite database with large values as files beside it. Processes on
+    one host share it; WAL mode lets readers run while one writes.
+    """
+
+    def __init__(self, directory=CACHE_DIR, inline_bytes=INLINE_BYTES):
+        self.directory = Path(directory)
+        self.blob_dir = self.directory / 'blobs'
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / 'cache.sqlite'
+        self.inline_bytes = inline_bytes
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, '
+                'value BLOB, blob TEXT, expires REAL)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, blob, expires FROM entries WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        value, blob, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        if blob is None:
+            return value
+        try:
+            return (self.blob_dir / blob).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        blob = None
+        if len(value) > self.inline_bytes:
+            blob = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            tmp_path = self.blob_dir / f'{blob}.{threading.get_ident()}.tmp'
+            tmp_path.write_bytes(value)
+            os.replace(tmp_path, self.blob_dir / blob)
+            value = None
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (key, value, blob, expires))
+
+    def delete(self, key):
+        with self._connection() as connection:
+            row = connection.execute(
+                'SELECT blob FROM entries WHERE key = ?', (key,)).fetchone()
+            connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+        if row and row[0]:
+            (self.blob_dir / row[0]).unlink(missing_ok=True)
+
+
+class RedisBackend(CacheBackend):
+    """Minimal client for the Redis protocol (RESP2), enough for GET, SET
+    with expiry and DEL. Works against Redis, Valkey, KeyDB or Memorystore.
+    One connection per thread.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 timeout=REDIS_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url):
+        """e.g. redis://:password@host:6379/0"""
+        parsed = urlparse(url)
+        db = parsed.path.strip('/')
+        return cls(host=parsed.hostname or 'localhost',
+                   port=parsed.port or 6379,
+                   db=int(db) if db else 0,
+                   password=parsed.password)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        if self.password:
+            self._command(b'AUTH', self.password)
+        if self.db:
+            self._command(b'SELECT', str(self.db))
+
+    def _command(self, *parts):
+        if getattr(self._local, 'sock', None) is None:
+            self._connect()
+        sock = self._local.sock
+        # Cache lookups must not hold up a run past its deadline
+        sock.settimeout(call_timeout(self.timeout))
+        try:
+            sock.sendall(encode_command(*parts))
+            return read_reply(self._local.reader)
+        except (OSError, ConnectionError) as e:
+            self.close()
+            raise CacheBackendError(f'redis {self.host}:{self.port}: {e}')
+
+    def close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+        self._local.sock = self._local.reader = None
+
+    def get(self, key):
+        return self._command(b'GET', key)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            self._command(b'SET', key, value)
+        else:
+            self._command(b'SET', key, value, b'PX', str(int(ttl * 1000)))
+
+    def delete(self, key):
+        self._command(b'DEL', key)
+
+
+def _as_bytes(part):
+    return part if isinstance(part, bytes) else str(part).encode('utf-8')
+
+
+def encode_command(*parts):
+    parts = [_as_bytes(p) for p in parts]
+    chunks = [b'*%d\r\n' % len(parts)]
+    for part in parts:
+        chunks += [b'$%d\r\n' % len(part), part, b'\r\n']
+    return b''.join(chunks)
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise ConnectionError('connection closed')
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b'+':
+        return rest.decode('utf-8')
+    if prefix == b'-':
+        raise CacheBackendError(rest.decode('utf-8'))
+    if prefix == b':':
+        return int(rest)
+    if prefix == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        return reader.read(length + 2)[:-2]
+    if prefix == b'*':
+        length = int(rest)
+        return None if length < 0 else [read_reply(reader)
+                                        for _ in range(length)]
+    raise CacheBackendError(f'Unexpected reply {line!r}')
+
+
+# Serialization: one tag byte, then the payload. Text and JSON go through
+# orjson, tables through zstd parquet (columns holding lists or dicts as JSON
+# text) and images through JPEG, or PNG when they have transparency.
+def encode(value, codec=JSON):
+    if codec == IMAGE:
+        buffer = io.BytesIO()
+        if value.mode in ('RGB', 'L'):
+            value.save(buffer, format='JPEG', quality=JPEG_QUALITY)
+        else:
+            value.save(buffer, format='PNG', compress_level=1)
+        return b'i' + buffer.getvalue()
+    if codec == RECORDS:
+        return b'r' + _encode_frame(pd.DataFrame(value))
+    if codec == DATAFRAME:
+        return b'p' + _encode_frame(value)
+    return b'j' + orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def decode(payload):
+    tag, body = payload[:1], payload[1:]
+    if tag == b'i':
+        from PIL import Image
+        image = Image.open(io.BytesIO(body))
+        image.load()
+        return image
+    if tag == b'r':
+        return _decode_frame(body).to_dict('records')
+    if tag == b'p':
+        return _decode_frame(body)
+    return orjson.loads(body)
+
+
+def _encode_frame(df):
+    nested = [c for c in df.columns if df[c].dtype == object
+              and df[c].map(lambda v: isinstance(v, (list, dict))).any()]
+    df = df.assign(**{c: df[c].map(lambda v: orjson.dumps(v).decode('utf-8'))
+                      for c in nested})
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, compression='zstd', index=False)
+    header = orjson.dumps(nested)
+    return struct.pack('>I', len(header)) + header + buffer.getvalue()
+
+
+def _decode_frame(body):
+    (length,) = struct.unpack('>I', body[:4])
+    nested = orjson.loads(body[4:4 + length])
+    df = pd.read_parquet(io.BytesIO(body[4 + length:]))
+    for column in nested:
+        df[column] = df[column].map(orjson.loads)
+    return df
+
+
+class SharedCache:
+    """Typed get/set on top of a backend, with hit counters. Backend errors
+    count as misses: a cache outage slows runs down, it does not fail them.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name, outcome):
+        with self._lock:
+            stats = self._stats.setdefault(
+                name, {'hits': 0, 'misses': 0, 'errors': 0})
+            stats[outcome] += 1
+
+    def get(self, key, name=''):
+        try:
+            payload = self.backend.get(f'{KEY_VERSION}:{key}')
+        except Exception as e:
+            logger.warning('Shared cache read failed: {!r}', e)
+            self._count(name, 'errors')
+            return None
+        self._count(name, 'misses' if payload is None else 'hits')
+        return None if payload is None else decode(payload)
+
+    def set(self, key, value, codec=JSON, ttl=None, name=''):
+        try:
+            self.backend.set(f'{KEY_VERSION}:{key}', encode(value, codec),
+                             ttl)
+        except Exception as e:
+            logger.warning('Shared cache write failed: {!r}', e)
+            self._count(name, 'errors')
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(s) for name, s in self._stats.items()}
+
+
+def make_backend(spec=CACHE_BACKEND):
+    if not spec or spec == OFF:
+        return None
+    if spec.startswith(('redis://', 'rediss://')):
+        return RedisBackend.from_url(spec)
+    return SQLiteBackend()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """Process-wide SharedCache for CACHE_BACKEND, None when it is off"""
+    global _cache
+    with _cache_lock:
+        if _cache is None and CACHE_BACKEND != OFF:
+            _cache = SharedCache(make_backend())
+        return _cache
+
+
+def shared_cache_stats():
+    return {} if _cache is None else _cache.stats()
+
+
+def shared(name, codec=JSON, ttl=None, ignore=IGNORED_ARGS):
+    """Decorate a provider call so its result is stored in the shared cache
+    and served from there to every replica making the same call.
+
+    Bypassed while recording or replaying cassettes, which need the real
+    calls. Put it under @recordable and over @scheduled, so a hit neither
+    waits for a provider slot nor misses the cassette.
+
+    Args:
+        name (str): Stable name of the call, e.g. 'openai.campaign'.
+        codec (str, optional): JSON, RECORDS, DATAFRAME or IMAGE.
+        ttl (float, optional): Seconds the result stays valid.
+        ignore (tuple, optional): Argument names left out of the key.
+
+    Returns:
+        callable: decorator
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = get_shared_cache()
+            if cache is None or replay_mode() != OFF:
+                return fn(*args, **kwargs)
+            key = call_key(name, signature, args, kwargs, ignore)
+            value = cache.get(key, name)
+            if value is not None:
+                logger.debug('Shared cache hit {}', key)
+                return value
+            value = fn(*args, **kwargs)
+            if value is not None:
+                cache.set(key, value, codec, ttl, name)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+class RespStandIn:
+    """In-process server speaking enough of the Redis protocol for
+    RedisBackend (PING, AUTH, SELECT, GET, SET with EX/PX, DEL), to try the
+    shared cache without a Redis server.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        import socketserver
+
+        store, lock = {}, threading.Lock()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        command = read_reply(self.rfile)
+                    except ConnectionError:
+                        return
+                    self.wfile.write(_stand_in_reply(command, store, lock))
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    @property
+    def url(self):
+        return f'redis://{self.host}:{self.port}/0'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _stand_in_reply(command, store, lock):
+    name = command[0].upper()
+    now = time.time()
+    with lock:
+        if name == b'GET':
+            value, expires = store.get(command[1], (None, None))
+            if value is None or (expires is not None and expires < now):
+                return b'$-1\r\n'
+            return b'$%d\r\n%s\r\n' % (len(value), value)
+        if name == b'SET':
+            expires = None
+            if len(command) == 5:
+                unit = 1000 if command[3].upper() == b'PX' else 1
+                expires = now + int(command[4]) / unit
+            store[command[1]] = (command[2], expires)
+            return b'+OK\r\n'
+        if name == b'DEL':
+            return b':%d\r\n' % sum(store.pop(k, None) is not None
+                                    for k in command[1:])
+    if name in (b'PING', b'AUTH', b'SELECT'):
+        return b'+OK\r\n' if name != b'PING' else b'+PONG\r\n'
+    return b'-ERR unknown command\r\n'
+
+
+if __name__ == '__main__':
+    # Two "replicas" sharing a stand-in Redis, then encoded size and decode
+    # time per format against pickle:
+    # python -m src.cache_utils
+    import pickle
+
+    import numpy as np
+    from PIL import Image
+
+    stand_in = RespStandIn()
+    calls = []
+
+    @shared('demo.campaign')
+    def campaign(brand):
+        calls.append(brand)
+        time.sleep(0.2)
+        return f'A campaign for {brand}'
+
+    for label in ('replica a', 'replica b'):
+        # Each replica has its own connection to the shared server
+        _cache = SharedCache(RedisBackend.from_url(stand_in.url))
+        start = time.perf_counter()
+        campaign('Nike')
+        print(f'{label}: {time.perf_counter() - start:.3f} s, '
+              f'stats {_cache.stats()}')
+    print(f'computed {len(calls)} time(s) for 2 requests')
+
+    rng = np.random.default_rng(0)
+    events = [{'id': str(i), 'title': f'Event {i}', 'category': 'concerts',
+               'phq_attendance': int(rng.integers(100, 100000)),
+               'location': [float(rng.normal()), float(rng.normal())],
+               'labels': ['music', 'outdoor'],
+               'start': pd.Timestamp('2026-01-01', tz='UTC')}
+              for i in range(500)]
+    base = np.linspace(0, 255, 1024, dtype=np.float32)
+    image = Image.fromarray(np.clip(
+        base[None, :, None] * rng.random(3) + base[:, None, None] * 0.3
+        + rng.normal(0, 4, (1024, 1024, 3)), 0, 255).astype(np.uint8))
+    samples = [('campaign text', 'Bold, bright, 2024. ' * 300, JSON),
+               ('events', events, RECORDS),
+               ('image', image, IMAGE)]
+    for label, value, codec in samples:
+        for fmt, dump, load in (
+                ('pickle', lambda v: pickle.dumps(v, pickle.HIGHEST_PROTOCOL),
+                 pickle.loads),
+                (codec, lambda v: encode(v, codec), decode)):
+            try:
+                payload = dump(value)
+            except ImportError as e:
+                print(f'{label} / {fmt}: skipped ({e})')
+                continue
+            start = time.perf_counter()
+            for _ in range(5):
+                load(payload)
+            elapsed = (time.perf_counter() - start) / 5
+            print(f'{label} / {fmt}: {len(payload) / 1024:.0f} KB, '
+                  f'decode {elapsed * 1e3:.2f} ms')
+    stand_in.close()
@@ -0,0 +1,205 @@
+import contextlib
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from loguru import logger
+
+
+DEFAULT_BUDGET_SECONDS = 60
+# Calls are not started with less than this left, they could not succeed
+MIN_CALL_SECONDS = 1
+# Seconds a stage usually needs; a stage whose estimate, plus what is kept
+# for more important stages, does not fit in the remaining budget is dropped
+# or cut down instead of started
+STAGE_ESTIMATES = {
+    'full_images': 8,
+    'hero_image': 8,
+    'images': 4,
+    'events_full_list': 20,
+    'events_search': 6,
+    'events': 10,
+    'insta': 20,
+}
+# Threads running calls that have no timeout of their own; a call running
+# past the deadline is left behind and its result dropped
+DETACHED_WORKERS = 16
+# Calls to a provider left running past their deadline; with this many the
+# provider is taken as stuck and new calls fail straight away instead of
+# queueing behind them
+MAX_ABANDONED_PER_PROVIDER = 2
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+_slot_hold = contextvars.ContextVar('slot_hold', default=None)
+_abandoned = {}
+_abandoned_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the run's budget is spent before or during a call"""
+
+
+class Deadline:
+    """Time budget for one run. Set it with set_deadline and every stage and
+    provider call below (pool threads included, when started with
+    job_utils.submit_in_context) sizes its timeout from it.
+
+    Args:
+        seconds (float): Budget from now.
+    """
+
+    def __init__(self, seconds=DEFAULT_BUDGET_SECONDS):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, stage, reserve=0):
+        """Whether a stage's usual duration fits in what is left, keeping
+        reserve seconds for more important stages still to come"""
+        return self.remaining() >= STAGE_ESTIMATES.get(stage, 0) + reserve
+
+    def timeout(self, cap=None):
+        """Timeout for a single call: what is left, at most cap
+
+        Raises:
+            DeadlineExceeded: if less than MIN_CALL_SECONDS is left
+        """
+        remaining = self.remaining()
+        if remaining < MIN_CALL_SECONDS:
+            raise DeadlineExceeded(f'{self.seconds}s budget spent')
+        return remaining if cap is None else min(cap, remaining)
+
+
+def set_deadline(deadline):
+    _deadline.set(deadline)
+
+
+def get_deadline():
+    return _deadline.get()
+
+
+def call_timeout(cap=None):
+    """Per-call timeout from the current deadline, cap (may be None) when
+    there is no deadline"""
+    deadline = get_deadline()
+    return cap if deadline is None else deadline.timeout(cap)
+
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current deadline has passed"""
+    deadline = get_deadline()
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded(f'{deadline.seconds}s budget spent')
+
+
+def remaining_time():
+    """Seconds left on the current deadline, None without one"""
+    deadline = get_deadline()
+    return None if deadline is None else deadline.remaining()
+
+
+def deadline_expired():
+    deadline = get_deadline()
+    return deadline is not None and deadline.expired()
+
+
+def stage_allowed(stage, reserve=0):
+    deadline = get_deadline()
+    return deadline is None or deadline.allows(stage, reserve)
+
+
+class SlotHold:
+    """Detached calls given up on while holding a provider slot. The
+    scheduler keeps the slot until they have really finished."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.futures = []
+
+
+@contextlib.contextmanager
+def holding_slot(provider):
+    """Mark the block as running in one of provider's scheduler slots"""
+    hold = SlotHold(provider)
+    token = _slot_hold.set(hold)
+    try:
+        yield hold
+    finally:
+        _slot_hold.reset(token)
+
+
+def hold_slot_until(future):
+    """Keep the enclosing scheduler slot taken until future is done, for
+    calls that return before the work they started has finished"""
+    hold = _slot_hold.get()
+    if hold is not None:
+        hold.futures.append(future)
+
+
+def abandoned_calls(provider):
+    with _abandoned_lock:
+        return _abandoned.get(provider, 0)
+
+
+def check_abandoned(provider):
+    """Raise DeadlineExceeded if provider has too many calls still running
+    past their deadline"""
+    stuck = abandoned_calls(provider)
+    if stuck >= MAX_ABANDONED_PER_PROVIDER:
+        raise DeadlineExceeded(f'{provider} still has {stuck} calls running '
+                               'past their deadline')
+
+
+def _abandon(provider, future):
+    def finished(_):
+        with _abandoned_lock:
+            _abandoned[provider] -= 1
+
+    with _abandoned_lock:
+        _abandoned[provider] = _abandoned.get(provider, 0) + 1
+    future.add_done_callback(finished)
+
+
+_detached = ThreadPoolExecutor(max_workers=DETACHED_WORKERS,
+                               thread_name_prefix='campaign-deadline')
+
+
+def run_with_deadline(fn, *args, cap=None, **kwargs):
+    """Run a call that takes no timeout (SDK calls) on a detached thread and
+    stop waiting for it when the deadline comes.
+
+    A call given up on keeps running, so it keeps its provider's scheduler
+    slot until it ends and counts towards MAX_ABANDONED_PER_PROVIDER.
+
+    Args:
+        fn (callable): Call to make.
+        cap (float, optional): Longest wait even with budget left.
+
+    Returns:
+        Whatever fn returns.
+    """
+    timeout = call_timeout(cap)
+    if timeout is None:
+        return fn(*args, **kwargs)
+    hold = _slot_hold.get()
+    provider = getattr(fn, '__name__', str(fn)) if hold is None \
+        else hold.provider
+    check_abandoned(provider)
+    context = contextvars.copy_context()
+    future = _detached.submit(context.run, fn, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if not future.cancel():
+            _abandon(provider, future)
+            if hold is not None:
+                hold.futures.append(future)
+        logger.warning('{} gave up after {:.1f}s', provider, timeout)
+        raise DeadlineExceeded(f'{provider} ran past the deadline') from None
@@ -0,0 +1,453 @@
+import random
+import threading
+import time
+
+import httpx
+import openai
+import streamlit as st
+from loguru import logger
+
+from src.deadline_utils import (DeadlineExceeded, call_timeout,
+                                 check_deadline, get_deadline)
+from src.scheduler_utils import set_provider_capacity
+
+
+OPENAI = 'openai'
+AZURE = 'azure'
+
+# Concurrent calls per endpoint when the config does not say
+DEFAULT_CAPACITY = 4
+LATENCY_ALPHA = 0.3
+# Quota headers older than this are assumed to have reset
+QUOTA_STALE_SECONDS = 60
+# Endpoints with less quota left than this only get traffic as spillover
+MIN_QUOTA = 0.05
+RATE_LIMIT_SECONDS = 10
+MAX_CONSECUTIVE_FAILURES = 3
+EJECT_SECONDS = 60
+HEALTH_CHECK_SECONDS = 30
+# Errors that say something about the endpoint rather than the request;
+# a stream failing half way raises the bare httpx error
+ENDPOINT_ERRORS = (openai.APIConnectionError, openai.APITimeoutError,
+                   openai.InternalServerError, openai.AuthenticationError,
+                   openai.PermissionDeniedError, httpx.TransportError)
+
+
+class Endpoint:
+    """One OpenAI key or Azure resource, with its own client, live latency,
+    remaining quota and health.
+
+    Args:
+        name (str): Shown in logs and stats.
+        kind (str): OPENAI or AZURE.
+        api_key (str): Key for this endpoint.
+        api_base (str, optional): Azure resource URL.
+        api_version (str, optional): Azure API version.
+        deployments (dict, optional): Azure deployment name per model, an
+            Azure endpoint only serves the models listed here.
+        weight (float, optional): Relative share of traffic. Defaults to 1.
+        capacity (int, optional): Concurrent calls it takes.
+    """
+
+    def __init__(self, name, kind, api_key, api_base=None, api_version=None,
+                 deployments=None, weight=1.0, capacity=DEFAULT_CAPACITY):
+        self.name = name
+        self.kind = kind
+        self.weight = float(weight)
+        self.capacity = int(capacity)
+        self.deployments = dict(deployments or {})
+        self.in_flight = 0
+        self.latency = None
+        self.quota = None
+        self.quota_seen = 0.0
+        self.limited_until = 0.0
+        self.ejected_until = 0.0
+        self.consecutive_failures = 0
+        self.calls = 0
+        self.errors = 0
+        # Retries are the pool's job: a 429 should spill over to another
+        # endpoint, not sleep on this one
+        self.http_client = httpx.Client(
+            event_hooks={'response': [self._read_quota]})
+        if kind == AZURE:
+            self.client = openai.AzureOpenAI(
+                api_key=api_key, azure_endpoint=api_base,
+                api_version=api_version, max_retries=0,
+                http_client=self.http_client)
+        else:
+            self.client = openai.OpenAI(api_key=api_key, max_retries=0,
+                                        http_client=self.http_client)
+        self._api_key = api_key
+        self._api_base = api_base
+        self._api_version = api_version
+
+    def serves(self, model):
+        return self.kind != AZURE or model in self.deployments
+
+    def deployment(self, model):
+        """Name to send as the model, the deployment name on Azure"""
+        return self.deployments.get(model, model)
+
+    def chat_model(self, model, **kwargs):
+        """langchain chat model sharing this endpoint's HTTP client"""
+        from langchain_openai import AzureChatOpenAI, ChatOpenAI
+        if self.kind == AZURE:
+            return AzureChatOpenAI(
+                azure_deployment=self.deployment(model),
+                azure_endpoint=self._api_base, api_key=self._api_key,
+                api_version=self._api_version, max_retries=0,
+                http_client=self.http_client, **kwargs)
+        return ChatOpenAI(model=model, api_key=self._api_key, max_retries=0,
+                          http_client=self.http_client, **kwargs)
+
+    def _read_quota(self, response):
+        # Both OpenAI and Azure send x-ratelimit-* headers; the scarcer of
+        # requests and tokens is what is left
+        fractions = []
+        for unit in ('requests', 'tokens'):
+            remaining = response.headers.get(f'x-ratelimit-remaining-{unit}')
+            limit = response.headers.get(f'x-ratelimit-limit-{unit}')
+            try:
+                fractions.append(int(remaining) / max(int(limit), 1))
+            except (TypeError, ValueError):
+                continue
+        if fractions:
+            self.quota = min(fractions)
+            self.quota_seen = time.monotonic()
+
+    def remaining_quota(self):
+        if (self.quota is None
+                or time.monotonic() - self.quota_seen > QUOTA_STALE_SECONDS):
+            return 1.0
+        return self.quota
+
+    def available(self, now):
+        return now >= self.ejected_until and now >= self.limited_until
+
+    def stats(self):
+        now = time.monotonic()
+        return {'kind': self.kind,
+                'weight': self.weight,
+                'in_flight': self.in_flight,
+                'latency': None if self.latency is None
+                else round(self.latency, 3),
+                'remaining_quota': round(self.remaining_quota(), 3),
+                'rate_limited_for': max(0, round(self.limited_until - now)),
+                'ejected_for': max(0, round(self.ejected_until - now)),
+                'calls': self.calls,
+                'errors': self.errors}
+
+
+class EndpointPool:
+    """Spread OpenAI calls over several endpoints.
+
+    Each call goes to an endpoint picked at random with probability
+    weight x remaining quota / (latency x (1 + calls in flight)). A rate
+    limited endpoint is skipped until its retry-after has passed and the
+    call spills over to the next one; an endpoint failing
+    MAX_CONSECUTIVE_FAILURES times in a row is ejected until a background
+    health check finds it working again.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = list(endpoints)
+        self._lock = threading.Lock()
+        self._checker = threading.Thread(target=self._check_forever,
+                                         name='endpoint-health', daemon=True)
+        self._checker.start()
+
+    @property
+    def capacity(self):
+        return sum(e.capacity for e in self.endpoints)
+
+    def _score(self, endpoint, default_latency):
+        quota = endpoint.remaining_quota()
+        if quota < MIN_QUOTA:
+            quota *= 0.01
+        latency = endpoint.latency or default_latency
+        return endpoint.weight * quota / (latency * (1 + endpoint.in_flight))
+
+    def candidates(self, model):
+        """Endpoints to try for a model, in order: a weighted random draw
+        among the available ones, then the rate limited and ejected ones as
+        a last resort
+        """
+        now = time.monotonic()
+        with self._lock:
+            serving = [e for e in self.endpoints if e.serves(model)]
+            latencies = [e.latency for e in serving if e.latency]
+            default_latency = (sum(latencies) / len(latencies)
+                               if latencies else 1.0)
+            available = [e for e in serving if e.available(now)]
+            scores = {e.name: self._score(e, default_latency)
+                      for e in available}
+        ordered = []
+        while available:
+            weights = [scores[e.name] for e in available]
+            pick = (random.choices(available, weights)[0] if sum(weights)
+                    else available[0])
+            ordered.append(pick)
+            available.remove(pick)
+        rest = sorted((e for e in serving if e not in ordered),
+                      key=lambda e: max(e.limited_until, e.ejected_until))
+        return ordered + rest
+
+    def run(self, model, call, stream=False):
+        """Run call(endpoint, deployment) on the best endpoint for a model,
+        spilling over to the next one on rate limits and endpoint errors.
+
+        Args:
+            model (str): OpenAI model name, mapped to a deployment on Azure.
+            call (callable): Takes the Endpoint and the model or deployment
+                name to send.
+            stream (bool, optional): call returns a stream of chunks. The
+                endpoint's call then only ends when the stream is read to
+                the end, fails or is closed. Defaults to False.
+
+        Returns:
+            Whatever call returns, wrapped in a TrackedStream when streaming.
+        """
+        candidates = self.candidates(model)
+        if not candidates:
+            raise ValueError(f'No endpoint serves {model}')
+        return self._run_on(candidates, model, call, stream)
+
+    def _run_on(self, candidates, model, call, stream):
+        last_error = None
+        for n, endpoint in enumerate(candidates):
+            check_deadline()
+            with self._lock:
+                endpoint.in_flight += 1
+                endpoint.calls += 1
+            start = time.perf_counter()
+            try:
+                result = call(endpoint, endpoint.deployment(model))
+            except BaseException as e:
+                self._release(endpoint)
+                if not self._record_error(endpoint, e):
+                    raise
+                last_error = e
+                continue
+            if stream:
+                rest = candidates[n + 1:]
+                return TrackedStream(
+                    self, endpoint, result, start,
+                    spill_over=(lambda: self._run_on(rest, model, call,
+                                                     stream)) if rest
+                    else None)
+            self._release(endpoint)
+            self._succeeded(endpoint, time.perf_counter() - start)
+            return result
+        raise last_error
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def _record_error(self, endpoint, error):
+        """Account a failed call to its endpoint. Returns whether the next
+        endpoint may take the call over."""
+        if isinstance(error, openai.RateLimitError):
+            self._rate_limited(endpoint, error)
+            return True
+        if isinstance(error, ENDPOINT_ERRORS):
+            deadline = get_deadline()
+            if deadline is not None and deadline.expired():
+                # Our own budget ran out, not the endpoint's fault
+                raise DeadlineExceeded(
+                    f'{endpoint.name} ran past the deadline') from error
+            self._failed(endpoint, error)
+            return True
+        return False
+
+    def chat_completion(self, model, **kwargs):
+        """client.chat.completions.create on the best endpoint, with a
+        timeout from the run's deadline"""
+        timeout = call_timeout()
+        if timeout is not None:
+            kwargs.setdefault('timeout', timeout)
+        return self.run(model, lambda endpoint, deployment:
+                        endpoint.client.chat.completions.create(
+                            model=deployment, **kwargs),
+                        stream=kwargs.get('stream', False))
+
+    def _succeeded(self, endpoint, latency):
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.latency = (latency if endpoint.latency is None else
+                                LATENCY_ALPHA * latency
+                                + (1 - LATENCY_ALPHA) * endpoint.latency)
+
+    def _rate_limited(self, endpoint, error):
+        try:
+            seconds = float(error.response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            seconds = RATE_LIMIT_SECONDS
+        logger.info('{} rate limited for {:.0f}s, spilling over',
+                    endpoint.name, seconds)
+        with self._lock:
+            endpoint.errors += 1
+            endpoint.limited_until = time.monotonic() + seconds
+
+    def _failed(self, endpoint, error):
+        logger.warning('{} failed: {!r}', endpoint.name, error)
+        with self._lock:
+            endpoint.errors += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                logger.warning('Ejecting {} for {}s', endpoint.name,
+                               EJECT_SECONDS)
+                endpoint.ejected_until = time.monotonic() + EJECT_SECONDS
+
+    def check(self, endpoint):
+        """Health check, lists models so it costs no tokens"""
+        try:
+            endpoint.client.models.list()
+        except Exception as e:
+            logger.warning('Health check of {} failed: {!r}',
+                           endpoint.name, e)
+            with self._lock:
+                endpoint.ejected_until = time.monotonic() + EJECT_SECONDS
+            return False
+        with self._lock:
+            if endpoint.ejected_until:
+                logger.info('{} is healthy again', endpoint.name)
+            endpoint.ejected_until = 0.0
+            endpoint.consecutive_failures = 0
+        return True
+
+    def _check_forever(self):
+        while True:
+            time.sleep(HEALTH_CHECK_SECONDS)
+            for endpoint in self.endpoints:
+                if endpoint.ejected_until:
+                    self.check(endpoint)
+
+    def stats(self):
+        with self._lock:
+            return {e.name: e.stats() for e in self.endpoints}
+
+
+class TrackedStream:
+    """Chunks of a streamed completion. The endpoint counts the call as in
+    flight until the stream is read to the end, fails or is closed, and
+    its latency covers the whole stream. A stream failing before its first
+    chunk spills over to the next endpoint like any other call.
+
+    Use it as a context manager so giving up half way releases the
+    endpoint and the connection.
+    """
+
+    def __init__(self, pool, endpoint, stream, start, spill_over=None):
+        self.endpoint = endpoint
+        self._pool = pool
+        self._stream = stream
+        self._start = start
+        self._spill_over = spill_over
+        self._started = False
+        self._open = True
+        self._next = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next is not None:
+            return next(self._next)
+        try:
+            chunk = next(self._stream)
+        except StopIteration:
+            self._finish(succeeded=True)
+            raise
+        except BaseException as e:
+            self._finish()
+            if (not self._pool._record_error(self.endpoint, e)
+                    or self._started or self._spill_over is None):
+                raise
+            logger.info('{} stream failed before its first chunk, spilling '
+                        'over', self.endpoint.name)
+            self._next = self._spill_over()
+            return next(self._next)
+        self._started = True
+        return chunk
+
+    def _finish(self, succeeded=False):
+        if not self._open:
+            return
+        self._open = False
+        self._pool._release(self.endpoint)
+        if succeeded:
+            self._pool._succeeded(self.endpoint,
+                                  time.perf_counter() - self._start)
+
+    def close(self):
+        if self._next is not None:
+            self._next.close()
+        self._finish()
+        close = getattr(self._stream, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def endpoints_from_config(config, default_api_key=None):
+    """Build endpoints from a list of dicts (st.secrets.openai_endpoints),
+    or a single OpenAI endpoint for the default key when there is none
+
+    Args:
+        config (list): Dicts with 'name', 'type' ('openai' or 'azure'),
+            'api_key' and optionally 'api_base', 'api_version',
+            'deployments', 'weight' and 'capacity'.
+        default_api_key (str, optional): Key used without a config.
+
+    Returns:
+        list: list of Endpoint
+    """
+    if not config:
+        return [Endpoint('openai', OPENAI, default_api_key)]
+    return [Endpoint(name=c.get('name', f'{c.get("type", OPENAI)}-{i}'),
+                     kind=c.get('type', OPENAI),
+                     api_key=c['api_key'],
+                     api_base=c.get('api_base'),
+                     api_version=c.get('api_version'),
+                     deployments=c.get('deployments'),
+                     weight=c.get('weight', 1.0),
+                     capacity=c.get('capacity', DEFAULT_CAPACITY))
+            for i, c in enumerate(config)]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_endpoint_pool(default_creds=None):
+    """Process-wide endpoint pool, built on first use from
+    st.secrets.openai_endpoints, falling back to the single key the app
+    was given. The openai scheduler's capacity becomes the pool's total.
+
+    Args:
+        default_creds (str or dict, optional): API key, or a dict with an
+            'api_key', used when no endpoints are configured.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if isinstance(default_creds, str) or default_creds is None:
+                default_key = default_creds
+            else:
+                default_key = default_creds['api_key']
+            config = [dict(c) for c in st.secrets.get('openai_endpoints', [])]
+            _pool = EndpointPool(endpoints_from_config(config, default_key))
+            set_provider_capacity('openai', _pool.capacity)
+            logger.info('OpenAI endpoint pool: {}',
+                        [e.name for e in _pool.endpoints])
+        return _pool
+
+
+def endpoint_stats():
+    return {} if _pool is None else _pool.stats()
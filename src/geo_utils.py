@@ -0,0 +1,253 @@
+import csv
+import functools
+import os
+import pickle
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+
+GAZETTEER_PATH = Path(__file__).parent.parent / Path('assets') / \
+    'gazetteer.csv'
+EVENTS_DIR = Path(__file__).parent.parent / '.cache' / 'events'
+EARTH_RADIUS_KM = 6371.0
+GRID_DEGREES = 1.0
+# How long a PredictHQ search over an area counts as fresh
+COVERAGE_TTL_SECONDS = 6 * 60 * 60
+# Stored events beyond this are dropped, those fetched longest ago first
+MAX_EVENTS = 200_000
+INDEX_FILE = 'index.pkl'
+# Columns every query result has, even when nothing is stored yet
+EVENT_COLUMNS = ['id', 'title', 'category', 'phq_attendance', 'location',
+                 'start', 'end']
+
+
+def _normalise_name(name):
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.lower().replace('.', '').split())
+
+
+@functools.lru_cache(maxsize=1)
+def load_gazetteer(path=GAZETTEER_PATH):
+    """Load the bundled city gazetteer into a name -> (lat, lon) dict,
+    including the aliases column.
+
+    Args:
+        path (Path, optional): CSV with city, country, latitude, longitude
+            and '|' separated aliases.
+
+    Returns:
+        dict: normalised name to (latitude, longitude)
+    """
+    gazetteer = {}
+    with open(path, encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            coordinates = (float(row['latitude']), float(row['longitude']))
+            names = [row['city']] + [a for a in row['aliases'].split('|')
+                                     if a]
+            for name in names:
+                gazetteer.setdefault(_normalise_name(name), coordinates)
+    return gazetteer
+
+
+def resolve_city(city_name):
+    """Resolve a free text city, e.g. 'Paris' or 'São Paulo, Brazil', to
+    coordinates from the offline gazetteer.
+
+    Returns:
+        tuple: (latitude, longitude), or None when the city is unknown
+    """
+    gazetteer = load_gazetteer()
+    name = _normalise_name(city_name)
+    if name in gazetteer:
+        return gazetteer[name]
+    return gazetteer.get(name.split(',')[0].strip())
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Great circle distance from one point to arrays of points"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats - lat) / 2) ** 2
+         + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class EventIndex:
+    """Grid index over every PredictHQ event stored locally, plus a record of
+    which circles and date ranges have been searched, so repeat and nearby
+    queries can be answered without another API call.
+    """
+
+    def __init__(self, grid_degrees=GRID_DEGREES):
+        self.grid_degrees = grid_degrees
+        self.events = pd.DataFrame()
+        self.coverage = []
+        self._lats = np.empty(0)
+        self._lons = np.empty(0)
+        self._starts = np.empty(0, dtype='datetime64[ns]')
+        self._ends = np.empty(0, dtype='datetime64[ns]')
+        self._grid = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def _cell(self, lat, lon):
+        return (int(np.floor(lat / self.grid_degrees)),
+                int(np.floor(lon / self.grid_degrees)))
+
+    def add_events(self, events_df, latitude, longitude, radius_km,
+                   start_date, end_date, complete=True):
+        """Store the result of a radius search and record its coverage.
+
+        A search cut off at its result limit, or one that came back empty,
+        is stored without coverage: later queries of the area search again
+        instead of trusting part of it.
+        """
+        with self._lock:
+            if len(events_df):
+                combined = pd.concat([self.events, events_df],
+                                     ignore_index=True)
+                # Refetched events move to the end, with the newest
+                combined = combined.drop_duplicates(subset='id', keep='last')
+                self._rebuild(_prune_events(combined))
+            self.coverage = _fresh_coverage(self.coverage)
+            if not complete or not len(events_df):
+                return
+            self.coverage.append({'latitude': latitude,
+                                  'longitude': longitude,
+                                  'radius_km': radius_km,
+                                  'start': str(start_date),
+                                  'end': str(end_date),
+                                  'fetched_at': time.time()})
+
+    def _rebuild(self, events):
+        # PredictHQ gives location as [longitude, latitude]
+        locations = np.array(events['location'].tolist(), dtype=float)
+        self.events = events
+        self._lons, self._lats = locations[:, 0], locations[:, 1]
+        self._starts = _to_datetime64(events['start'])
+        self._ends = _to_datetime64(events['end'])
+        self._grid = defaultdict(list)
+        for row, (lat, lon) in enumerate(zip(self._lats, self._lons)):
+            self._grid[self._cell(lat, lon)].append(row)
+
+    def covers(self, latitude, longitude, radius_km, start_date, end_date):
+        """Whether a fresh stored search fully contains this query circle and
+        date range
+        """
+        now = time.time()
+        with self._lock:
+            for c in self.coverage:
+                if now - c['fetched_at'] > COVERAGE_TTL_SECONDS:
+                    continue
+                if c['start'] > str(start_date) or c['end'] < str(end_date):
+                    continue
+                distance = haversine_km(latitude, longitude,
+                                        c['latitude'], c['longitude'])
+                if distance + radius_km <= c['radius_km']:
+                    return True
+        return False
+
+    def query(self, latitude, longitude, radius_km, start_date=None,
+              end_date=None):
+        """Events within radius_km that are active in the date range"""
+        with self._lock:
+            rows = self._candidate_rows(latitude, longitude, radius_km)
+            if not len(rows):
+                return self._empty()
+            mask = haversine_km(latitude, longitude, self._lats[rows],
+                                self._lons[rows]) <= radius_km
+            if start_date is not None:
+                mask &= self._ends[rows] >= np.datetime64(str(start_date))
+            if end_date is not None:
+                mask &= self._starts[rows] <= np.datetime64(str(end_date))
+            return self.events.iloc[rows[mask]]
+
+    def _empty(self):
+        if len(self.events.columns):
+            return self.events.iloc[0:0]
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+
+    def _candidate_rows(self, latitude, longitude, radius_km):
+        lat_span = radius_km / 111.0
+        lon_span = lat_span / max(np.cos(np.radians(latitude)), 0.01)
+        lat_lo, lon_lo = self._cell(latitude - lat_span, longitude - lon_span)
+        lat_hi, lon_hi = self._cell(latitude + lat_span, longitude + lon_span)
+        rows = []
+        for i in range(lat_lo, lat_hi + 1):
+            for j in range(lon_lo, lon_hi + 1):
+                rows.extend(self._grid.get((i, j), ()))
+        return np.array(rows, dtype=int)
+
+    def save(self, directory=EVENTS_DIR):
+        """Write events and coverage to one file, atomically: concurrent
+        saves and loads see either the old or the new file, never a torn
+        one"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            # The frame is replaced, never changed in place, by add_events
+            state = {'events': self.events, 'coverage': list(self.coverage)}
+        tmp_path = directory / (f'{INDEX_FILE}.{os.getpid()}.'
+                                f'{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, directory / INDEX_FILE)
+
+    @classmethod
+    def load(cls, directory=EVENTS_DIR):
+        with open(Path(directory) / INDEX_FILE, 'rb') as f:
+            state = pickle.load(f)
+        index = cls()
+        index.coverage = _fresh_coverage(state['coverage'])
+        if len(state['events']):
+            index._rebuild(_prune_events(state['events']))
+        return index
+
+
+def _prune_events(events):
+    # Queries start today at the earliest, ended events are never served
+    ends = _to_datetime64(events['end'])
+    events = events[ends >= np.datetime64(pd.Timestamp.now('UTC')
+                                          .tz_localize(None))]
+    return events.iloc[-MAX_EVENTS:].reset_index(drop=True)
+
+
+def _fresh_coverage(coverage):
+    now = time.time()
+    return [c for c in coverage
+            if now - c['fetched_at'] <= COVERAGE_TTL_SECONDS]
+
+
+def _to_datetime64(column):
+    return pd.to_datetime(column, utc=True).dt.tz_localize(None).to_numpy()
+
+
+_event_index = None
+_event_index_lock = threading.Lock()
+
+
+def get_event_index():
+    """Process-wide event index, loaded from EVENTS_DIR when saved"""
+    global _event_index
+    with _event_index_lock:
+        if _event_index is None:
+            try:
+                _event_index = EventIndex.load(EVENTS_DIR)
+            except FileNotFoundError:
+                _event_index = EventIndex()
+            except Exception as e:
+                # Searching again is never worth failing a run over
+                logger.warning('Ignoring unreadable event index: {!r}', e)
+                _event_index = EventIndex()
+            logger.info('Event index holds {} events', len(_event_index))
+        return _event_index
@@ -0,0 +1,144 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+from loguru import logger
+from PIL import Image, ImageOps
+
+
+LOGO_PATH = Path(__file__).parent.parent / 'assets' / 'piecrust.png'
+# Instagram formats, (width, height) in pixels
+FORMATS = {
+    'square': (1080, 1080),
+    'portrait': (1080, 1350),
+    'story': (1080, 1920),
+}
+# Logo width as a fraction of the output width, and its margin from the
+# bottom right corner
+LOGO_WIDTH_RATIO = 0.2
+LOGO_MARGIN_RATIO = 0.03
+JPEG_QUALITY = 90
+POOL_WORKERS = os.cpu_count() or 1
+
+# Loaded once per worker process by _init_worker
+_logo = None
+_scaled_logos = {}
+
+
+def _init_worker(logo_path=LOGO_PATH):
+    global _logo
+    _logo = Image.open(logo_path).convert('RGBA')
+    _logo.load()
+
+
+def _scaled_logo(width):
+    logo_width = int(width * LOGO_WIDTH_RATIO)
+    if logo_width not in _scaled_logos:
+        height = round(_logo.height * logo_width / _logo.width)
+        _scaled_logos[logo_width] = _logo.resize((logo_width, height),
+                                                 Image.LANCZOS)
+    return _scaled_logos[logo_width]
+
+
+def postprocess_image(image, formats=FORMATS):
+    """Crop and resize an image to each Instagram format, composite the
+    brand logo and encode the result as JPEG. Runs in a pool worker.
+
+    Args:
+        image (PIL.Image): Generated post image.
+        formats (dict, optional): Format name to (width, height).
+
+    Returns:
+        dict: format name to JPEG bytes
+    """
+    if _logo is None:
+        _init_worker()
+    image = image.convert('RGB')
+    outputs = {}
+    for name, size in formats.items():
+        # Center crop to the aspect ratio, then resize
+        framed = ImageOps.fit(image, size, Image.LANCZOS)
+        logo = _scaled_logo(size[0])
+        margin = int(size[0] * LOGO_MARGIN_RATIO)
+        framed.paste(logo, (size[0] - logo.width - margin,
+                            size[1] - logo.height - margin), logo)
+        buffer = io.BytesIO()
+        framed.save(buffer, format='JPEG', quality=JPEG_QUALITY,
+                    optimize=True)
+        outputs[name] = buffer.getvalue()
+    return outputs
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_image_pool():
+    """Process pool for image post-processing, shared by all sessions.
+
+    Workers are spawned rather than forked since the Streamlit server is
+    multi-threaded.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            logger.info('Starting image pool with {} workers', POOL_WORKERS)
+            _pool = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker)
+        return _pool
+
+
+def submit_postprocess(image):
+    """Post-process an image off the calling thread, or on it when there is
+    a single core: a pool would only add the pickling of every image
+
+    Returns:
+        Future: resolves to the dict returned by postprocess_image
+    """
+    if POOL_WORKERS > 1:
+        return get_image_pool().submit(postprocess_image, image)
+    future = Future()
+    try:
+        future.set_result(postprocess_image(image))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+if __name__ == '__main__':
+    # Images per second per core, in process and on the pool, e.g.
+    # python -m src.image_utils 32
+    import sys
+    import time
+
+    import numpy as np
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    rng = np.random.default_rng(0)
+    # Smooth gradients plus noise, so JPEG has realistic work to do
+    base = np.linspace(0, 255, 1024, dtype=np.float32)
+    images = [Image.fromarray(np.clip(
+        base[None, :, None] * rng.random(3) + base[:, None, None] * 0.3
+        + rng.normal(0, 12, (1024, 1024, 3)), 0, 255).astype(np.uint8))
+        for _ in range(count)]
+
+    start = time.perf_counter()
+    for image in images:
+        postprocess_image(image)
+    elapsed = time.perf_counter() - start
+    print(f'in process: {count / elapsed:.2f} images/s on 1 core')
+
+    pool = get_image_pool()
+    # Warm the workers up so spawning is not part of the timing
+    list(pool.map(_init_worker, [LOGO_PATH] * POOL_WORKERS))
+    start = time.perf_counter()
+    list(pool.map(postprocess_image, images))
+    elapsed = time.perf_counter() - start
+    print(f'pool: {count / elapsed:.2f} images/s on {POOL_WORKERS} cores, '
+          f'{count / elapsed / POOL_WORKERS:.2f} images/s/core')
+    pool.shutdown()
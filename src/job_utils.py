@@ -0,0 +1,261 @@
+import contextvars
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from src.memory_utils import get_artefact_store, resolve
+from src.profile_utils import profile_run
+
+
+JOB_WORKERS = 4
+MAX_JOBS = 100
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Job:
+    """A pipeline run executing on the worker pool. Results are published as
+    they are produced so the page can render partial output on every rerun.
+    """
+
+    def __init__(self, key, inputs, owner=None, profile=False):
+        self.key = key
+        self.inputs = inputs
+        self.profile = profile
+        # Session whose memory budget the job's images and tables count
+        # against
+        self.owner = key if owner is None else owner
+        # Sessions showing the job, other than its owner it may be shared
+        # by any that submitted the same inputs
+        self.sessions = set() if owner is None else {owner}
+        self.status = QUEUED
+        self.progress = 'Waiting for a free worker'
+        self.error = None
+        self.created = time.time()
+        self.updated = self.created
+        self.started = None
+        self.results = {}
+        self.metadata = {'run_id': key[:12], 'routing': [], 'metrics': {},
+                         'degraded': []}
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+
+    def set_result(self, name, value):
+        value = get_artefact_store().put(self.owner, value)
+        with self._lock:
+            self.results[name] = value
+            self.updated = time.time()
+
+    def set_item(self, name, index, value):
+        """Set one element of a dict-valued result, e.g. a single image"""
+        value = get_artefact_store().put(self.owner, value)
+        with self._lock:
+            self.results.setdefault(name, {})[index] = value
+            self.updated = time.time()
+
+    def record_metric(self, name, value):
+        with self._lock:
+            self.metadata['metrics'][name] = value
+
+    def record_degraded(self, message):
+        """Note something left out or cut down, to stay within the deadline
+        or after a provider failed"""
+        logger.warning('Degraded run: {}', message)
+        with self._lock:
+            self.metadata['degraded'].append(message)
+
+    def elapsed(self):
+        """Seconds since a worker picked the job up"""
+        if self.started is None:
+            return 0.0
+        return time.monotonic() - self.started
+
+    def set_progress(self, message):
+        logger.info('Job progress: {}', message)
+        with self._lock:
+            self.progress = message
+            self.updated = time.time()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def snapshot(self):
+        """Return a consistent copy of the job state for rendering, with
+        spilled artefacts loaded back
+        """
+        get_artefact_store().touch(self.owner)
+        with self._lock:
+            snapshot = {'key': self.key,
+                        'status': self.status,
+                        'progress': self.progress,
+                        'error': self.error,
+                        'results': {k: copy.copy(v)
+                                    for k, v in self.results.items()},
+                        'metadata': {k: copy.copy(v)
+                                     for k, v in dict(self.metadata).items()}}
+        snapshot['results'] = resolve(snapshot['results'])
+        return snapshot
+
+
+class JobManager:
+    """Persistent worker pool plus the local store of jobs keyed by their
+    inputs. Lives for the whole server process, so Streamlit reruns and
+    reconnecting browsers find the same jobs.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, max_jobs=MAX_JOBS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='campaign-job')
+        self._jobs = OrderedDict()
+        self._max_jobs = max_jobs
+        self._lock = threading.Lock()
+        get_artefact_store().add_eviction_listener(self._drop_owner)
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def submit(self, key, inputs, fn, *args, owner=None, profile=False,
+               **kwargs):
+        """Submit fn(job, *args, **kwargs) unless a job with the same key is
+        already running or finished, in which case that job is returned.
+        A profiled submission always starts a new run.
+
+        Args:
+            key (str): Job key, see make_job_key.
+            inputs (dict): Inputs the key was built from, kept for display.
+            fn (callable): Pipeline function, gets the Job as first argument.
+            owner (str, optional): Session submitting the job, for memory
+                budgets. Defaults to the job key.
+            profile (bool, optional): Profile the run, see
+                profile_utils.profile_run. Defaults to False.
+
+        Returns:
+            Job: the new or existing job
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if (job is not None and job.status not in (FAILED, CANCELLED)
+                    and not (profile and job.finished)):
+                logger.info('Re-attaching to job {} ({})', key[:12],
+                            job.status)
+                self._jobs.move_to_end(key)
+                if owner is not None:
+                    job.sessions.add(owner)
+                return job
+            job = Job(key, inputs, owner=owner, profile=profile)
+            self._jobs[key] = job
+            self._prune()
+        self._executor.submit(self._run, job, fn, *args, **kwargs)
+        return job
+
+    def attach(self, key, session):
+        """Count a session as showing a job, e.g. a tab reloaded on its URL"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and session is not None:
+                job.sessions.add(session)
+            return job
+
+    def detach(self, key, session):
+        """A session moved on from a job. The job is cancelled once no
+        session is left showing it, so a run shared by several sessions
+        keeps going for the others.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job.sessions.discard(session)
+            if job.sessions or job.finished:
+                return
+        logger.info('Cancelling job {}, no session is showing it', key[:12])
+        job.cancel()
+
+    def _drop_owner(self, owner):
+        # The session's artefacts are gone: its jobs could only show empty
+        # results, so the next submission with the same inputs runs again
+        with self._lock:
+            keys = [k for k, j in self._jobs.items() if j.owner == owner]
+            jobs = [self._jobs.pop(k) for k in keys]
+        for job in jobs:
+            logger.info('Dropping job {} of evicted session', job.key[:12])
+            job.cancel()
+
+    def _prune(self):
+        finished = [k for k, j in self._jobs.items() if j.finished]
+        while len(self._jobs) > self._max_jobs and finished:
+            self._jobs.pop(finished.pop(0))
+
+    @staticmethod
+    def _run(job, fn, *args, **kwargs):
+        job.status = RUNNING
+        job.started = time.monotonic()
+        try:
+            with logger.contextualize(run_id=job.metadata['run_id']):
+                if job.profile:
+                    JobManager._run_profiled(job, fn, *args, **kwargs)
+                else:
+                    fn(job, *args, **kwargs)
+        except Exception as e:
+            logger.exception('Job {} failed', job.key[:12])
+            job.error = repr(e)
+            job.status = FAILED
+            return
+        job.status = CANCELLED if job.cancelled else DONE
+        job.set_progress(job.status)
+
+    @staticmethod
+    def _run_profiled(job, fn, *args, **kwargs):
+        profile = {}
+        try:
+            with profile_run(job.metadata['run_id']) as profile:
+                fn(job, *args, **kwargs)
+        finally:
+            # Saved for failed runs too, they are often the slow ones
+            with job._lock:
+                job.metadata['profile'] = profile
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit that carries the caller's context variables (run ids,
+    deadlines, scheduling identity) into the pool thread
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+
+def make_job_key(**inputs):
+    """Stable key for a set of pipeline inputs"""
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+        return _job_manager
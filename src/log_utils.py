@@ -0,0 +1,216 @@
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+
+from loguru import logger
+
+
+LOG_LEVEL = os.environ.get('CAMPAIGN_POC_LOG_LEVEL', 'INFO')
+# Per-module minimum levels, the most specific module prefix wins. Extra
+# entries can be given as CAMPAIGN_POC_LOG_LEVELS="src.geo_utils=DEBUG,..."
+MODULE_LEVELS = {
+    'src.parse_utils': 'WARNING',
+    'src.semantic_cache_utils': 'WARNING',
+    'httpx': 'WARNING',
+}
+# Fraction of records kept per level; unlisted levels are always kept
+SAMPLE_RATES = {'DEBUG': 0.05}
+# Longer messages (prompts, full responses) are cut to this many characters
+MAX_MESSAGE_CHARS = 500
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _parse_module_levels(spec):
+    levels = {}
+    for item in filter(None, (i.strip() for i in spec.split(','))):
+        module, _, level = item.partition('=')
+        levels[module.strip()] = level.strip().upper()
+    return levels
+
+
+def make_filter(default_level=LOG_LEVEL, module_levels=None,
+                sample_rates=None):
+    """Build a loguru filter applying per-module levels and level sampling
+
+    Args:
+        default_level (str, optional): Level for modules without an entry.
+        module_levels (dict, optional): Module prefix to level name.
+        sample_rates (dict, optional): Level name to fraction kept.
+
+    Returns:
+        callable: filter for logger.add
+    """
+    module_levels = MODULE_LEVELS if module_levels is None else module_levels
+    sample_rates = SAMPLE_RATES if sample_rates is None else sample_rates
+    default_no = logger.level(default_level).no
+    # Longest prefixes first so 'src.geo_utils' beats 'src'
+    prefixes = sorted(((m, logger.level(level).no)
+                       for m, level in module_levels.items()),
+                      key=lambda item: -len(item[0]))
+    level_cache = {}
+
+    def _filter(record):
+        name = record['name'] or ''
+        minimum = level_cache.get(name)
+        if minimum is None:
+            minimum = next((no for prefix, no in prefixes
+                            if name == prefix
+                            or name.startswith(prefix + '.')), default_no)
+            level_cache[name] = minimum
+        if record['level'].no < minimum:
+            return False
+        rate = sample_rates.get(record['level'].name)
+        return rate is None or random.random() < rate
+
+    return _filter
+
+
+def handler_level(default_level=LOG_LEVEL, module_levels=None):
+    """Lowest level any module logs at. Registering the handler at it lets
+    loguru drop other calls before patching and formatting them, instead of
+    leaving it to the filter.
+    """
+    module_levels = MODULE_LEVELS if module_levels is None else module_levels
+    return min(logger.level(level).no
+               for level in (default_level, *module_levels.values()))
+
+
+def truncate_message(record, max_chars=MAX_MESSAGE_CHARS):
+    message = record['message']
+    if len(message) > max_chars:
+        record['message'] = (f'{message[:max_chars]}... '
+                             f'[{len(message) - max_chars} chars truncated]')
+
+
+class BackgroundSink:
+    """loguru sink that hands records to a writer thread, which does the JSON
+    encoding and the I/O. The logging call only pays for a queue put.
+
+    loguru's own enqueue=True goes through a multiprocessing pipe and still
+    serializes in the caller, which costs more than it saves here.
+    """
+
+    def __init__(self, stream=sys.stderr):
+        if isinstance(stream, (str, os.PathLike)):
+            stream = open(stream, 'a', encoding='utf-8')
+        self._stream = stream
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_forever,
+                                        name='log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def __call__(self, message):
+        record = message.record
+        exception = record['exception']
+        self._queue.put((record['time'], record['level'].name,
+                         record['name'], record['function'], record['line'],
+                         record['message'], dict(record['extra']),
+                         None if exception is None else str(message)))
+
+    def _write_forever(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Drain whatever else is waiting and write it in one go
+            while len(batch) < 1000:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write(batch)
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        lines = []
+        for timestamp, level, name, function, line, text, extra, exc in batch:
+            entry = {'time': timestamp.isoformat(), 'level': level,
+                     'module': name, 'function': function, 'line': line,
+                     'message': text, **extra}
+            if exc is not None:
+                entry['exception'] = exc
+            lines.append(json.dumps(entry, default=str))
+        self._stream.write('\n'.join(lines) + '\n')
+        self._stream.flush()
+
+    def stop(self):
+        """Flush what is queued and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+def configure_logging(sink=sys.stderr, force=False):
+    """Replace loguru's default handler with a BackgroundSink writing JSON
+    records (with the run id) from a background thread.
+
+    Safe to call on every Streamlit rerun, it only configures once unless
+    force is set.
+
+    Args:
+        sink (optional): Anything logger.add accepts. Defaults to stderr.
+        force (bool, optional): Reconfigure even if already configured.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured and not force:
+            return
+        module_levels = {
+            **MODULE_LEVELS,
+            **_parse_module_levels(
+                os.environ.get('CAMPAIGN_POC_LOG_LEVELS', ''))}
+        logger.remove()
+        logger.configure(extra={'run_id': None}, patcher=truncate_message)
+        logger.add(BackgroundSink(sink),
+                   level=handler_level(module_levels=module_levels),
+                   format='{message}',
+                   filter=make_filter(module_levels=module_levels))
+        _configured = True
+
+
+if __name__ == '__main__':
+    import time
+
+    post = 'Caption: 🎉 a caption #tag\nImage Description: ' + 'x' * 2000
+    requests = 200
+
+    def legacy_request():
+        # What one Instagram run used to log: every post chunk in full,
+        # formatted eagerly
+        for i in range(40):
+            logger.info('Formatting posts for instagram')
+            logger.info(f'{post}')
+
+    def request():
+        # What one Instagram run logs now
+        for i in range(40):
+            logger.debug('Formatting post {}', i)
+        logger.info('Parsed 40 posts: {}', post * 40)
+
+    def bench(label, request):
+        start = time.perf_counter()
+        for _ in range(requests):
+            request()
+        elapsed = (time.perf_counter() - start) / requests
+        print(f'{label}: {elapsed * 1e3:.3f} ms of logging per request')
+
+    # All runs log to stderr, run with 2> some-file or a pipe to compare
+    logger.remove()
+    logger.add(sys.stderr, level='DEBUG')
+    bench('before: verbose calls, synchronous text sink', legacy_request)
+    # The sinks compared on the same calls
+    bench('current calls, synchronous text sink', request)
+    configure_logging(force=True)
+    with logger.contextualize(run_id='bench'):
+        bench('current calls, background JSON sink', request)
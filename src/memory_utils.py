@@ -0,0 +1,295 @@
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from PIL import Image
+
+
+SESSION_BUDGET_BYTES = 200 * 1024 ** 2
+GLOBAL_BUDGET_BYTES = 1024 ** 3
+IDLE_SESSION_SECONDS = 30 * 60
+# Smaller artefacts stay plain Python objects on the job
+MIN_TRACKED_BYTES = 256 * 1024
+# Spilled artefacts read back for rendering stay loaded, within this many
+# bytes across sessions, so a page polling every second does not reread them
+LOADED_BYTES = 64 * 1024 ** 2
+SPILL_DIR = Path(__file__).parent.parent / '.cache' / 'spill'
+
+IMAGE = 'image'
+DATAFRAME = 'dataframe'
+# Encoded files by name, e.g. the JPEG crops of a post image
+ENCODED = 'encoded'
+
+
+def artefact_kind(value):
+    if isinstance(value, Image.Image):
+        return IMAGE
+    if isinstance(value, pd.DataFrame):
+        return DATAFRAME
+    if (isinstance(value, dict) and value
+            and all(isinstance(v, bytes) for v in value.values())):
+        return ENCODED
+    return None
+
+
+def artefact_nbytes(value):
+    kind = artefact_kind(value)
+    if kind == IMAGE:
+        return value.width * value.height * len(value.getbands())
+    if kind == DATAFRAME:
+        return int(value.memory_usage(deep=True).sum())
+    if kind == ENCODED:
+        return sum(len(v) for v in value.values())
+    return 0
+
+
+class ArtefactRef:
+    """Handle for an artefact held by the ArtefactStore, in memory or on
+    disk. Jobs keep these instead of the artefacts themselves.
+    """
+
+    def __init__(self, owner, kind, nbytes):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.kind = kind
+        self.nbytes = nbytes
+
+
+class _Entry:
+    def __init__(self, ref, value):
+        self.ref = ref
+        self.value = value
+        self.path = None
+        # Picked to spill and being written, still served from memory
+        self.spilling = False
+
+    @property
+    def in_memory(self):
+        return self.value is not None
+
+
+class ArtefactStore:
+    """Per-session and global memory budgets for generated artefacts.
+
+    Over budget, the least recently used artefacts spill to disk: images as
+    .npy files read back memory-mapped, DataFrames and encoded files as
+    pickles. Sessions idle for longer than IDLE_SESSION_SECONDS are evicted
+    altogether, and eviction listeners (the job manager) are told so.
+    """
+
+    def __init__(self, session_budget=SESSION_BUDGET_BYTES,
+                 global_budget=GLOBAL_BUDGET_BYTES, spill_dir=SPILL_DIR,
+                 loaded_bytes=LOADED_BYTES):
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self.spill_dir = Path(spill_dir)
+        self.loaded_bytes = loaded_bytes
+        self._entries = OrderedDict()
+        self._last_seen = {}
+        # Spilled artefacts read back recently, ref id to value
+        self._loaded = OrderedDict()
+        self._loaded_usage = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_eviction_listener(self, listener):
+        """Call listener(owner) after an idle session has been evicted"""
+        self._listeners.append(listener)
+
+    def put(self, owner, value):
+        """Track a large artefact and return its ref, or the value itself
+        when it is not an image, DataFrame or dict of encoded files, or is
+        too small to matter
+        """
+        kind = artefact_kind(value)
+        nbytes = artefact_nbytes(value) if kind else 0
+        if nbytes < MIN_TRACKED_BYTES:
+            return value
+        ref = ArtefactRef(owner, kind, nbytes)
+        with self._lock:
+            self._entries[ref.id] = _Entry(ref, value)
+            self._last_seen[owner] = time.monotonic()
+            victims = self._pick_spills(owner)
+        # Written outside the lock, other sessions' reads and puts do not
+        # wait for the disk
+        for entry in victims:
+            self._spill(entry)
+        self.evict_idle()
+        return ref
+
+    def get(self, ref):
+        """Artefact for a ref, loaded from disk if it was spilled and kept
+        loaded within loaded_bytes. Returns None once the owning session has
+        been evicted.
+        """
+        with self._lock:
+            entry = self._entries.get(ref.id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(ref.id)
+            self._last_seen[ref.owner] = time.monotonic()
+            if entry.in_memory:
+                return entry.value
+            if ref.id in self._loaded:
+                self._loaded.move_to_end(ref.id)
+                return self._loaded[ref.id]
+            path = entry.path
+        if ref.kind == IMAGE:
+            value = Image.fromarray(np.load(path, mmap_mode='r'))
+        elif ref.kind == ENCODED:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        else:
+            value = pd.read_pickle(path)
+        with self._lock:
+            if ref.id in self._entries and ref.id not in self._loaded:
+                self._loaded[ref.id] = value
+                self._loaded_usage += ref.nbytes
+                self._trim_loaded()
+        return value
+
+    def _trim_loaded(self):
+        # The caller holds the lock
+        while self._loaded_usage > self.loaded_bytes and self._loaded:
+            self._forget_loaded(next(iter(self._loaded)))
+
+    def _forget_loaded(self, ref_id):
+        # The caller holds the lock
+        if self._loaded.pop(ref_id, None) is not None:
+            self._loaded_usage -= self._entries[ref_id].ref.nbytes
+
+    def touch(self, owner):
+        with self._lock:
+            self._last_seen[owner] = time.monotonic()
+
+    def _pick_spills(self, owner):
+        # Least recently used first, the caller holds the lock. Entries
+        # already being spilled by another put count as gone.
+        in_memory = [e for e in self._entries.values()
+                     if e.in_memory and not e.spilling]
+        session_usage = sum(e.ref.nbytes for e in in_memory
+                            if e.ref.owner == owner)
+        global_usage = sum(e.ref.nbytes for e in in_memory)
+        victims = []
+        for entry in in_memory:
+            if session_usage <= self.session_budget:
+                break
+            if entry.ref.owner == owner:
+                entry.spilling = True
+                victims.append(entry)
+                session_usage -= entry.ref.nbytes
+                global_usage -= entry.ref.nbytes
+        for entry in in_memory:
+            if global_usage <= self.global_budget:
+                break
+            if not entry.spilling:
+                entry.spilling = True
+                victims.append(entry)
+                global_usage -= entry.ref.nbytes
+        return victims
+
+    def _spill(self, entry):
+        # Called without the lock, on an entry _pick_spills marked
+        try:
+            path = self._write(entry.ref, entry.value)
+        except Exception as e:
+            logger.warning('Could not spill {}: {!r}', entry.ref.id, e)
+            with self._lock:
+                entry.spilling = False
+            return
+        with self._lock:
+            entry.spilling = False
+            evicted = self._entries.get(entry.ref.id) is not entry
+            if not evicted:
+                entry.path, entry.value = path, None
+        if evicted:
+            # The session went while the file was written
+            path.unlink(missing_ok=True)
+            return
+        logger.debug('Spilled {} {} ({} bytes)', entry.ref.kind,
+                     entry.ref.id, entry.ref.nbytes)
+
+    def _write(self, ref, value):
+        directory = self.spill_dir / str(ref.owner)
+        directory.mkdir(parents=True, exist_ok=True)
+        if ref.kind == IMAGE:
+            path = directory / f'{ref.id}.npy'
+            if value.mode not in ('L', 'RGB', 'RGBA'):
+                value = value.convert('RGB')
+            np.save(path, np.asarray(value))
+        elif ref.kind == ENCODED:
+            path = directory / f'{ref.id}.pkl'
+            with open(path, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        else:
+            path = directory / f'{ref.id}.pkl'
+            value.to_pickle(path)
+        return path
+
+    def evict_idle(self, idle_seconds=IDLE_SESSION_SECONDS):
+        now = time.monotonic()
+        with self._lock:
+            idle = [owner for owner, seen in self._last_seen.items()
+                    if now - seen > idle_seconds]
+            for owner in idle:
+                self._evict(owner)
+        # Outside the lock, listeners take their own
+        for owner in idle:
+            for listener in self._listeners:
+                listener(owner)
+        return idle
+
+    def _evict(self, owner):
+        logger.info('Evicting artefacts of idle session {}', owner)
+        for ref_id in [i for i, e in self._entries.items()
+                       if e.ref.owner == owner]:
+            self._forget_loaded(ref_id)
+            del self._entries[ref_id]
+        self._last_seen.pop(owner, None)
+        shutil.rmtree(self.spill_dir / str(owner), ignore_errors=True)
+
+    def report(self):
+        """Memory and disk usage per session and per artefact type
+
+        Returns:
+            dict: owner -> kind -> {'count', 'memory_bytes', 'disk_bytes'},
+                plus a 'total' entry
+        """
+        report = {}
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            for owner in (str(entry.ref.owner), 'total'):
+                usage = report.setdefault(owner, {}).setdefault(
+                    entry.ref.kind,
+                    {'count': 0, 'memory_bytes': 0, 'disk_bytes': 0})
+                usage['count'] += 1
+                if entry.in_memory:
+                    usage['memory_bytes'] += entry.ref.nbytes
+                else:
+                    usage['disk_bytes'] += entry.ref.nbytes
+        return report
+
+
+def resolve(value, store=None):
+    """Replace ArtefactRefs (also inside dict results) with their artefacts"""
+    store = get_artefact_store() if store is None else store
+    if isinstance(value, ArtefactRef):
+        return store.get(value)
+    if isinstance(value, dict):
+        return {k: resolve(v, store) for k, v in value.items()}
+    return value
+
+
+_artefact_store = ArtefactStore()
+
+
+def get_artefact_store():
+    return _artefact_store
@@ -1,11 +1,21 @@
 from loguru import logger
 import openai
 import json
+import time
+import tiktoken
 from pathlib import Path
 import streamlit as st
 from src.gcp_utils import (get_secret_from_gcp,
                            TEAM_SECRETS_GCP_PROJECT_SECRET_ID,
                            get_gcp_project_id_from_env_var)
+from src.cache_utils import LLM_TTL, shared
+from src.deadline_utils import check_deadline
+from src.endpoint_utils import get_endpoint_pool
+from src.parse_utils import (add_newline_before_list_numbers,
+                              StreamingCampaignParser)
+from src.replay_utils import recordable
+from src.routing_utils import MODELS, call_with_routing
+from src.scheduler_utils import scheduled
 
 
 gcp_project_id = 'wpp-cto-os-intlignce-layer-dev'
@@ -72,9 +82,15 @@ def get_openai_creds(gcp_project_id):
 #     text_response = response["choices"][0]["message"]["content"]
 #     return text_response
 
+@recordable('openai.campaign')
+@shared('openai.campaign', ttl=LLM_TTL)
+@scheduled('openai')
 def get_gpt4_campaign_response(user_input,
                                type='gpt4',
-                               gpt4_creds_dict=None):
+                               gpt4_creds_dict=None,
+                               model=None,
+                               run_metadata=None,
+                               on_text=None):
     """Get text response from GPT4 Azure
 
     Args:
@@ -82,6 +98,13 @@ def get_gpt4_campaign_response(user_input,
         type (str): Type of prompt to send to GPT4 (either normal or events)
         gpt4_creds_dict (dict, optional): Specific creds for GPT4 in Azure.
                                           Defaults to None.
+        model (str, optional): Force a model instead of letting the router
+            pick one for the 'campaign' stage. Defaults to None.
+        run_metadata (dict, optional): Routing decisions get recorded here.
+            Defaults to None.
+        on_text (callable, optional): When given the response is streamed
+            and this is called with the text so far each time a line
+            completes. Defaults to None.
 
     Returns:
         str: Text response from GPT4
@@ -90,22 +113,42 @@ def get_gpt4_campaign_response(user_input,
         gpt4_creds_dict = st.secrets.openai
     messages = _get_newgpt_prompt(type=type)
     prompt = _add_role_user(user_input, messages)
-    logger.info('Setting creds to send to openai')
-    _set_openai(openai_creds=gpt4_creds_dict)
-
-    logger.info('Getting campaign from GPT4')
-    prompt = _add_role_user(user_input, messages)
-    response = openai.chat.completions.create(
-        model='gpt-4',
-        messages=prompt,
-        temperature=0.8,
-        max_tokens=1200,
-        top_p=0.95,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=None)
-
-    text_response = response.choices[0].message.content
+    pool = get_endpoint_pool(gpt4_creds_dict)
+    attempts = []
+
+    def _create(model):
+        logger.info('Getting campaign from {}', model)
+        if on_text is not None and attempts:
+            # A model that failed part way has already shown its text
+            on_text('')
+        attempts.append(model)
+        response = pool.chat_completion(
+            model,
+            messages=prompt,
+            temperature=0.8,
+            max_tokens=1200,
+            top_p=0.95,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=None,
+            stream=on_text is not None)
+        if on_text is None:
+            _record_usage(run_metadata, 'campaign', response)
+            return response.choices[0].message.content
+        parts = []
+        with response:
+            for chunk in response:
+                check_deadline()
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ''
+                parts.append(delta)
+                if '\n' in delta:
+                    on_text(''.join(parts))
+        return ''.join(parts)
+
+    text_response = call_with_routing('campaign', _create, model=model,
+                                      run_metadata=run_metadata)
     return text_response
 
 
@@ -147,7 +190,11 @@ def get_gpt4_campaign_response(user_input,
 #     text_response_insta = response["choices"][0]["message"]["content"]
 #     return text_response_insta
 
-def get_gpt4_insta_response(user_input, campaign, gpt4_creds_dict=None):
+@recordable('openai.insta')
+@shared('openai.insta', ttl=LLM_TTL)
+@scheduled('openai')
+def get_gpt4_insta_response(user_input, campaign, gpt4_creds_dict=None,
+                            model=None, run_metadata=None):
     """Get text response from GPT4 (for instagram posts specifically
     after generating a campaign)
 
@@ -157,6 +204,10 @@ def get_gpt4_insta_response(user_input, campaign, gpt4_creds_dict=None):
         campaign (str): campaign returned from get_gpt4_campaign
         gpt4_creds_dict (dict, optional): Specific creds for GPT4 in Azure.
             Defaults to None.
+        model (str, optional): Force a model instead of letting the router
+            pick one for the 'insta' stage. Defaults to None.
+        run_metadata (dict, optional): Routing decisions get recorded here.
+            Defaults to None.
 
     Returns:
         str: instagram posts
@@ -165,23 +216,27 @@ def get_gpt4_insta_response(user_input, campaign, gpt4_creds_dict=None):
         gpt4_creds_dict = st.secrets.openai
     messages = _get_newgpt_prompt(type='gpt4')
     prompt = _add_role_user(user_input, messages)
-    _set_openai(openai_creds=gpt4_creds_dict)
+    pool = get_endpoint_pool(gpt4_creds_dict)
     logger.info('Adding campaign to get back instagram posts')
     prompt_campaign = _add_campaign(campaign, prompt)
     prompt_insta = _add_insta(prompt_campaign)
 
-    logger.info('Getting insta campaign from GPT4')
-    response = openai.chat.completions.create(
-        model='gpt-4',
-        messages=prompt_insta,
-        temperature=0.8,
-        max_tokens=1200,
-        top_p=0.95,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=None)
-
-    text_response = response.choices[0].message.content
+    def _create(model):
+        logger.info('Getting insta campaign from {}', model)
+        response = pool.chat_completion(
+            model,
+            messages=prompt_insta,
+            temperature=0.8,
+            max_tokens=1200,
+            top_p=0.95,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=None)
+        _record_usage(run_metadata, 'insta', response)
+        return response.choices[0].message.content
+
+    text_response = call_with_routing('insta', _create, model=model,
+                                      run_metadata=run_metadata)
     return text_response
     # messages = _get_newgpt_prompt(type='gpt4')
     # prompt = _add_role_user(user_input, messages)
@@ -204,11 +259,130 @@ def get_gpt4_insta_response(user_input, campaign, gpt4_creds_dict=None):
 
 
 
+@recordable('openai.combined')
+@shared('openai.combined', ttl=LLM_TTL)
+@scheduled('openai')
+def get_gpt4_campaign_and_insta_response(user_input, gpt4_creds_dict=None,
+                                         model=None, run_metadata=None,
+                                         on_campaign=None, on_post=None):
+    """Get the campaign and the instagram posts in one streamed JSON
+    response instead of two sequential calls.
+
+    Args:
+        user_input (str): parsed user input,
+            from the function parse_user_input_gpt4
+        gpt4_creds_dict (dict, optional): Specific creds for GPT4.
+            Defaults to None.
+        model (str, optional): Force a model instead of letting the router
+            pick one for the 'combined' stage. Defaults to None.
+        run_metadata (dict, optional): Routing decisions and the latency and
+            token comparison get recorded here. Defaults to None.
+        on_campaign (callable, optional): Called with the campaign text as
+            soon as it has streamed in.
+        on_post (callable, optional): Called with each InstaPost as soon as
+            it has streamed in.
+
+    Returns:
+        tuple: (campaign, list of post dicts as InstaPost.to_dict gives)
+    """
+    if gpt4_creds_dict is None:
+        gpt4_creds_dict = st.secrets.openai
+    messages = _get_newgpt_prompt(type='gpt4')
+    prompt = _add_combined(_add_role_user(user_input, messages))
+    pool = get_endpoint_pool(gpt4_creds_dict)
+
+    def _create(model):
+        logger.info('Getting campaign and insta posts from {}', model)
+        extra = ({'response_format': {'type': 'json_object'}}
+                 if MODELS.get(model, {}).get('json_mode') else {})
+        start = time.perf_counter()
+        stream = pool.chat_completion(
+            model,
+            messages=prompt,
+            temperature=0.8,
+            max_tokens=2400,
+            top_p=0.95,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=None,
+            stream=True,
+            **extra)
+        parser = StreamingCampaignParser()
+        time_to_campaign = None
+        with stream:
+            for chunk in stream:
+                check_deadline()
+                if not chunk.choices:
+                    continue
+                for kind, value in parser.feed(
+                        chunk.choices[0].delta.content or ''):
+                    if kind == 'campaign':
+                        time_to_campaign = time.perf_counter() - start
+                        if on_campaign:
+                            on_campaign(value)
+                    elif on_post:
+                        on_post(value)
+        if parser.campaign is None:
+            raise ValueError('Combined response had no campaign')
+        _record_combined_metrics(run_metadata, model, user_input, prompt,
+                                 parser, time_to_campaign,
+                                 time.perf_counter() - start)
+        return parser.campaign, [post.to_dict() for post in parser.posts]
+
+    return call_with_routing('combined', _create, model=model,
+                             run_metadata=run_metadata)
+
+
+def _record_usage(run_metadata, stage, response):
+    # Token counts the API reports for a call, to set against the combined
+    # call's estimates
+    usage = getattr(response, 'usage', None)
+    if run_metadata is None or usage is None:
+        return
+    run_metadata.setdefault('metrics', {})[f'{stage}_tokens'] = {
+        'input': usage.prompt_tokens, 'output': usage.completion_tokens}
+
+
+def _record_combined_metrics(run_metadata, model, user_input, prompt, parser,
+                             time_to_campaign, total_seconds):
+    # Set against the two-call flow, which is not run: its token counts are
+    # tiktoken estimates (the insta call resends the system prompt, the user
+    # query and the whole campaign). Measured two-call latencies are the
+    # campaign_seconds and insta_seconds metrics of runs in that mode.
+    if run_metadata is None:
+        return
+    combined_input = count_tokens(prompt, model)
+    campaign_call = count_tokens(_add_role_user(
+        user_input, _get_newgpt_prompt(type='gpt4')), model)
+    insta_call = count_tokens(_add_insta(_add_campaign(
+        parser.campaign, _add_role_user(
+            user_input, _get_newgpt_prompt(type='gpt4')))), model)
+    run_metadata.setdefault('metrics', {})['combined'] = {
+        'token_counts': 'tiktoken estimate',
+        'input_tokens': combined_input,
+        'output_tokens': count_tokens(parser.buffer, model),
+        'two_call_input_tokens_estimate': campaign_call + insta_call,
+        'input_tokens_saved_estimate': (campaign_call + insta_call
+                                        - combined_input),
+        'time_to_campaign': round(time_to_campaign or total_seconds, 3),
+        'total_seconds': round(total_seconds, 3),
+    }
+
+
+def count_tokens(messages, model='gpt-4'):
+    """Count tokens of a prompt (list of messages) or a string"""
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    if isinstance(messages, str):
+        return len(encoding.encode(messages))
+    # Every message costs a few tokens of framing on top of its content
+    return sum(4 + len(encoding.encode(m['content'])) for m in messages) + 3
+
+
 def add_newline_before_digits(text):
-    digits = [i for i in text if i.isdigit()]
-    for digit in digits:
-        text = text.replace(digit, f'\n{digit}')
-    return text
+    return add_newline_before_list_numbers(text)
 
 
 def _set_openai_to_azure(azure_openai_creds_dict, use_preview_api=True):
@@ -251,6 +425,25 @@ def _add_insta(prompt):
     return prompt
 
 
+def _add_combined(prompt):
+    combined_tag = """Come up with the brand platform and, in the same
+        answer, 4 Instagram posts promoting it. Each post needs an
+        emoji-filled caption and a highly detailed and specific image
+        description that will be sent to an AI Image Generator as a prompt.
+        Answer only with a JSON object in this format, with the campaign
+        first:
+        {"campaign": "the full brand platform, as markdown",
+         "posts": [{"caption": "🎉🎬 Celebrating 100 years of Disney magic!
+                    #ACenturyofDreams 🏰💖",
+                    "image_description": "A colorful image of a retro
+                    suitcase adorned with stickers representing Disney
+                    movies, set against a background of clouds and stars."}]}
+        """
+    message_combined = {"role": "user", "content": combined_tag}
+    prompt.append(message_combined)
+    return prompt
+
+
 def _get_newgpt_prompt(type='gpt4'):
     if type == 'gpt4':
         file = Path(__file__).parent.parent / \
@@ -0,0 +1,367 @@
+import itertools
+import json
+import re
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+
+# "Post 2", "**Post 2:**" or "### Post 2" starting a post's record. The
+# lookahead rejects most lines on their first character, before the engine
+# tries the optional parts one by one.
+_POST_LABEL = (r'(?=[#*_ \t]*p)(?:#{1,6}[ \t]*)?(?:\*\*|__)?[ \t]*post'
+               r'[ \t]*#?(?P<%s>\d{1,3})[ \t]*(?:\*\*|__)?[ \t]*')
+# Instagram fields: "1. Caption:", "**Image Description:**", "Post 2 - Image:"
+_FIELD = (rf'(?:{_POST_LABEL % "field_post"}[:.)-]?[ \t]*(?:\*\*|__)?[ \t]*)?'
+          r'(?:\d{1,3}[.)][ \t]*)?(?:\*\*|__)?[ \t]*'
+          r'(?P<field>caption|image[ \t]+description|image[ \t]+prompt|image)'
+          r'[ \t]*(?:\*\*|__)?[ \t]*:[ \t]*(?:\*\*|__)?')
+# A "Post N" label alone, or followed by the caption without a field name
+_POST = (rf'{_POST_LABEL % "post"}(?:[:.)-]|$)[ \t]*(?:\*\*|__)?[ \t]*')
+# Markdown headings: "### Visual Identity"
+_MD_HEADING = r'#{1,6}[ \t]*(?:\d{1,2}[.)][ \t]*)?(?P<md>[^\n]+?)[ \t]*:?'
+# Bold labels: "**Promotional Tactics:**" or "2. **KPIs**:"
+_BOLD_HEADING = (r'(?:\d{1,2}[.)][ \t]*)?(?:\*\*|__)(?P<bold>[^*_\n]{1,60}?)'
+                 r'[ \t]*:?[ \t]*(?:\*\*|__)[ \t]*:?')
+# Plain labels: "Visual Identity:" (only kept when it names a known section)
+_PLAIN_HEADING = (r'(?:\d{1,2}[.)][ \t]*)?'
+                  r'(?P<plain>[A-Za-z][A-Za-z &/\'-]{1,40}):(?=[ \t]|$)')
+_MARKER = (rf'[ \t]*(?:{_FIELD}|{_POST}|{_MD_HEADING}$|{_BOLD_HEADING}'
+           rf'|{_PLAIN_HEADING})')
+
+MARKER_RE = re.compile(rf'^{_MARKER}', re.IGNORECASE | re.MULTILINE)
+# The same markers after a newline: a literal first character lets the
+# regex engine skip from line to line instead of trying every position
+_LINE_MARKER_RE = re.compile(rf'\n{_MARKER}', re.IGNORECASE | re.MULTILINE)
+
+SECTION_KEYWORDS = [
+    ('principal_image', re.compile(
+        r'principal image|main image|hero image|key visual', re.I)),
+    ('visual_identity', re.compile(
+        r'visual identity|colou?r palette|visual style|look and feel', re.I)),
+    ('tactics', re.compile(
+        r'tactic|promotion|platform feature|activation|channel', re.I)),
+    ('kpis', re.compile(
+        r'kpi|key performance|measur|metric|success', re.I)),
+]
+
+# Keys of the combined campaign + posts JSON response
+_CAMPAIGN_KEY_RE = re.compile(r'"campaign"\s*:\s*')
+_POSTS_KEY_RE = re.compile(r'"posts"\s*:\s*\[')
+_ARRAY_GAP_RE = re.compile(r'[\s,]*')
+
+# Numbered list items glued to the previous sentence: "...ideas. 2. Next"
+_LIST_NUMBER_RE = re.compile(r'(?<=\S)[ \t]+(?=\d{1,3}[.)][ \t])')
+# Numbering left at the end of a chunk, e.g. the "2." before a new field
+_TRAILING_NUMBER_RE = re.compile(r'(?<!\S)\d{1,3}[.)]$')
+
+
+@dataclass
+class InstaPost:
+    caption: str
+    image_description: str = ''
+
+    def to_dict(self):
+        return {'Caption': self.caption,
+                'Image Description': self.image_description}
+
+
+@dataclass
+class CampaignSections:
+    intro: str = ''
+    visual_identity: str = ''
+    tactics: str = ''
+    kpis: str = ''
+    principal_image: str = ''
+    other: dict = field(default_factory=dict)
+
+
+@dataclass
+class ParsedResponse:
+    campaign: CampaignSections
+    posts: list
+
+
+def classify_heading(label):
+    """Map a heading label to a CampaignSections field, or None"""
+    for name, pattern in SECTION_KEYWORDS:
+        if pattern.search(label):
+            return name
+    return None
+
+
+def iter_markers(text):
+    """Instagram fields, post labels and section headings in text, in
+    order"""
+    first = MARKER_RE.match(text)
+    return itertools.chain([first] if first else [],
+                           _LINE_MARKER_RE.finditer(text))
+
+
+def parse_response(text):
+    """Parse a GPT-4 campaign and/or Instagram response in a single pass.
+
+    Every marker (Instagram field, "Post N" label or section heading) is
+    found by one scan over the text; the content of a marker runs until the
+    next one. A "Post N" label with a new number always starts a new post,
+    whatever the fields that follow it.
+
+    Args:
+        text (str): GPT-4 response.
+
+    Returns:
+        ParsedResponse: campaign sections and Instagram posts
+    """
+    campaign = CampaignSections()
+    posts = []
+    section, start = 'intro', 0
+    in_posts = False
+    # The last post was started by a label and has no caption yet
+    record_open = False
+    post_number = None
+
+    def close(end):
+        content = _clean(text[start:end])
+        if not content:
+            return
+        if in_posts:
+            return
+        if section in campaign.other or not hasattr(campaign, section):
+            previous = campaign.other.get(section, '')
+            campaign.other[section] = _join(previous, content)
+        else:
+            setattr(campaign, section,
+                    _join(getattr(campaign, section), content))
+
+    pending_field = None
+    for match in iter_markers(text):
+        field_name, post, field_post = match.group('field', 'post',
+                                                   'field_post')
+        post = post or field_post
+        if field_name is None and post is None:
+            label = (match.group('md') or match.group('bold')
+                     or match.group('plain')).strip()
+            name = classify_heading(label)
+            if name is None and match.group('plain') is not None:
+                # Plain "Label:" lines only start known sections
+                continue
+        if pending_field is not None:
+            record_open = _set_post_field(
+                posts, pending_field, _clean(text[start:match.start()]),
+                record_open)
+            pending_field = None
+        else:
+            close(match.start())
+        start = match.end()
+        if post is not None and post != post_number:
+            # "Post 1 - Caption:" then "Post 1 - Image:" is one record
+            post_number = post
+            posts.append(InstaPost(caption=''))
+            record_open = True
+        if post is not None and field_name is None:
+            # Text right after a bare label is the caption
+            pending_field = 'post'
+            in_posts = True
+        elif field_name is not None:
+            pending_field = field_name.lower()
+            in_posts = True
+        else:
+            in_posts = False
+            section = name or label
+    if pending_field is not None:
+        _set_post_field(posts, pending_field, _clean(text[start:]),
+                        record_open)
+    else:
+        close(len(text))
+    # Labels with nothing under them
+    posts = [p for p in posts if p.caption or p.image_description]
+
+    logger.debug('Parsed {} posts and {} extra sections', len(posts),
+                 len(campaign.other))
+    return ParsedResponse(campaign=campaign, posts=posts)
+
+
+class StreamingCampaignParser:
+    """Incremental parser for the streamed combined response
+    {"campaign": "...", "posts": [{"caption": ..., "image_description": ...}]}
+
+    feed() returns the campaign as soon as its string is closed and every
+    post as soon as its object is closed, without waiting for the rest.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.campaign = None
+        self.posts = []
+        self._decoder = json.JSONDecoder()
+        self._posts_pos = None
+
+    def feed(self, chunk):
+        """Add a streamed chunk and return new ('campaign', str) and
+        ('post', InstaPost) events
+        """
+        self.buffer += chunk
+        events = []
+        if self.campaign is None and '"' in chunk:
+            match = _CAMPAIGN_KEY_RE.search(self.buffer)
+            value = match and self._try_decode(match.end())
+            if isinstance(value, str):
+                self.campaign = value
+                events.append(('campaign', value))
+
+        if self._posts_pos is None:
+            match = _POSTS_KEY_RE.search(self.buffer)
+            if match:
+                self._posts_pos = match.end()
+        while self._posts_pos is not None and '}' in chunk:
+            start = _ARRAY_GAP_RE.match(self.buffer, self._posts_pos).end()
+            if start >= len(self.buffer) or self.buffer[start] != '{':
+                break
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, start)
+            except json.JSONDecodeError:
+                break
+            self._posts_pos = end
+            post = InstaPost(caption=value.get('caption', ''),
+                             image_description=value.get(
+                                 'image_description', ''))
+            self.posts.append(post)
+            events.append(('post', post))
+        return events
+
+    def _try_decode(self, position):
+        try:
+            return self._decoder.raw_decode(self.buffer, position)[0]
+        except json.JSONDecodeError:
+            return None
+
+
+def parse_instagram_posts(text):
+    return parse_response(text).posts
+
+
+def parse_campaign_sections(text):
+    return parse_response(text).campaign
+
+
+def find_principal_image(text, complete=True):
+    """Principal image description of a campaign, or '' if there is none
+    (yet).
+
+    Args:
+        text (str): Campaign text, possibly still streaming.
+        complete (bool, optional): Whether text is the whole response. If
+            not, the description is only returned once something follows
+            it, another heading or a blank line. Defaults to True.
+
+    Returns:
+        str: principal image description
+    """
+    start = None
+    for match in iter_markers(text):
+        if (match.group('field') is not None
+                or match.group('post') is not None):
+            if start is not None:
+                break
+            continue
+        label = (match.group('md') or match.group('bold')
+                 or match.group('plain')).strip()
+        name = classify_heading(label)
+        if name is None and match.group('plain') is not None:
+            continue
+        if start is not None:
+            return _clean(text[start:match.start()])
+        if name == 'principal_image':
+            start = match.end()
+    else:
+        match = None
+    if start is None:
+        return ''
+    if match is not None:
+        return _clean(text[start:match.start()])
+    rest = text[start:]
+    if complete:
+        return _clean(rest)
+    # Still streaming: a blank line after the description ends it
+    content = rest.lstrip()
+    paragraph_end = content.find('\n\n')
+    return _clean(content[:paragraph_end]) if paragraph_end > 0 else ''
+
+
+def add_newline_before_list_numbers(text):
+    """Put numbered list items on their own line without touching numbers
+    inside the text (prices, years, '3.5')
+    """
+    return _LIST_NUMBER_RE.sub('\n', text)
+
+
+def _set_post_field(posts, field_name, content, record_open):
+    # Returns whether the last post still waits for its caption
+    if field_name in ('caption', 'post'):
+        if record_open:
+            posts[-1].caption = content
+            return field_name == 'post' and not content
+        posts.append(InstaPost(caption=content))
+    elif posts and not posts[-1].image_description:
+        posts[-1].image_description = content
+        return record_open
+    else:
+        posts.append(InstaPost(caption='', image_description=content))
+    return False
+
+
+def _clean(content):
+    content = content.strip()
+    # Only the last few characters can hold the numbering, so the search
+    # stays constant time per chunk, and most sentences end in a letter
+    # before the full stop
+    if content[-1:] in ('.', ')') and content[-2:-1].isdigit():
+        match = _TRAILING_NUMBER_RE.search(content, max(0, len(content) - 4))
+        if match:
+            content = content[:match.start()].rstrip()
+    if content[:1] in ('*', '_') or content[-1:] in ('*', '_'):
+        content = content.strip('*_').strip()
+    return content
+
+
+def _join(previous, content):
+    return f'{previous}\n\n{content}' if previous else content
+
+
+if __name__ == '__main__':
+    import time
+
+    post = ('{n}. Caption: 🎉🎬 Celebrating 100 years of magic! Join us on '
+            'this journey with #ACenturyofDreams 🏰💖 since 1923.\n'
+            '{m}. Image Description: A colorful image of a retro suitcase '
+            'adorned with stickers from 3.5 decades, set against clouds.\n\n')
+    campaign = ('**Campaign Name:** Century of Dreams\n\n'
+                '### Visual Identity\nDeep blues, gold and 100 stars.\n\n'
+                '**Promotional Tactics:**\n1. AR filters\n2. Pop-ups\n\n'
+                '**KPIs:** Reach, engagement rate, 20% uplift\n\n'
+                '**Principal Image:** A castle under a starry sky.\n\n')
+    sizes = {'typical': campaign + ''.join(
+                 post.format(n=2 * i + 1, m=2 * i + 2) for i in range(5)),
+             'large': campaign + ''.join(
+                 post.format(n=2 * i + 1, m=2 * i + 2) for i in range(430))}
+
+    def legacy(response):
+        chunks = [re.sub(r"\n\n\d+\.\s", '', c)
+                  for c in response.split('Caption: ')]
+        return [c.split('Image Description: ') for c in chunks[1:]]
+
+    logger.remove()
+    for size, text in sizes.items():
+        print(f'{size} response: {len(text.encode()) / 1024:.1f} KB')
+        for name, fn in [('legacy split', legacy),
+                         ('parse_response', parse_response)]:
+            # Fastest of many runs, timings on a shared machine are noisy
+            best = float('inf')
+            for _ in range(max(100, 20000 // len(text.splitlines()))):
+                start = time.perf_counter()
+                fn(text)
+                best = min(best, time.perf_counter() - start)
+            print(f'  {name}: {best * 1e3:.3f} ms')
+    parsed = parse_response(sizes['large'])
+    print(len(parsed.posts), parsed.posts[0])
+    print(parsed.campaign)
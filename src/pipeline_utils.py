@@ -0,0 +1,479 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from loguru import logger
+
+from src.openai_utils import (get_gpt4_campaign_response,
+                              get_gpt4_insta_response,
+                              get_gpt4_campaign_and_insta_response)
+from src.parse_utils import find_principal_image
+from src.streamlit_utils import parse_insta_posts, parse_user_input_for_gpt4
+from src.stable_utils import (add_details_for_stable, download_image,
+                              get_stable_image, get_stable_image_async,
+                              get_prediction_tracker)
+from src.predict_utils import (find_events_by_city,
+                               get_list_of_events_from_df,
+                               get_event_recommendations,
+                               rank_events_across_cities)
+from src.deadline_utils import (DEFAULT_BUDGET_SECONDS, STAGE_ESTIMATES,
+                                 Deadline, DeadlineExceeded,
+                                 deadline_expired, remaining_time,
+                                 set_deadline, stage_allowed)
+from src.image_utils import submit_postprocess
+from src.job_utils import submit_in_context
+from src.replay_utils import OFF, replay_mode
+from src.scheduler_utils import BATCH, INTERACTIVE, set_request_context
+from src.semantic_cache_utils import get_semantic_cache
+from src.segmind_utils import (get_segmind_image, get_segmind_preview_image,
+                               get_segmind_full_image)
+
+# 'segmind' or 'replicate' (SDXL predictions, slower but with live progress)
+IMAGE_SERVICE = 'segmind'
+# Show a cheap preview of every post image first, then replace each one with
+# the full quality render (segmind only).
+PROGRESSIVE_IMAGES = True
+REPLICATE_WAIT_SECONDS = 1
+# Cities processed at once in multi-city mode
+CITY_WORKERS = 8
+# Get the campaign and the Instagram posts in a single streamed call instead
+# of two sequential ones (only when posts are requested)
+COMBINED_MODE = False
+# Crop final images to the Instagram formats with the logo on a process pool
+POSTPROCESS_IMAGES = True
+# Render the campaign's principal image while the posts are being written
+HERO_IMAGE = True
+HERO_WORKERS = 4
+# Events sent to the recommendation when time is short
+SHORT_EVENT_LIST = 15
+
+_hero_executor = ThreadPoolExecutor(max_workers=HERO_WORKERS,
+                                    thread_name_prefix='campaign-hero')
+
+
+def run_campaign_pipeline(job, brand, tags, insta, location, creds,
+                          cities=None, budget_seconds=DEFAULT_BUDGET_SECONDS,
+                          semantic_cache=True):
+    """Full campaign run, executed on a job worker. Nothing here touches
+    Streamlit: every output is published on the job and rendered by the page.
+
+    Args:
+        job (Job): Job to publish progress and results on.
+        brand (str): Brand from the sidebar.
+        tags (str): Taglines, broader ideas, references.
+        insta (bool): Whether to generate Instagram posts and images.
+        location (str): City for event recommendations, may be empty.
+        creds (dict): OpenAI creds, must have 'api_key'.
+        cities (list, optional): Several cities to fan out to instead of
+            location. Defaults to None.
+        budget_seconds (float, optional): The run finishes within this many
+            seconds of the click, dropping what does not fit, least
+            important first: full renders, images, events, posts.
+        semantic_cache (bool, optional): Serve a campaign cached for a near
+            identical query. False always asks for a new one.
+    """
+    # Regional fan-outs are heavy, let single clicks go ahead of them
+    set_request_context(job.owner, BATCH if cities else INTERACTIVE)
+    queued = max(0.0, time.time() - job.created - job.elapsed())
+    set_deadline(Deadline(budget_seconds - queued))
+    job.record_metric('budget_seconds', budget_seconds)
+    job.set_progress(f'Building {brand} campaign')
+    user_query = parse_user_input_for_gpt4(brand=brand, tags=tags)
+    hero = {} if insta and HERO_IMAGE else None
+    if insta and COMBINED_MODE:
+        _run_combined(job, brand, tags, user_query, creds, cities, location,
+                      hero)
+        _wait_for_hero_image(job, hero)
+        return
+
+    def on_text(text):
+        # The campaign shows up as it streams, and the hero image starts as
+        # soon as its description is complete
+        job.set_result('campaign', text)
+        _start_hero_image(job, text, hero, complete=False)
+
+    start = time.perf_counter()
+    campaign = _get_campaign(job, brand, tags, location, user_query, creds,
+                             on_text, use_cache=semantic_cache)
+    job.record_metric('campaign_seconds',
+                      round(time.perf_counter() - start, 3))
+    job.set_result('campaign', campaign)
+    # Cached and replayed campaigns do not stream
+    _start_hero_image(job, campaign, hero)
+
+    _run_event_stages(job, cities, location, campaign, creds,
+                      reserve=STAGE_ESTIMATES['insta'] if insta else 0)
+
+    if insta and not job.cancelled:
+        if stage_allowed('insta'):
+            _optional(job, 'Instagram posts', _run_insta, user_query,
+                      campaign, creds)
+        else:
+            _drop(job, 'Instagram posts')
+    _wait_for_hero_image(job, hero)
+
+
+def _get_campaign(job, brand, tags, location, user_query, creds,
+                  on_text=None, use_cache=True):
+    if replay_mode() != OFF:
+        # Recorded runs must make the same provider calls on replay
+        return get_gpt4_campaign_response(user_query,
+                                          gpt4_creds_dict=creds['api_key'],
+                                          run_metadata=job.metadata,
+                                          on_text=on_text)
+    cache = get_semantic_cache()
+    if use_cache:
+        campaign, similarity = cache.lookup(brand, tags, location)
+        job.metadata['semantic_cache'] = {'hit': campaign is not None,
+                                          'similarity': round(similarity, 3),
+                                          'threshold': cache.threshold}
+        if campaign is not None:
+            return campaign
+    else:
+        job.metadata['semantic_cache'] = {'hit': False, 'bypassed': True}
+    campaign = get_gpt4_campaign_response(user_query,
+                                          gpt4_creds_dict=creds['api_key'],
+                                          run_metadata=job.metadata,
+                                          on_text=on_text)
+    cache.add(brand, tags, campaign, location)
+    # Written in the background, batched with other runs' additions
+    cache.save_later()
+    return campaign
+
+
+def _drop(job, what):
+    job.record_degraded(f'{what} skipped to stay within the time budget')
+
+
+def _optional(job, what, stage, *args):
+    # A stage the campaign can do without: running out of time or a
+    # provider failing drops it instead of failing the whole run
+    try:
+        stage(job, *args)
+    except Exception as e:
+        if isinstance(e, DeadlineExceeded) or deadline_expired():
+            logger.warning('{} ran out of time: {!r}', what, e)
+            job.record_degraded(f'{what} cut short by the time budget')
+        else:
+            logger.opt(exception=e).warning('{} failed', what)
+            job.record_degraded(f'{what} left out after an error: {e!r}')
+
+
+def _run_event_stages(job, cities, location, campaign, creds, reserve=0):
+    if job.cancelled or not (cities or location):
+        return
+    if not stage_allowed('events', reserve):
+        _drop(job, 'Event recommendations')
+        return
+    if cities:
+        _optional(job, 'Event recommendations', _run_multi_city, cities,
+                  campaign, creds)
+    else:
+        _optional(job, 'Event recommendations', _run_events, location,
+                  campaign, creds, reserve)
+
+
+def _start_hero_image(job, campaign, hero, complete=True):
+    if hero is None or hero or job.cancelled:
+        return
+    description = find_principal_image(campaign, complete=complete)
+    if not description:
+        return
+    if not stage_allowed('hero_image'):
+        hero['future'] = None
+        _drop(job, 'Principal image')
+        return
+    logger.info('Starting hero image render')
+    job.set_result('hero_description', description)
+    hero['future'] = submit_in_context(_hero_executor, _render_hero_image,
+                                       job, description)
+
+
+def _render_hero_image(job, description):
+    prompt = add_details_for_stable(description)
+    if IMAGE_SERVICE == 'replicate':
+        image = get_stable_image(prompt, model='sdxl')
+    else:
+        image = get_segmind_image(prompt)
+    job.set_result('hero_image', image)
+    job.record_metric('hero_ready_seconds', round(job.elapsed(), 3))
+
+
+def _wait_for_hero_image(job, hero):
+    if not hero or hero['future'] is None:
+        return
+    try:
+        hero['future'].result(timeout=remaining_time())
+    except FutureTimeoutError:
+        hero['future'].cancel()
+        job.record_degraded('Principal image cut short by the time budget')
+    except DeadlineExceeded:
+        job.record_degraded('Principal image cut short by the time budget')
+    except Exception as e:
+        logger.warning('Hero image failed: {}', e)
+
+
+def _run_combined(job, brand, tags, user_query, creds, cities, location,
+                  hero):
+    # Campaign and posts land on the job while the response streams; events
+    # and images follow once the call is done.
+    start = time.perf_counter()
+
+    def on_campaign(campaign):
+        job.set_result('campaign', campaign)
+        job.set_progress('Gathering posts')
+        _start_hero_image(job, campaign, hero)
+
+    streamed = []
+
+    def on_post(post):
+        streamed.append(post.to_dict())
+        job.set_result('posts', list(streamed))
+
+    campaign, posts = get_gpt4_campaign_and_insta_response(
+        user_query, gpt4_creds_dict=creds['api_key'],
+        run_metadata=job.metadata, on_campaign=on_campaign, on_post=on_post)
+    job.record_metric('combined_seconds',
+                      round(time.perf_counter() - start, 3))
+    # Published again as replayed calls do not stream
+    job.set_result('campaign', campaign)
+    _start_hero_image(job, campaign, hero)
+    parsed_list = list(posts)
+    job.set_result('posts', parsed_list)
+    job.record_metric('posts_ready_seconds', round(job.elapsed(), 3))
+    if replay_mode() == OFF:
+        cache = get_semantic_cache()
+        cache.add(brand, tags, campaign, location)
+        # Written in the background, batched with other runs' additions
+        cache.save_later()
+
+    _run_event_stages(job, cities, location, campaign, creds)
+
+    if not job.cancelled:
+        _optional(job, 'Post images', _render_post_images, parsed_list)
+
+
+def _run_events(job, location, campaign, creds, reserve=0):
+    job.set_progress('Genie is finding event recommendations on Predict HQ')
+    cached_only = not stage_allowed('events_search', reserve
+                                    + STAGE_ESTIMATES['events'])
+    if cached_only:
+        _drop(job, 'A fresh PredictHQ search (cached events used)')
+    events_df = find_events_by_city(city_name=location,
+                                    cached_only=cached_only)
+    job.set_result('events_df', events_df)
+    if not len(events_df):
+        _drop(job, 'Event recommendations (no cached events)')
+        return
+    events_list = get_list_of_events_from_df(events_df)
+    if not stage_allowed('events_full_list', reserve):
+        events_list = events_list[:SHORT_EVENT_LIST]
+        job.record_degraded(f'Event list shortened to {SHORT_EVENT_LIST} '
+                            'events to stay within the time budget')
+    recommendation = get_event_recommendations(
+        city=location,
+        campaign=campaign,
+        events_list=','.join(events_list),
+        gpt4_creds_dict=creds,
+        run_metadata=job.metadata)
+    job.set_result('recommendation', _recommendation_text(recommendation))
+
+
+def _run_multi_city(job, cities, campaign, creds):
+    # The campaign is shared, each city only needs its own events and
+    # recommendation, so wall time follows the slowest city.
+    job.set_progress(f'Finding events in {len(cities)} cities')
+    city_dfs = {}
+    executor = ThreadPoolExecutor(max_workers=CITY_WORKERS,
+                                  thread_name_prefix='campaign-city')
+    futures = {submit_in_context(executor, _get_city_recommendation,
+                                 job, city, campaign, creds): city
+               for city in cities}
+    try:
+        for future in as_completed(futures, timeout=remaining_time()):
+            city = futures[future]
+            try:
+                events_df, recommendation = future.result()
+            except Exception as e:
+                logger.warning('Events for {} failed: {}', city, e)
+                job.set_item('city_results', city, {'error': repr(e)})
+                continue
+            city_dfs[city] = events_df
+            job.set_item('city_results', city,
+                         {'recommendation': recommendation})
+            job.set_result('cross_city_events',
+                           rank_events_across_cities(city_dfs))
+            job.set_progress(f'{len(city_dfs)} of {len(cities)} cities done')
+    except FutureTimeoutError:
+        late = [city for future, city in futures.items() if not future.done()]
+        _drop(job, f'Events for {", ".join(late)}')
+    finally:
+        # Late cities are not waited for, their calls end on their own
+        # timeouts
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_city_recommendation(job, city, campaign, creds):
+    if job.cancelled:
+        raise RuntimeError('Job cancelled')
+    events_df = find_events_by_city(city_name=city)
+    events_list = get_list_of_events_from_df(events_df)
+    recommendation = get_event_recommendations(
+        city=city,
+        campaign=campaign,
+        events_list=','.join(events_list),
+        gpt4_creds_dict=creds,
+        run_metadata=job.metadata)
+    return events_df, _recommendation_text(recommendation)
+
+
+def _run_insta(job, user_query, campaign, creds):
+    job.set_progress('Gathering posts')
+    start = time.perf_counter()
+    insta_posts = get_gpt4_insta_response(user_query, campaign,
+                                          creds['api_key'],
+                                          run_metadata=job.metadata)
+    job.record_metric('insta_seconds', round(time.perf_counter() - start, 3))
+    metrics = job.metadata['metrics']
+    if not job.metadata.get('semantic_cache', {}).get('hit'):
+        # Measured, to compare with combined_seconds of combined runs
+        job.record_metric('two_call_seconds', round(
+            metrics.get('campaign_seconds', 0) + metrics['insta_seconds'], 3))
+    parsed_list = parse_insta_posts(insta_posts)
+    job.set_result('posts', parsed_list)
+    job.record_metric('posts_ready_seconds', round(job.elapsed(), 3))
+    _optional(job, 'Post images', _render_post_images, parsed_list)
+
+
+def _render_post_images(job, parsed_list):
+    prompts = [add_details_for_stable(post['Image Description'])
+               for post in parsed_list]
+    if not stage_allowed('images'):
+        _drop(job, 'Post images')
+        return
+    postprocessing = []
+    if IMAGE_SERVICE == 'replicate':
+        _render_images_on_replicate(job, prompts, postprocessing)
+    elif PROGRESSIVE_IMAGES:
+        _render_images_progressively(job, prompts, postprocessing)
+    else:
+        _render_images(job, prompts, postprocessing)
+    # Formats are published as they finish, the job only ends with the last
+    _, late = wait(postprocessing, timeout=remaining_time())
+    if late:
+        _drop(job, f'{len(late)} Instagram format crops')
+
+
+def _render_images(job, prompts, postprocessing):
+    for i, prompt in enumerate(prompts):
+        if job.cancelled:
+            logger.info('Job cancelled, skipping remaining images')
+            return
+        if not stage_allowed('full_images'):
+            _drop(job, f'Images for posts {i+1} to {len(prompts)}')
+            return
+        job.set_progress(f'Collecting image {i+1} of {len(prompts)}')
+        image = get_segmind_image(prompt)
+        job.set_item('images', i, image)
+        job.set_item('image_passes', i, 'full')
+        _record_first_pixel(job)
+        _postprocess(job, i, image, postprocessing)
+
+
+def _postprocess(job, i, image, postprocessing):
+    if not POSTPROCESS_IMAGES:
+        return
+
+    def publish(future):
+        try:
+            job.set_item('image_formats', i, future.result())
+        except Exception as e:
+            logger.warning('Post-processing image {} failed: {}', i + 1, e)
+
+    future = submit_postprocess(image)
+    future.add_done_callback(publish)
+    postprocessing.append(future)
+
+
+def _render_images_progressively(job, prompts, postprocessing):
+    for i, prompt in enumerate(prompts):
+        if job.cancelled:
+            return
+        if not stage_allowed('images'):
+            _drop(job, f'Images for posts {i+1} to {len(prompts)}')
+            return
+        job.set_progress(f'Sketching image {i+1} of {len(prompts)}')
+        start = time.perf_counter()
+        job.set_item('images', i, get_segmind_preview_image(prompt))
+        job.set_item('image_passes', i, 'preview')
+        job.set_item('preview_seconds', i, time.perf_counter() - start)
+        _record_first_pixel(job)
+
+    # The final pass is the first thing dropped when the user moves on
+    for i, prompt in enumerate(prompts):
+        if job.cancelled:
+            logger.info('Job cancelled, skipping full quality renders')
+            return
+        if not stage_allowed('full_images'):
+            _drop(job, 'Full quality renders (previews kept)')
+            return
+        job.set_progress(f'Finishing image {i+1} of {len(prompts)}')
+        image = get_segmind_full_image(prompt)
+        job.set_item('images', i, image)
+        job.set_item('image_passes', i, 'full')
+        _postprocess(job, i, image, postprocessing)
+
+
+def _render_images_on_replicate(job, prompts, postprocessing):
+    # All predictions are in flight at once; a single tracker thread polls
+    # them and progress lands on the job through the callbacks.
+    tracker = get_prediction_tracker()
+    pending = {}
+    for i, prompt in enumerate(prompts):
+        def on_progress(percent, logs, i=i):
+            job.set_item('image_progress', i, {'progress': percent,
+                                               'logs': logs})
+        prediction_id = get_stable_image_async(prompt,
+                                               on_progress=on_progress)
+        pending[prediction_id] = (i, tracker.future(prediction_id))
+    job.set_progress(f'Rendering {len(prompts)} images on Replicate')
+
+    while pending:
+        if job.cancelled or deadline_expired():
+            for prediction_id in pending:
+                tracker.cancel(prediction_id)
+            if not job.cancelled:
+                _drop(job, f'{len(pending)} unfinished images')
+            return
+        futures = {f: p for p, (_, f) in pending.items()}
+        remaining = remaining_time()
+        done, _ = wait(futures, timeout=REPLICATE_WAIT_SECONDS
+                       if remaining is None
+                       else min(REPLICATE_WAIT_SECONDS, remaining))
+        for prediction_id in pending:
+            # Asking for the status keeps the prediction from being abandoned
+            tracker.status(prediction_id)
+        for future in done:
+            i, _ = pending.pop(futures[future])
+            try:
+                # Replicate returns a URL, the crops need the pixels
+                image = download_image(future.result()[0])
+            except Exception as e:
+                logger.warning('Image {} failed: {}', i + 1, e)
+                continue
+            job.set_item('images', i, image)
+            job.set_item('image_passes', i, 'full')
+            _record_first_pixel(job)
+            _postprocess(job, i, image, postprocessing)
+
+
+def _record_first_pixel(job):
+    if 'time_to_first_pixel' not in job.metadata['metrics']:
+        job.record_metric('time_to_first_pixel', round(job.elapsed(), 3))
+
+
+def _recommendation_text(recommendation):
+    # langchain runnables return a message, the older LLMChain a dict
+    if hasattr(recommendation, 'content'):
+        return recommendation.content
+    return recommendation['text']
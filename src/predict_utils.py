@@ -1,4 +1,6 @@
+import functools
 import os
+import numpy as np
 import pandas as pd
 from loguru import logger
 import datetime
@@ -12,8 +14,15 @@ from langchain_openai import ChatOpenAI
 import openai
 from predicthq import Client
 
+from src.cache_utils import EVENTS_TTL, LLM_TTL, RECORDS, shared
+from src.deadline_utils import call_timeout, run_with_deadline
+from src.endpoint_utils import get_endpoint_pool
 from src.gcp_utils import (get_secret_from_gcp,
                            TEAM_SECRETS_GCP_PROJECT_SECRET_ID)
+from src.geo_utils import EVENT_COLUMNS, get_event_index, resolve_city
+from src.replay_utils import OFF, recordable, replay_mode
+from src.routing_utils import call_with_routing
+from src.scheduler_utils import scheduled, set_provider_capacity
 import streamlit as st
 
 # TODO:
@@ -88,44 +97,120 @@ def _set_openai(openai_creds):
     openai.api_key = openai_creds
 
 
-def find_events_by_city(city_name, start_date=None, end_date=None):
+DEFAULT_RADIUS_KM = 25
+SEARCH_LIMIT = 500
+# Concurrent searches on the token, unless st.secrets.predict_hq sets
+# max_concurrency to what the account's rate limit allows. Below the
+# multi-city fan-out (pipeline_utils.CITY_WORKERS) cities queue for it.
+SEARCH_CONCURRENCY = 8
+
+
+@functools.lru_cache(maxsize=None)
+def _configure_search_capacity():
+    capacity = int(get_predict_creds().get('max_concurrency',
+                                           SEARCH_CONCURRENCY))
+    logger.info('PredictHQ searches: {} at a time', capacity)
+    set_provider_capacity('predicthq', capacity)
+
+
+def find_events_by_city(city_name, start_date=None, end_date=None,
+                        radius_km=DEFAULT_RADIUS_KM, cached_only=False):
     """Find events given a specific city.
 
+    The city is resolved to coordinates with the bundled gazetteer and events
+    are searched within radius_km of it. Searches are stored in the local
+    event index, so a query inside an area that was searched recently is
+    answered without calling PredictHQ. Unknown cities fall back to a free
+    text search. Recording and replaying cassettes bypass the index, so a
+    run makes the same calls whatever this machine has stored.
+
     Args:
         city_name (str): Name of city where campaign will take place
         start_date (str): Date of interest for events start (YYYY-MM-DD),
             defaults to today.
         end_date (str): Date of interest for events end (YYYY-MM-DD),
             defaults to a year from today.
+        radius_km (float): Search radius around the city centre.
+        cached_only (bool): Only return what the local index already has,
+            without calling PredictHQ.
 
     Returns:
         df: (DataFrame) Pandas DataFrame with list of 500 most relevant events
             for city in question.
 
     """
-    ACCESS_TOKEN = get_predict_creds()['token']
-    phq = Client(access_token=ACCESS_TOKEN)
-
     if start_date is None:
         start_date = datetime.date.today()
-    else:
-        start_date = start_date
 
     if end_date is None:
         end_date = _get_date_a_year_from_today()
 
+    coordinates = resolve_city(city_name)
+    if coordinates is None and cached_only:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    if coordinates is None:
+        logger.info('{} not in gazetteer, searching by text', city_name)
+        _configure_search_capacity()
+        city_df = pd.DataFrame(_search_events(active__gte=start_date,
+                                              active__lte=end_date,
+                                              q=city_name))
+        return _by_attendance(city_df)
+
+    latitude, longitude = coordinates
+    search = dict(active__gte=start_date, active__lte=end_date,
+                  within__radius=f'{radius_km}km',
+                  within__latitude=latitude, within__longitude=longitude,
+                  sort='-phq_attendance')
+    if replay_mode() != OFF:
+        if cached_only:
+            return pd.DataFrame(columns=EVENT_COLUMNS)
+        return _by_attendance(pd.DataFrame(_search_events(**search)))
+
+    index = get_event_index()
+    if cached_only:
+        logger.info('Serving cached events only for {}', city_name)
+    elif not index.covers(latitude, longitude, radius_km, start_date,
+                          end_date):
+        logger.info('getting events from PredictHq within {}km of {}',
+                    radius_km, city_name)
+        _configure_search_capacity()
+        events = _search_events(**search)
+        if len(events) >= SEARCH_LIMIT:
+            logger.info('Search around {} hit the {} event limit, not '
+                        'recording it as covered', city_name, SEARCH_LIMIT)
+        index.add_events(pd.DataFrame(events), latitude, longitude,
+                         radius_km, start_date, end_date,
+                         complete=len(events) < SEARCH_LIMIT)
+        index.save()
     else:
-        end_date = end_date
-    city = []
-    logger.info(f'getting events from PredictHq for {city_name}')
-    for event in phq.events.search(active__gte=start_date,
-                                   active__lte=end_date,
-                                   q=city_name,
-                                   limit=500):
-        city.append(event.to_dict())
+        logger.info('Serving events for {} from the local index',
+                    city_name)
+
+    city_df = index.query(latitude, longitude, radius_km, start_date,
+                          end_date)
+    return _by_attendance(city_df)
+
+
+def _by_attendance(events_df):
+    # An empty search gives a frame without any columns
+    if 'phq_attendance' not in events_df.columns:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    return events_df.sort_values(by='phq_attendance', ascending=False)
+
 
-    city_df = pd.DataFrame(city)
-    return city_df.sort_values(by='phq_attendance', ascending=False)
+@recordable('predicthq.search')
+@shared('predicthq.search', codec=RECORDS, ttl=EVENTS_TTL)
+@scheduled('predicthq')
+def _search_events(**params):
+    ACCESS_TOKEN = get_predict_creds()['token']
+    phq = Client(access_token=ACCESS_TOKEN)
+
+    def search():
+        return [event.to_dict()
+                for event in phq.events.search(limit=SEARCH_LIMIT, **params)]
+
+    # The SDK takes no timeout
+    return run_with_deadline(search)
 
 
 def get_list_of_events_from_df(df):
@@ -142,6 +227,31 @@ def get_list_of_events_from_df(df):
     return event_list
 
 
+def rank_events_across_cities(city_dfs):
+    """Merge per-city event tables into one ranking. Attendance is log scaled
+    so one stadium event does not swamp every other city.
+
+    Args:
+        city_dfs (dict): city name to DataFrame from find_events_by_city.
+
+    Returns:
+        DataFrame: all events with 'city', 'score' and 'city_rank' columns,
+            best first.
+    """
+    frames = [df.assign(city=city) for city, df in city_dfs.items()
+              if len(df)]
+    if not frames:
+        return pd.DataFrame(columns=['city', 'score', 'city_rank'])
+    merged = pd.concat(frames, ignore_index=True)
+    attendance = np.log1p(
+        merged['phq_attendance'].fillna(0).to_numpy(dtype=float))
+    top = attendance.max()
+    merged['score'] = attendance / top if top > 0 else attendance
+    merged['city_rank'] = merged.groupby('city')['score'].rank(
+        ascending=False, method='first').astype(int)
+    return merged.sort_values(by='score', ascending=False)
+
+
 # Define Events prompt and chain
 def get_event_recommendations_azure(city, campaign, events_list, gpt4_creds_dict):
     _set_openai_to_azure(gpt4_creds_dict)
@@ -157,7 +267,7 @@ def get_event_recommendations_azure(city, campaign, events_list, gpt4_creds_dict
     prompt_events = PromptTemplate(
                         template=template_events,
                         input_variables=['city', 'campaign', 'events_list'])
-    events_chain = LLMChain(llm=chat, prompt=prompt_events, verbose=True)
+    events_chain = LLMChain(llm=chat, prompt=prompt_events, verbose=False)
 
     dict = events_chain({'city': city,
                          'campaign': campaign,
@@ -166,9 +276,12 @@ def get_event_recommendations_azure(city, campaign, events_list, gpt4_creds_dict
     return dict
 
 
-def get_event_recommendations(city, campaign, events_list, gpt4_creds_dict):
-    _set_openai(gpt4_creds_dict)
-    chat = set_chat(gpt4_creds_dict)
+@recordable('openai.events')
+@shared('openai.events', ttl=LLM_TTL)
+@scheduled('openai')
+def get_event_recommendations(city, campaign, events_list, gpt4_creds_dict,
+                              model=None, run_metadata=None):
+    pool = get_endpoint_pool(gpt4_creds_dict)
     template_events = """
     You are an expert brand manager. Given a campaign, a city, and a list of events in that city, choose which events would be most appropriate for a partnership?
     Provide as much reasoning as you can, in terms of brand attribute fit.
@@ -180,13 +293,21 @@ def get_event_recommendations(city, campaign, events_list, gpt4_creds_dict):
     prompt_events = PromptTemplate(
                         template=template_events,
                         input_variables=['city', 'campaign', 'events_list'])
-    model = chat
-    chain = prompt_events | model
     dict_chain = {'city': city, 'campaign': campaign,
                   'events_list': events_list}
-    response = chain.invoke(dict_chain)
 
-    return response
+    def _invoke(model):
+        def _on_endpoint(endpoint, deployment):
+            chain = prompt_events | endpoint.chat_model(
+                model, temperature=0.8, timeout=call_timeout())
+            return chain.invoke(dict_chain)
+        return pool.run(model, _on_endpoint)
+
+    response = call_with_routing('events', _invoke, model=model,
+                                 run_metadata=run_metadata)
+
+    # Same shape as the LLMChain output, and plain enough to share
+    return {'text': response.content}
 
 
 def set_chat_azure(deployment_name='GPT-4'):
@@ -208,10 +329,10 @@ def set_chat_azure(deployment_name='GPT-4'):
     return chat
 
 
-def set_chat(creds_dict):
+def set_chat(creds_dict, model='gpt-4'):
     os.environ["OPENAI_API_KEY"] = creds_dict['api_key']
     chat = ChatOpenAI(
-        model='gpt-4',
+        model=model,
         temperature=0.8
     )
     return chat
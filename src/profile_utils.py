@@ -0,0 +1,231 @@
+import contextlib
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger
+
+
+# Profile every run, not only those asked for with ?admin=1&profile=1
+PROFILE_ALL_RUNS = os.environ.get('CAMPAIGN_POC_PROFILE', '') == '1'
+# When set, the URL has to carry profile=<token> rather than profile=1
+PROFILE_TOKEN = os.environ.get('CAMPAIGN_POC_PROFILE_TOKEN', '')
+PROFILE_DIR = Path(os.environ.get(
+    'CAMPAIGN_POC_PROFILE_DIR',
+    Path(__file__).parent.parent / '.cache' / 'profiles'))
+SAMPLE_INTERVAL_SECONDS = 0.005
+# Helper threads sampled along with the job's own thread. These pools are
+# shared, so a concurrent run's work can show up in the stacks too.
+HELPER_THREAD_PREFIXES = ('campaign-city', 'campaign-hero',
+                          'campaign-deadline')
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+# Frames kept per allocation. One (the allocating line) already slows
+# allocation-heavy code ~10x; ten make it ~25x.
+TRACEMALLOC_FRAMES = int(os.environ.get('CAMPAIGN_POC_PROFILE_FRAMES', 1))
+
+# Files a profile directory holds, with the mime type to download them as
+PROFILE_FILES = {
+    'stacks.folded': 'text/plain',
+    'functions.txt': 'text/plain',
+    'allocations.txt': 'text/plain',
+    'cprofile.pstats': 'application/octet-stream',
+    'summary.json': 'application/json',
+}
+
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+
+class StackSampler:
+    """Samples the stacks of the profiled threads from a background thread
+    and counts them in folded form ("a;b;c count"), the input of
+    flamegraph.pl, inferno and speedscope. Unlike cProfile it sees the
+    helper threads a run fans out to.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_forever,
+                                        name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _profiled_threads(self):
+        ids = {self.thread_id}
+        for thread in threading.enumerate():
+            if thread.name.startswith(HELPER_THREAD_PREFIXES):
+                ids.add(thread.ident)
+        return ids
+
+    def _sample_forever(self):
+        while not self._stop.wait(self.interval):
+            profiled = self._profiled_threads()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in profiled:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f'{code.co_name} '
+                                 f'({Path(code.co_filename).name}:'
+                                 f'{frame.f_lineno})')
+                    frame = frame.f_back
+                # Pool threads with no work (blocked in the C queue get);
+                # waits inside a run are kept, they are where time goes
+                if names and names[0].startswith('_worker (thread.py'):
+                    continue
+                self.stacks[';'.join(reversed(names))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return '\n'.join(f'{stack} {count}'
+                         for stack, count in self.stacks.most_common())
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    return snapshot, peak
+
+
+def profiling_allowed(query_params, token=None):
+    """Whether a page's query params ask for a profiled run. Profiling slows
+    the run down, so it takes admin=1 as well as profile=1, or
+    profile=<PROFILE_TOKEN> when a token is configured.
+
+    Args:
+        query_params (dict): Name to list of values, as Streamlit gives them.
+        token (str, optional): Defaults to PROFILE_TOKEN.
+    """
+    token = PROFILE_TOKEN if token is None else token
+    if query_params.get('admin') != ['1']:
+        return False
+    given = query_params.get('profile', [''])[0]
+    return hmac.compare_digest(given.encode('utf-8'),
+                               (token or '1').encode('utf-8'))
+
+
+@contextlib.contextmanager
+def profile_run(run_id, directory=PROFILE_DIR):
+    """Profile the code run inside the block and save the results to a
+    timestamped directory: cProfile stats of the calling thread, folded
+    stacks sampled from it and its helper threads, and the top allocations
+    traced by tracemalloc (across the process).
+
+    Args:
+        run_id (str): Added to the directory name.
+        directory (Path, optional): Parent of the profile directories.
+
+    Yields:
+        dict: filled in on exit with 'directory' and 'summary'
+    """
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    output = Path(directory) / f'{stamp}-{run_id}'
+    result = {}
+    sampler = StackSampler(threading.get_ident())
+    profiler = cProfile.Profile()
+    _start_tracemalloc()
+    sampler.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - start
+        sampler.stop()
+        snapshot, peak = _stop_tracemalloc()
+        result['directory'] = str(output)
+        result['summary'] = _save(output, profiler, sampler, snapshot, peak,
+                                  wall)
+        logger.info('Saved profile to {}', output)
+
+
+def _save(output, profiler, sampler, snapshot, peak, wall):
+    output.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(output / 'cprofile.pstats')
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative') \
+        .print_stats(TOP_FUNCTIONS)
+    (output / 'functions.txt').write_text(text.getvalue())
+
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__)))
+    allocations = snapshot.statistics('traceback')[:TOP_ALLOCATIONS]
+    lines = [f'Peak traced memory: {peak / 1024 ** 2:.1f} MB', '']
+    for stat in allocations:
+        lines.append(f'{stat.size / 1024:.1f} KB in {stat.count} blocks')
+        lines += [f'    {line}' for line in stat.traceback.format()]
+    (output / 'allocations.txt').write_text('\n'.join(lines))
+
+    (output / 'stacks.folded').write_text(sampler.folded())
+    summary = {'wall_seconds': round(wall, 3),
+               'samples': sampler.samples,
+               'sample_interval_seconds': sampler.interval,
+               'peak_traced_mb': round(peak / 1024 ** 2, 1),
+               'top_allocations_kb': [round(s.size / 1024, 1)
+                                      for s in allocations[:5]]}
+    (output / 'summary.json').write_text(json.dumps(summary, indent=2))
+    return summary
+
+
+def read_profile_files(directory):
+    """Contents of a saved profile, for download buttons
+
+    Returns:
+        dict: file name to (bytes, mime type), for the files that exist
+    """
+    directory = Path(directory)
+    return {name: ((directory / name).read_bytes(), mime)
+            for name, mime in PROFILE_FILES.items()
+            if (directory / name).exists()}
+
+
+if __name__ == '__main__':
+    # Profile a replayed run, e.g.
+    # CAMPAIGN_POC_REPLAY=replay python -m src.profile_utils Nike running Paris
+    from src.job_utils import Job, make_job_key
+    from src.pipeline_utils import run_campaign_pipeline
+
+    brand, tags, location = (sys.argv[1:] + ['', '', ''])[:3]
+    inputs = {'brand': brand, 'tags': tags, 'insta': True,
+              'location': location, 'cities': []}
+    job = Job(make_job_key(**inputs), inputs)
+    with profile_run(job.metadata['run_id']) as profile:
+        run_campaign_pipeline(job, brand=brand, tags=tags, insta=True,
+                              location=location, creds={'api_key': 'replay'})
+    print(json.dumps(profile, indent=2))
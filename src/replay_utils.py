@@ -0,0 +1,245 @@
+import datetime
+import functools
+import hashlib
+import inspect
+import io
+import json
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from loguru import logger
+
+
+OFF = 'off'
+RECORD = 'record'
+REPLAY = 'replay'
+
+REPLAY_MODE = os.environ.get('CAMPAIGN_POC_REPLAY', OFF)
+CASSETTE_PATH = Path(os.environ.get(
+    'CAMPAIGN_POC_CASSETTE',
+    Path(__file__).parent.parent / '.cache' / 'cassettes' / 'default.cassette'))
+# Fraction of the recorded duration to sleep on replay, 0 replays instantly
+REPLAY_LATENCY_FACTOR = float(os.environ.get('CAMPAIGN_POC_REPLAY_LATENCY',
+                                             0))
+# Arguments that never take part in matching a call (secrets, callbacks,
+# per-run bookkeeping)
+IGNORED_ARGS = ('gpt4_creds_dict', 'api_key', 'creds', 'run_metadata',
+                'on_progress', 'on_text', 'on_campaign', 'on_post',
+                'timeout')
+
+
+# Start of a cassette made of appended records; older cassettes are a
+# single pickle of every call
+CASSETTE_HEADER = b'campaign-cassette-v2\n'
+
+
+class ReplayMissError(LookupError):
+    """Raised in replay mode when the cassette has no matching call"""
+
+
+class Cassette:
+    """Recorded provider calls in one file of appended records, each a
+    length-prefixed zlib-compressed pickle of (key, duration, response).
+    Each call key holds the list of responses in the order they were
+    recorded.
+    """
+
+    def __init__(self, path=CASSETTE_PATH):
+        self.path = Path(path)
+        self._calls = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        # Rewritten in the current format on the first recording
+        self._legacy = False
+        if self.path.exists():
+            self._load()
+
+    def __len__(self):
+        return sum(len(responses) for responses in self._calls.values())
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(CASSETTE_HEADER):
+            self._calls = pickle.loads(zlib.decompress(data))
+            self._legacy = True
+            return
+        offset = len(CASSETTE_HEADER)
+        while offset + 4 <= len(data):
+            (length,) = struct.unpack('>I', data[offset:offset + 4])
+            frame = data[offset + 4:offset + 4 + length]
+            if len(frame) < length:
+                logger.warning('Ignoring a torn last record in {}', self.path)
+                break
+            key, duration, payload = pickle.loads(zlib.decompress(frame))
+            self._calls.setdefault(key, []).append((duration, payload))
+            offset += 4 + length
+
+    def record(self, key, duration, response):
+        entry = (duration, _encode(response))
+        with self._lock:
+            self._calls.setdefault(key, []).append(entry)
+            if self._legacy or not self.path.exists():
+                self._save()
+                self._legacy = False
+            else:
+                with open(self.path, 'ab') as f:
+                    f.write(_frame(key, *entry))
+
+    def play(self, key):
+        """Return (duration, response) for the next recording of a call. A
+        call made more often than recorded gets the last response again.
+        """
+        with self._lock:
+            responses = self._calls.get(key)
+            if not responses:
+                raise ReplayMissError(
+                    f'No recording for {key} in {self.path}')
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            duration, payload = responses[min(position, len(responses) - 1)]
+        return duration, _decode(payload)
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(CASSETTE_HEADER)
+            for key, responses in self._calls.items():
+                for duration, payload in responses:
+                    f.write(_frame(key, duration, payload))
+        os.replace(tmp_path, self.path)
+
+
+def _frame(key, duration, payload):
+    body = zlib.compress(pickle.dumps((key, duration, payload),
+                                      pickle.HIGHEST_PROTOCOL))
+    return struct.pack('>I', len(body)) + body
+
+
+def _encode(response):
+    # Images are stored as PNG bytes rather than raw pixel buffers
+    if type(response).__module__.startswith('PIL.'):
+        buffer = io.BytesIO()
+        response.save(buffer, format='PNG')
+        return ('png', buffer.getvalue())
+    return ('pickle', response)
+
+
+def _decode(payload):
+    kind, value = payload
+    if kind == 'png':
+        from PIL import Image
+        return Image.open(io.BytesIO(value))
+    return value
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    global _cassette
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette()
+        return _cassette
+
+
+def replay_mode():
+    return REPLAY_MODE
+
+
+def _today():
+    return datetime.date.today()
+
+
+def _relative_dates(value, today):
+    # Dates become offsets from today, so a call made with 'today' and
+    # 'a year from today' matches its recording on any later day
+    if isinstance(value, datetime.date):
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        return f'today{(value - today).days:+d}d'
+    if isinstance(value, dict):
+        return {k: _relative_dates(v, today) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_relative_dates(v, today) for v in value]
+    return value
+
+
+def call_key(name, signature, args, kwargs, ignore=IGNORED_ARGS,
+             relative_dates=False):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = {k: v for k, v in bound.arguments.items() if k not in ignore}
+    if relative_dates:
+        arguments = _relative_dates(arguments, _today())
+    payload = json.dumps(arguments, sort_keys=True, default=str)
+    digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+    return f'{name}:{digest}'
+
+
+def recordable(name, ignore=IGNORED_ARGS):
+    """Decorate a provider call so it is written to the cassette in record
+    mode and served from it, without network, in replay mode.
+
+    Date arguments are matched relative to the day the call is made, so
+    cassettes keep replaying on later days.
+
+    Args:
+        name (str): Stable name of the provider call, e.g. 'openai.campaign'.
+        ignore (tuple, optional): Argument names left out of the call key.
+
+    Returns:
+        callable: decorator
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            mode = replay_mode()
+            if mode == OFF:
+                return fn(*args, **kwargs)
+            key = call_key(name, signature, args, kwargs, ignore,
+                           relative_dates=True)
+            if mode == REPLAY:
+                duration, response = get_cassette().play(key)
+                if REPLAY_LATENCY_FACTOR:
+                    time.sleep(duration * REPLAY_LATENCY_FACTOR)
+                logger.debug('Replayed {}', key)
+                return response
+            start = time.perf_counter()
+            response = fn(*args, **kwargs)
+            get_cassette().record(key, time.perf_counter() - start, response)
+            logger.debug('Recorded {}', key)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == '__main__':
+    # Time a full pipeline run served from the cassette, e.g.
+    # CAMPAIGN_POC_REPLAY=replay python -m src.replay_utils Nike "running" Paris
+    import sys
+
+    from src.job_utils import Job, make_job_key
+    from src.pipeline_utils import run_campaign_pipeline
+
+    brand, tags, location = (sys.argv[1:] + ['', '', ''])[:3]
+    inputs = {'brand': brand, 'tags': tags, 'insta': True,
+              'location': location, 'cities': []}
+    job = Job(make_job_key(**inputs), inputs)
+    start = time.perf_counter()
+    run_campaign_pipeline(job, brand=brand, tags=tags, insta=True,
+                          location=location, creds={'api_key': REPLAY})
+    print(f'{replay_mode()} run took {time.perf_counter() - start:.3f} s, '
+          f'{len(job.results.get("images", {}))} images')
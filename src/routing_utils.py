@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+from src.deadline_utils import DeadlineExceeded, check_deadline
+
+
+# Models the router can pick from. 'quality' is a rough rank (higher is
+# better); the dict order is the preference order between equal models.
+# 'json_mode' marks models accepting response_format={'type': 'json_object'}.
+MODELS = {
+    'gpt-4': {'quality': 3},
+    'gpt-4-turbo-preview': {'quality': 3, 'json_mode': True},
+    'gpt-3.5-turbo': {'quality': 2, 'json_mode': True},
+}
+
+# What each pipeline stage needs. 'max_p95_latency' is in seconds, None means
+# the stage only cares about quality.
+STAGE_TARGETS = {
+    'campaign': {'min_quality': 3, 'max_p95_latency': None},
+    'insta': {'min_quality': 2, 'max_p95_latency': 20},
+    'events': {'min_quality': 2, 'max_p95_latency': 15},
+    'combined': {'min_quality': 3, 'max_p95_latency': None},
+}
+
+WINDOW_SIZE = 50
+WINDOW_SECONDS = 600
+MIN_SAMPLES = 3
+MAX_ERROR_RATE = 0.5
+MAX_CONSECUTIVE_FAILURES = 3
+COOLDOWN_SECONDS = 60
+
+
+class ModelStats:
+    """Rolling latency and error window for a single model, safe to record
+    into and read from different threads
+    """
+
+    def __init__(self, window_size=WINDOW_SIZE):
+        self.calls = deque(maxlen=window_size)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        now = time.monotonic()
+        with self._lock:
+            self.calls.append((now, latency, ok))
+            if ok:
+                self.consecutive_failures = 0
+            else:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                    self.cooldown_until = now + COOLDOWN_SECONDS
+
+    def _recent(self):
+        cutoff = time.monotonic() - WINDOW_SECONDS
+        # Copied under the lock, a concurrent append would otherwise break
+        # the iteration
+        with self._lock:
+            calls = list(self.calls)
+        return [c for c in calls if c[0] >= cutoff]
+
+    def p95(self):
+        latencies = sorted(c[1] for c in self._recent() if c[2])
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1,
+                             int(0.95 * len(latencies)))]
+
+    def error_rate(self):
+        recent = self._recent()
+        if len(recent) < MIN_SAMPLES:
+            return 0.0
+        return sum(1 for c in recent if not c[2]) / len(recent)
+
+    def is_degraded(self):
+        return (time.monotonic() < self.cooldown_until
+                or self.error_rate() > MAX_ERROR_RATE)
+
+
+class ModelRouter:
+    """Pick a model per pipeline stage from live latency and error stats"""
+
+    def __init__(self, models=None, stage_targets=None):
+        self.models = MODELS if models is None else models
+        self.stage_targets = (STAGE_TARGETS if stage_targets is None
+                              else stage_targets)
+        self._stats = {name: ModelStats() for name in self.models}
+        self._lock = threading.Lock()
+
+    def stats(self, model):
+        with self._lock:
+            return self._stats.setdefault(model, ModelStats())
+
+    def record(self, model, latency, ok):
+        self.stats(model).record(latency, ok)
+
+    def rank(self, stage):
+        """Return the models for a stage, best candidate first, each with the
+        reason it was ranked there.
+
+        Args:
+            stage (str): Key of STAGE_TARGETS, e.g. 'campaign'.
+
+        Returns:
+            list: list of (model, reason) tuples
+        """
+        target = self.stage_targets.get(stage, {})
+        min_quality = target.get('min_quality', 0)
+        max_p95 = target.get('max_p95_latency')
+
+        healthy, degraded = [], []
+        for order, (name, info) in enumerate(self.models.items()):
+            if info['quality'] < min_quality:
+                continue
+            stats = self.stats(name)
+            p95 = stats.p95()
+            # Unknown latency counts as meeting the target so new models get
+            # tried at least once.
+            meets_latency = max_p95 is None or p95 is None or p95 <= max_p95
+            sort_key = (not meets_latency, -info['quality'],
+                        float('inf') if p95 is None else p95, order)
+            entry = (sort_key, name, meets_latency)
+            (degraded if stats.is_degraded() else healthy).append(entry)
+
+        ranked = [(name, 'meets target' if meets else 'fastest available')
+                  for _, name, meets in sorted(healthy)]
+        # Degraded models are kept as a last resort, least failing first.
+        degraded.sort(key=lambda e: (self.stats(e[1]).error_rate(), e[0]))
+        ranked += [(name, 'fallback (degraded)') for _, name, _ in degraded]
+        return ranked
+
+    def describe(self, model):
+        stats = self.stats(model)
+        return {'p95': stats.p95(), 'error_rate': stats.error_rate()}
+
+
+_router = ModelRouter()
+
+
+def get_router():
+    """Return the process-wide router, so stats are shared across sessions"""
+    return _router
+
+
+def call_with_routing(stage, call, model=None, run_metadata=None,
+                      router=None):
+    """Run an LLM call on the best model for a stage, falling back to the next
+    candidate when a call fails.
+
+    Args:
+        stage (str): Pipeline stage, key of STAGE_TARGETS.
+        call (callable): Takes the model name and returns the response.
+        model (str, optional): Force a single model instead of routing.
+            Defaults to None.
+        run_metadata (dict, optional): Routing decisions are appended to its
+            'routing' list. Defaults to None.
+        router (ModelRouter, optional): Defaults to the process-wide router.
+
+    Returns:
+        Whatever call returns.
+    """
+    router = get_router() if router is None else router
+    candidates = ([(model, 'forced')] if model is not None
+                  else router.rank(stage))
+    if not candidates:
+        raise ValueError(f'No model configured for stage {stage}')
+
+    last_error = None
+    for attempt, (name, reason) in enumerate(candidates, start=1):
+        # No point falling back to another model once the budget is spent
+        check_deadline()
+        decision = {'stage': stage, 'model': name, 'reason': reason,
+                    'attempt': attempt, **router.describe(name)}
+        logger.info('Routing {} to {} ({})', stage, name, reason)
+        start = time.perf_counter()
+        try:
+            result = call(name)
+        except Exception as e:
+            latency = time.perf_counter() - start
+            router.record(name, latency, ok=False)
+            logger.warning('{} failed for {}: {}', name, stage, e)
+            _append_decision(run_metadata, decision, latency, ok=False,
+                             error=repr(e))
+            if isinstance(e, DeadlineExceeded):
+                raise
+            last_error = e
+            continue
+        latency = time.perf_counter() - start
+        router.record(name, latency, ok=True)
+        _append_decision(run_metadata, decision, latency, ok=True)
+        return result
+
+    raise last_error
+
+
+def _append_decision(run_metadata, decision, latency, ok, error=None):
+    if run_metadata is None:
+        return
+    decision = {**decision, 'latency': round(latency, 3), 'ok': ok}
+    if error is not None:
+        decision['error'] = error
+    run_metadata.setdefault('routing', []).append(decision)
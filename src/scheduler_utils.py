@@ -0,0 +1,284 @@
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+from src.deadline_utils import (DeadlineExceeded, abandoned_calls,
+                                 call_timeout, check_abandoned,
+                                 holding_slot)
+
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+# Concurrent calls allowed per shared API key
+PROVIDER_CAPACITY = {
+    'openai': 4,
+    'segmind': 4,
+    'replicate': 4,
+    # As many as the multi-city fan-out runs at once (CITY_WORKERS), see
+    # predict_utils.SEARCH_CONCURRENCY
+    'predicthq': 8,
+}
+# Share of capacity a session gets relative to others, by priority
+PRIORITY_WEIGHTS = {INTERACTIVE: 4.0, BATCH: 1.0}
+WAIT_WINDOW = 200
+# Sessions' finish tags are pruned once there are this many, at the least
+PRUNE_SESSIONS = 64
+
+_request_context = contextvars.ContextVar(
+    'request_context', default=(None, INTERACTIVE))
+
+
+def set_request_context(session_id, priority=INTERACTIVE):
+    """Tag provider calls made from this context with a session and priority.
+
+    Pool threads inherit it when started through job_utils.submit_in_context.
+    """
+    _request_context.set((session_id, priority))
+
+
+def get_request_context():
+    return _request_context.get()
+
+
+class _Waiter:
+    def __init__(self, session_id, priority):
+        self.session_id = session_id
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()
+        self.abandoned = False
+
+
+class FairScheduler:
+    """Weighted fair queueing in front of one provider.
+
+    Each session gets virtual finish tags advancing by cost / weight per
+    call, and free slots go to the smallest tag. A session firing many calls
+    pushes its own tags ahead and waits behind sessions that called less,
+    and interactive calls advance four times slower than batch ones.
+    """
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self._in_use = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._prune_at = PRUNE_SESSIONS
+        self._queue = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._waits = {INTERACTIVE: deque(maxlen=WAIT_WINDOW),
+                       BATCH: deque(maxlen=WAIT_WINDOW)}
+
+    def acquire(self, session_id, priority=INTERACTIVE, cost=1.0,
+                timeout=None):
+        """Wait for a slot
+
+        Raises:
+            DeadlineExceeded: if no slot was free within timeout
+        """
+        waiter = _Waiter(session_id, priority)
+        with self._lock:
+            weight = PRIORITY_WEIGHTS.get(priority, 1.0)
+            start = max(self._virtual_time,
+                        self._last_finish.get(session_id, 0.0))
+            finish = start + cost / weight
+            self._last_finish[session_id] = finish
+            if self._in_use < self.capacity and not self._queue:
+                self._grant(waiter, finish)
+            else:
+                heapq.heappush(self._queue,
+                               (finish, next(self._sequence), waiter))
+        if waiter.event.wait(timeout):
+            return
+        with self._lock:
+            # Granted between the timeout and taking the lock
+            if waiter.event.is_set():
+                return
+            waiter.abandoned = True
+        raise DeadlineExceeded(
+            f'No {self.name} slot within {timeout:.1f}s')
+
+    def release(self):
+        with self._lock:
+            self._in_use -= 1
+            self._grant_queued()
+
+    def set_capacity(self, capacity):
+        with self._lock:
+            self.capacity = capacity
+            self._grant_queued()
+
+    def _grant_queued(self):
+        # The caller holds the lock
+        while self._queue and self._in_use < self.capacity:
+            finish, _, waiter = heapq.heappop(self._queue)
+            if not waiter.abandoned:
+                self._grant(waiter, finish)
+
+    def _grant(self, waiter, finish):
+        # The caller holds the lock
+        self._in_use += 1
+        self._virtual_time = max(self._virtual_time, finish)
+        if len(self._last_finish) >= self._prune_at:
+            self._prune_sessions()
+        self._waits.setdefault(waiter.priority, deque(maxlen=WAIT_WINDOW)) \
+            .append(time.monotonic() - waiter.enqueued)
+        waiter.event.set()
+
+    def _prune_sessions(self):
+        # The caller holds the lock. A tag the virtual time has passed
+        # belongs to a session with nothing queued, and acquire() starts
+        # from the virtual time anyway, so dropping it changes no ordering.
+        self._last_finish = {s: f for s, f in self._last_finish.items()
+                             if f > self._virtual_time}
+        # Amortised: the next prune waits until the dict has doubled
+        self._prune_at = max(PRUNE_SESSIONS, 2 * len(self._last_finish))
+
+    @contextlib.contextmanager
+    def slot(self, session_id=None, priority=None, cost=1.0):
+        context_session, context_priority = get_request_context()
+        session_id = context_session if session_id is None else session_id
+        priority = context_priority if priority is None else priority
+        # A provider stuck on calls left past their deadline fails fast
+        # rather than making every caller wait for a slot
+        check_abandoned(self.name)
+        start = time.monotonic()
+        # Waiting in line counts against the run's deadline
+        self.acquire(session_id, priority, cost, timeout=call_timeout())
+        waited = time.monotonic() - start
+        if waited > 1:
+            logger.info('Waited {:.1f}s for a {} slot ({})', waited,
+                        self.name, priority)
+        with holding_slot(self.name) as hold:
+            try:
+                yield waited
+            finally:
+                self._release_when_done(hold.futures)
+
+    def _release_when_done(self, futures):
+        # Calls given up on, or started without waiting, are still in
+        # flight at the provider, the slot is theirs until they end
+        pending = [f for f in futures if not f.done()]
+        if not pending:
+            self.release()
+            return
+        logger.info('Keeping a {} slot until {} unfinished calls end',
+                    self.name, len(pending))
+        remaining = [len(pending)]
+        lock = threading.Lock()
+
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.release()
+
+        for future in pending:
+            future.add_done_callback(finished)
+
+    def stats(self):
+        with self._lock:
+            depth = {}
+            for _, _, waiter in self._queue:
+                if waiter.abandoned:
+                    continue
+                depth[waiter.priority] = depth.get(waiter.priority, 0) + 1
+            waits = {p: sorted(w) for p, w in self._waits.items()}
+            in_use = self._in_use
+        return {'capacity': self.capacity,
+                'in_use': in_use,
+                'abandoned': abandoned_calls(self.name),
+                'queue_depth': depth,
+                'p95_wait_seconds': {p: _p95(w) for p, w in waits.items()}}
+
+
+def _p95(values):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(0.95 * len(values)))], 3)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(provider):
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            _schedulers[provider] = FairScheduler(
+                provider, PROVIDER_CAPACITY.get(provider, 4))
+        return _schedulers[provider]
+
+
+def set_provider_capacity(provider, capacity):
+    """Change how many concurrent calls a provider takes, e.g. once the
+    number of configured endpoints is known"""
+    PROVIDER_CAPACITY[provider] = capacity
+    with _schedulers_lock:
+        scheduler = _schedulers.get(provider)
+    if scheduler is not None:
+        scheduler.set_capacity(capacity)
+
+
+def scheduler_stats():
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {s.name: s.stats() for s in schedulers}
+
+
+def scheduled(provider):
+    """Decorate a provider call so it waits for a fair-share slot on the
+    provider's scheduler
+
+    Args:
+        provider (str): Key of PROVIDER_CAPACITY.
+
+    Returns:
+        callable: decorator
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_scheduler(provider).slot():
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == '__main__':
+    # One heavy session floods openai while light sessions click now and
+    # then; the light sessions' p95 wait should stay near zero.
+    from concurrent.futures import ThreadPoolExecutor
+
+    from src.job_utils import submit_in_context
+
+    @scheduled('openai')
+    def fake_call():
+        time.sleep(0.05)
+
+    def session(session_id, priority, calls, pause):
+        set_request_context(session_id, priority)
+        for _ in range(calls):
+            fake_call()
+            time.sleep(pause)
+
+    with ThreadPoolExecutor(max_workers=24) as executor:
+        for n in range(16):
+            submit_in_context(executor, session, 'heavy', BATCH, 20, 0)
+        for n in range(4):
+            submit_in_context(executor, session, f'light{n}', INTERACTIVE,
+                              5, 0.2)
+    print(scheduler_stats())
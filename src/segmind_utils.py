@@ -1,7 +1,15 @@
+from io import BytesIO
+
 import requests
 import streamlit as st
+from PIL import Image
 from segmind import SDXL
 
+from src.cache_utils import IMAGE, IMAGE_TTL, shared
+from src.deadline_utils import call_timeout, run_with_deadline
+from src.replay_utils import recordable
+from src.scheduler_utils import scheduled
+
 
 url = "https://api.segmind.com/v1/sdxl1.0-colossus-lightning"
 added_prompt = """
@@ -10,28 +18,85 @@ added_prompt = """
                 """
 
 
-def get_segmind_image_requests(prompt):
-    api_key = st.secrets.segmind.api_key
-    url = "https://api.segmind.com/v1/sdxl1.0-colossus-lightning"
+# Settings for the two passes of progressive rendering. Both passes share the
+# seed so the full render looks like a sharper version of the preview.
+PREVIEW_SETTINGS = {"num_inference_steps": 4,
+                    "img_width": 512,
+                    "img_height": 512}
+FULL_SETTINGS = {"num_inference_steps": 9,
+                 "img_width": 1024,
+                 "img_height": 1024}
+DEFAULT_SEED = 902448
+
+
+def get_segmind_image_requests(prompt, api_key=None, seed=DEFAULT_SEED,
+                               num_inference_steps=9, img_width=1024,
+                               img_height=1024):
+    if api_key is None:
+        api_key = _get_segmind_creds()
     data = {
             "prompt": prompt + added_prompt,
             "samples": 1,
             "scheduler": "DPM++ SDE",
-            "num_inference_steps": 9,
+            "num_inference_steps": num_inference_steps,
             "guidance_scale": 1,
-            "seed": 902448,
-            "img_width": 1024,
-            "img_height": 1024,
+            "seed": seed,
+            "img_width": img_width,
+            "img_height": img_height,
             "base64": False
           }
 
-    response = requests.post(url, json=data, headers={'x-api-key': api_key})
+    response = requests.post(url, json=data, headers={'x-api-key': api_key},
+                             timeout=call_timeout())
     return response
 
+
+def get_segmind_preview_image(prompt, api_key=None, seed=DEFAULT_SEED):
+    """Cheap, low resolution render on the lightning model, meant to be
+    replaced by get_segmind_full_image with the same seed.
+
+    Args:
+        prompt (str): Image prompt.
+        api_key (str, optional): Segmind key, read from secrets if None.
+        seed (int, optional): Seed shared with the full quality pass.
+
+    Returns:
+        PIL.Image: preview image
+    """
+    return _get_lightning_image(prompt, api_key, seed, PREVIEW_SETTINGS)
+
+
+def get_segmind_full_image(prompt, api_key=None, seed=DEFAULT_SEED):
+    """Full quality render on the lightning model.
+
+    Args:
+        prompt (str): Image prompt.
+        api_key (str, optional): Segmind key, read from secrets if None.
+        seed (int, optional): Seed used for the preview pass.
+
+    Returns:
+        PIL.Image: full quality image
+    """
+    return _get_lightning_image(prompt, api_key, seed, FULL_SETTINGS)
+
+
+@recordable('segmind.lightning')
+@shared('segmind.lightning', codec=IMAGE, ttl=IMAGE_TTL)
+@scheduled('segmind')
+def _get_lightning_image(prompt, api_key, seed, settings):
+    response = get_segmind_image_requests(prompt, api_key=api_key, seed=seed,
+                                          **settings)
+    response.raise_for_status()
+    return Image.open(BytesIO(response.content))
+
+
 def _get_segmind_creds():
     segmind_creds = st.secrets.segmind.api_key
     return segmind_creds
 
+@recordable('segmind.sdxl')
+@shared('segmind.sdxl', codec=IMAGE, ttl=IMAGE_TTL)
+@scheduled('segmind')
 def get_segmind_image(prompt, api_key=None, model='SDXL'):
     if api_key is None:
         api_key = _get_segmind_creds()
@@ -39,6 +104,7 @@ def get_segmind_image(prompt, api_key=None, model='SDXL'):
         model = SDXL(api_key=api_key)
     else:
         ValueError(f'{model} not recognized')
-    image = model.generate(prompt)
+    # The SDK takes no timeout
+    image = run_with_deadline(model.generate, prompt)
     return image
 
@@ -0,0 +1,365 @@
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+
+DIMS = 512
+# Tuned on LABELLED_PAIRS: same-intent pairs score 0.81 and up ('morning
+# ritual' / 'morning coffee ritual'), different ones 0.72 at most ('vegan' /
+# 'not vegan', also refused by the exact terms)
+SIMILARITY_THRESHOLD = 0.76
+CHAR_NGRAM = 3
+# Light enough that sharing letters ('young women' / 'young men') does not
+# outweigh a different word
+CHAR_NGRAM_WEIGHT = 0.2
+# Bump when embed changes, caches saved with another version are dropped
+EMBEDDING_VERSION = 2
+INITIAL_CAPACITY = 64
+# Adds within this many seconds are written to disk together
+SAVE_DELAY_SECONDS = 5
+CACHE_DIR = Path(__file__).parent.parent / '.cache' / 'semantic'
+CACHE_FILE = 'cache.npz'
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+_SUFFIX_RE = re.compile(r'(ies|ing|ers|er|es|s)$')
+STOPWORDS = frozenset(
+    'a an and the for of with to in on at by from or is are be this that '
+    'people person our your their its it as'.split())
+# Stemmed words folded onto one term
+SYNONYMS = {
+    'young': 'youth', 'teen': 'youth', 'teenag': 'youth',
+    'kid': 'child', 'children': 'child',
+    'city': 'urban',
+    'mum': 'mother', 'mom': 'mother', 'dad': 'father',
+}
+# Words that flip or pin down the meaning of the tags: a hit needs the same
+# ones (and the same numbers) as the stored query
+NEGATIONS = frozenset(
+    'not no non without never nor free less anti'.split())
+
+
+def embed(text, dims=DIMS, ignore=()):
+    """Embed text locally with a signed hashing vectorizer over lightly
+    stemmed words and their character n-grams.
+
+    Args:
+        text (str): Text to embed, e.g. the campaign tags.
+        dims (int, optional): Vector size. Defaults to DIMS.
+        ignore (iterable, optional): Extra words to drop, e.g. the brand.
+
+    Returns:
+        np.ndarray: L2-normalised float32 vector (all zeros for empty text)
+    """
+    vector = np.zeros(dims, dtype=np.float32)
+    for word in _TOKEN_RE.findall(text.lower()):
+        if word in STOPWORDS or word in ignore:
+            continue
+        word = _stem(word)
+        _add_feature(vector, 'w:' + word, 1.0)
+        padded = f'#{word}#'
+        for i in range(len(padded) - CHAR_NGRAM + 1):
+            _add_feature(vector, 'c:' + padded[i:i + CHAR_NGRAM],
+                         CHAR_NGRAM_WEIGHT)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def _stem(word):
+    if len(word) > 4:
+        match = _SUFFIX_RE.search(word)
+        if match:
+            # families -> family, runners -> runn
+            word = word[:match.start()] + ('y' if match.group() == 'ies'
+                                          else '')
+    return SYNONYMS.get(word, word)
+
+
+def _add_feature(vector, feature, weight):
+    h = zlib.crc32(feature.encode('utf-8'))
+    vector[h % len(vector)] += weight if h & 0x80000000 else -weight
+
+
+def normalise_brand(brand):
+    return ' '.join(brand.lower().split())
+
+
+def exact_terms(tags):
+    """Negations and numbers in the tags, which must match exactly"""
+    return sorted(w for w in _TOKEN_RE.findall((tags or '').lower())
+                  if w in NEGATIONS or w.isdigit())
+
+
+def _index_key(brand, location):
+    # Structured inputs are matched exactly, only the tags are embedded
+    return f'{normalise_brand(brand)}|{normalise_brand(location or "")}'
+
+
+def _embed_tags(brand, tags, dims):
+    # The brand is matched exactly, repeating it in the tags is just noise
+    return embed(tags or '', dims,
+                 ignore=frozenset(_TOKEN_RE.findall(brand.lower())))
+
+
+class _BrandIndex:
+    """Growable matrix of query vectors for one brand"""
+
+    def __init__(self, dims, capacity=INITIAL_CAPACITY):
+        self.vectors = np.zeros((capacity, dims), dtype=np.float32)
+        self.count = 0
+        self.entries = []
+
+    def add(self, vector, entry):
+        if self.count == len(self.vectors):
+            grown = np.zeros((2 * len(self.vectors), self.vectors.shape[1]),
+                             dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+        self.vectors[self.count] = vector
+        self.count += 1
+        self.entries.append(entry)
+
+    def best(self, vector):
+        if not self.count:
+            return None, 0.0, None
+        similarities = self.vectors[:self.count] @ vector
+        i = int(np.argmax(similarities))
+        return self.entries[i], float(similarities[i]), i
+
+
+class SemanticCache:
+    """Near-duplicate cache for campaigns. The brand and location must
+    match exactly, and so must negations and numbers in the tags; the tags
+    otherwise only need a cosine similarity above the threshold.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, dims=DIMS):
+        self.threshold = threshold
+        self.dims = dims
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self.stats = {'hits': 0, 'misses': 0, 'false_hits': 0}
+
+    def __len__(self):
+        return sum(index.count for index in self._indexes.values())
+
+    def _match(self, brand, tags, location):
+        # The caller holds the lock
+        vector = _embed_tags(brand, tags, self.dims)
+        index = self._indexes.get(_index_key(brand, location))
+        if index is None:
+            return None, 0.0, None
+        entry, similarity, row = index.best(vector)
+        # Two empty tag sets embed to zero vectors: treat as identical
+        if entry is not None and not vector.any() and not entry['tags']:
+            similarity = 1.0
+        if (entry is None or similarity < self.threshold
+                or entry.get('exact', []) != exact_terms(tags)):
+            return None, similarity, None
+        return entry, similarity, (index, row)
+
+    def lookup(self, brand, tags, location=''):
+        """Return (campaign, similarity) for the closest stored query of the
+        same brand and location, or (None, similarity) when it is not close
+        enough.
+        """
+        with self._lock:
+            entry, similarity, _ = self._match(brand, tags, location)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None, similarity
+            self.stats['hits'] += 1
+        logger.info('Semantic cache hit for {} ({:.3f})', brand, similarity)
+        return entry['campaign'], similarity
+
+    def add(self, brand, tags, campaign, location=''):
+        vector = _embed_tags(brand, tags, self.dims)
+        entry = {'tags': tags or '', 'exact': exact_terms(tags),
+                 'campaign': campaign, 'created': time.time()}
+        with self._lock:
+            key = _index_key(brand, location)
+            if key not in self._indexes:
+                self._indexes[key] = _BrandIndex(self.dims)
+            self._indexes[key].add(vector, entry)
+
+    def report_false_hit(self, brand, tags, location=''):
+        """A user flagged the campaign served for this query as not matching
+        it: count it and stop serving that entry
+
+        Returns:
+            bool: whether a cached entry was withdrawn
+        """
+        with self._lock:
+            self.stats['false_hits'] += 1
+            entry, _, match = self._match(brand, tags, location)
+            if entry is None:
+                return False
+            index, row = match
+            # A zero vector never reaches the threshold again
+            index.vectors[row] = 0
+        logger.info('Withdrew a semantic cache entry for {}', brand)
+        self.save_later()
+        return True
+
+    def false_hit_rate(self):
+        hits = self.stats['hits']
+        return self.stats['false_hits'] / hits if hits else 0.0
+
+    def save(self, directory=CACHE_DIR):
+        """Write the cache to one file, atomically: concurrent saves and
+        loads see either the old or the new file, never a torn one"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            arrays = {f'v{i}': index.vectors[:index.count].copy()
+                      for i, index in enumerate(self._indexes.values())}
+            meta = json.dumps({
+                'version': EMBEDDING_VERSION,
+                'dims': self.dims,
+                'indexes': [{'key': key, 'entries': index.entries}
+                            for key, index in self._indexes.items()]})
+        arrays['meta'] = np.frombuffer(meta.encode('utf-8'), dtype=np.uint8)
+        path = directory / CACHE_FILE
+        with self._save_lock:
+            tmp_path = directory / (f'{CACHE_FILE}.{os.getpid()}.'
+                                    f'{threading.get_ident()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, path)
+
+    def save_later(self, directory=CACHE_DIR, delay=SAVE_DELAY_SECONDS):
+        """Save once, delay seconds from now, however many changes are
+        made meanwhile. Keeps the file write off the run's critical path.
+        """
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(delay, self._save_pending,
+                                               (directory,))
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _save_pending(self, directory):
+        with self._lock:
+            self._save_timer = None
+        try:
+            self.save(directory)
+        except OSError as e:
+            logger.warning('Could not save the semantic cache: {!r}', e)
+
+    @classmethod
+    def load(cls, directory=CACHE_DIR, threshold=SIMILARITY_THRESHOLD):
+        with np.load(Path(directory) / CACHE_FILE) as arrays:
+            meta = json.loads(arrays['meta'].tobytes().decode('utf-8'))
+            if meta.get('version') != EMBEDDING_VERSION:
+                raise ValueError(f'Embedding version {meta.get("version")}'
+                                 f', expected {EMBEDDING_VERSION}')
+            cache = cls(threshold=threshold, dims=meta['dims'])
+            for i, index_meta in enumerate(meta['indexes']):
+                index = _BrandIndex(cache.dims)
+                for vector, entry in zip(arrays[f'v{i}'],
+                                         index_meta['entries']):
+                    index.add(vector, entry)
+                cache._indexes[index_meta['key']] = index
+        return cache
+
+
+# (brand, stored tags, query tags, same intent)
+LABELLED_PAIRS = [
+    ('Nike', 'running, urban youth', 'running for urban young people', True),
+    ('Nike', 'Nike running, urban youth',
+     'nike, running for urban young people', True),
+    ('Nike', 'running, urban youth', 'urban youth running', True),
+    ('Nescafe', 'morning ritual', 'morning coffee ritual', True),
+    ('Lego', 'summer festival family', 'summer music festival for families',
+     True),
+    ('Nike', 'running, urban youth', 'golf for retired executives', False),
+    ('Nike', 'urban running youth', 'urban cycling youth', False),
+    ('Nescafe', 'morning ritual', 'evening wind down ritual', False),
+    ('Lego', 'summer festival family', 'winter family skiing', False),
+    ('Nike', 'young women', 'young men', False),
+    ('Nike', 'vegan', 'not vegan', False),
+    ('Nike', 'summer 2024 launch', 'summer 2025 launch', False),
+]
+
+
+def measure_false_hit_rate(cache, labelled_pairs=LABELLED_PAIRS):
+    """Replay labelled query pairs through a fresh cache with the same
+    threshold to estimate how often a hit serves the wrong intent, and how
+    often a same-intent query is served at all.
+
+    Args:
+        cache (SemanticCache): Cache whose threshold and dims are evaluated.
+        labelled_pairs (list, optional): (brand, stored_tags, query_tags,
+            same_intent). Defaults to LABELLED_PAIRS.
+
+    Returns:
+        dict: hit and false hit counts, false hit rate, and recall (the
+            share of same-intent pairs that hit)
+    """
+    hits = false_hits = same_intent_hits = same_intent_pairs = 0
+    for brand, stored_tags, query_tags, same_intent in labelled_pairs:
+        probe = SemanticCache(threshold=cache.threshold, dims=cache.dims)
+        probe.add(brand, stored_tags, campaign=stored_tags)
+        campaign, _ = probe.lookup(brand, query_tags)
+        same_intent_pairs += same_intent
+        if campaign is not None:
+            hits += 1
+            false_hits += not same_intent
+            same_intent_hits += same_intent
+    return {'hits': hits, 'false_hits': false_hits,
+            'false_hit_rate': false_hits / hits if hits else 0.0,
+            'recall': (same_intent_hits / same_intent_pairs
+                       if same_intent_pairs else 0.0)}
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache():
+    """Process-wide cache, loaded from CACHE_DIR when a saved copy exists"""
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            try:
+                _semantic_cache = SemanticCache.load(CACHE_DIR)
+            except FileNotFoundError:
+                _semantic_cache = SemanticCache()
+            except Exception as e:
+                # A cache is never worth failing a run over
+                logger.warning('Ignoring unreadable semantic cache: {!r}', e)
+                _semantic_cache = SemanticCache()
+        return _semantic_cache
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    words = ['running', 'urban', 'youth', 'coffee', 'morning', 'ritual',
+             'summer', 'festival', 'family', 'sport', 'music', 'night',
+             'green', 'planet', 'street', 'style', 'retro', 'future']
+    cache = SemanticCache()
+    for n in range(20000):
+        tags = ' '.join(rng.choice(words, size=4))
+        cache.add(f'brand{n % 20}', tags, campaign=tags)
+    cache.add('Nike', 'Nike running, urban youth', campaign='nike campaign')
+
+    queries = [' '.join(rng.choice(words, size=4)) for _ in range(1000)]
+    start = time.perf_counter()
+    for n, query in enumerate(queries):
+        cache.lookup(f'brand{n % 20}', query)
+    per_lookup = (time.perf_counter() - start) / len(queries)
+    print(f'{len(cache)} entries, {per_lookup * 1e3:.3f} ms per lookup')
+    print('near duplicate:',
+          cache.lookup('nike', 'nike, running for urban young people'))
+    print(measure_false_hit_rate(cache))
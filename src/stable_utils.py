@@ -1,6 +1,23 @@
+import functools
+import itertools
 import os
+import re
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from io import BytesIO
+from types import SimpleNamespace
+
 import replicate
+import requests
 from loguru import logger
+from PIL import Image
+
+from src.cache_utils import shared
+from src.deadline_utils import call_timeout, hold_slot_until
+from src.replay_utils import OFF, recordable, replay_mode
+from src.scheduler_utils import scheduled
 from src.gcp_utils import (get_secret_from_gcp,
                            get_gcp_project_id_from_env_var,
                            TEAM_SECRETS_GCP_PROJECT_SECRET_ID)
@@ -47,39 +64,309 @@ def get_stable_creds_and_set_as_env_vars():
     os.environ["REPLICATE_API_TOKEN"] = stable_creds_dict['api_key']
 
 
-def get_stable_image(prompt, model='sdxl'):
+MODEL_VERSIONS = {
+    'sdxl': ("stability-ai/sdxl:2b017d9b67edd2ee1401238df49d75da53c523f36e363881e057f5dc3ed3c5b2", 200),
+    'normal': ("stability-ai/stable-diffusion:27b93a2413e7f36cd83da926f3656280b2931564ff050bf9575f1fdf9bcd7478", 150),
+}
+
+FIRST_POLL_SECONDS = 1.0
+MAX_POLL_SECONDS = 10.0
+POLL_BACKOFF = 1.5
+# Predictions nobody has asked about for this long are cancelled
+ABANDON_SECONDS = 120
+TERMINAL_STATUSES = ('succeeded', 'failed', 'canceled')
+
+# tqdm progress lines in the prediction logs, e.g. " 45%|####5 | 90/200"
+_PROGRESS_RE = re.compile(r'(\d+)%\|')
+
+
+class _TrackedPrediction:
+    def __init__(self, prediction, on_progress, timeout=None):
+        self.prediction = prediction
+        self.on_progress = on_progress
+        self.future = Future()
+        self.interval = FIRST_POLL_SECONDS
+        self.next_poll = time.monotonic() + self.interval
+        self.last_interest = time.monotonic()
+        self.expires = (None if timeout is None
+                        else time.monotonic() + timeout)
+        self.progress = 0
+        self.logs = ''
+
+
+class PredictionTracker:
+    """Track many Replicate predictions from one poller thread.
+
+    Predictions are created without blocking, polled with exponential backoff
+    and cancelled when abandoned, so no thread is held per image.
+    """
+
+    def __init__(self):
+        self._predictions = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._poller = None
+        self._finished_ids = itertools.count(1)
+
+    def submit(self, prompt, model='sdxl', on_progress=None, timeout=None):
+        """Create a prediction and return its id straight away.
+
+        Args:
+            prompt (str): Prompt for generating the image.
+            model (str): Key of MODEL_VERSIONS.
+            on_progress (callable, optional): Called with (percent, logs) each
+                time a poll sees new progress.
+            timeout (float, optional): Seconds after which the prediction is
+                cancelled. Defaults to None (run until it finishes).
+
+        Returns:
+            str: Replicate prediction id
+        """
+        if model not in MODEL_VERSIONS:
+            raise ValueError(f'Model {model} not recognized')
+        version_ref, steps = MODEL_VERSIONS[model]
+        logger.info('Creating Replicate Stable Diffusion {} prediction...',
+                    model)
+        prediction = replicate.predictions.create(
+            version=_get_version(version_ref),
+            input={"prompt": prompt, "num_inference_steps": steps})
+        with self._lock:
+            self._predictions[prediction.id] = _TrackedPrediction(
+                prediction, on_progress, timeout)
+        self._ensure_poller()
+        return prediction.id
+
+    def add_finished(self, output):
+        """Track an output that is already known, e.g. replayed from a
+        cassette, like a prediction that has just succeeded"""
+        prediction_id = f'finished-{next(self._finished_ids)}'
+        tracked = _TrackedPrediction(
+            SimpleNamespace(id=prediction_id, status='succeeded',
+                            output=output, logs='', error=None), None)
+        tracked.progress = 100
+        # Never polled, dropped once nobody has asked about it for
+        # ABANDON_SECONDS
+        tracked.next_poll = float('inf')
+        tracked.future.set_result(output)
+        with self._lock:
+            self._predictions[prediction_id] = tracked
+        self._ensure_poller()
+        return prediction_id
+
+    def status(self, prediction_id):
+        """Current status, progress percentage and tail of the logs"""
+        with self._lock:
+            tracked = self._predictions.get(prediction_id)
+        if tracked is None:
+            return None
+        tracked.last_interest = time.monotonic()
+        return {'status': tracked.prediction.status,
+                'progress': tracked.progress,
+                'logs': tracked.logs[-500:]}
+
+    def wait(self, prediction_id, timeout=None):
+        """Block until the prediction finishes and return its output"""
+        with self._lock:
+            tracked = self._predictions[prediction_id]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Waiting counts as interest, so the prediction is not abandoned
+            tracked.last_interest = time.monotonic()
+            chunk = MAX_POLL_SECONDS
+            if deadline is not None:
+                chunk = min(chunk, max(0.0, deadline - time.monotonic()))
+            try:
+                return tracked.future.result(timeout=chunk)
+            except FutureTimeoutError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def future(self, prediction_id):
+        with self._lock:
+            return self._predictions[prediction_id].future
+
+    def cancel(self, prediction_id):
+        with self._lock:
+            tracked = self._predictions.pop(prediction_id, None)
+        if tracked is None or tracked.future.done():
+            return
+        logger.info('Cancelling Replicate prediction {}', prediction_id)
+        try:
+            tracked.prediction.cancel()
+        except Exception as e:
+            logger.warning('Could not cancel {}: {}', prediction_id, e)
+        tracked.future.cancel()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._predictions)
+
+    def _ensure_poller(self):
+        with self._lock:
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(
+                    target=self._poll_forever, name='replicate-poller',
+                    daemon=True)
+                self._poller.start()
+        self._wakeup.set()
+
+    def _poll_forever(self):
+        while True:
+            with self._lock:
+                tracked_list = list(self._predictions.items())
+            if not tracked_list:
+                self._wakeup.wait(timeout=MAX_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+            now = time.monotonic()
+            for prediction_id, tracked in tracked_list:
+                if now - tracked.last_interest > ABANDON_SECONDS:
+                    self.cancel(prediction_id)
+                elif tracked.expires is not None and now >= tracked.expires:
+                    logger.info('Prediction {} ran past its deadline',
+                                prediction_id)
+                    self.cancel(prediction_id)
+                elif now >= tracked.next_poll:
+                    try:
+                        self._poll(prediction_id, tracked)
+                    except Exception:
+                        # One bad prediction must not stop the others
+                        logger.exception('Polling {} failed', prediction_id)
+            with self._lock:
+                next_polls = [t.next_poll for t in self._predictions.values()]
+            delay = min(next_polls, default=now + MAX_POLL_SECONDS) \
+                - time.monotonic()
+            self._wakeup.wait(timeout=min(max(0.05, delay),
+                                          MAX_POLL_SECONDS))
+            self._wakeup.clear()
+
+    def _poll(self, prediction_id, tracked):
+        if tracked.future.done():
+            # Cancelled since the poller listed it
+            return
+        try:
+            prediction = replicate.predictions.get(prediction_id)
+        except Exception as e:
+            logger.warning('Polling {} failed: {}', prediction_id, e)
+            prediction = tracked.prediction
+        tracked.prediction = prediction
+        tracked.logs = prediction.logs or ''
+        matches = _PROGRESS_RE.findall(tracked.logs)
+        progress = int(matches[-1]) if matches else tracked.progress
+        if progress != tracked.progress and tracked.on_progress:
+            tracked.on_progress(progress, tracked.logs[-500:])
+        tracked.progress = progress
+
+        if prediction.status in TERMINAL_STATUSES:
+            with self._lock:
+                self._predictions.pop(prediction_id, None)
+            try:
+                if prediction.status == 'succeeded':
+                    tracked.future.set_result(prediction.output)
+                else:
+                    tracked.future.set_exception(RuntimeError(
+                        f'Prediction {prediction_id} {prediction.status}: '
+                        f'{prediction.error}'))
+            except InvalidStateError:
+                # Cancelled while this poll was in flight
+                pass
+            return
+
+        tracked.interval = min(tracked.interval * POLL_BACKOFF,
+                               MAX_POLL_SECONDS)
+        tracked.next_poll = time.monotonic() + tracked.interval
+
+
+@functools.lru_cache(maxsize=None)
+def _get_version(version_ref):
+    model_name, version_id = version_ref.split(':')
+    return replicate.models.get(model_name).versions.get(version_id)
+
+
+_tracker = PredictionTracker()
+
+
+def get_prediction_tracker():
+    return _tracker
+
+
+def get_stable_image_async(prompt, model='sdxl', on_progress=None):
+    """Start a Replicate prediction without waiting for it.
+
+    The prediction holds a 'replicate' scheduler slot until it ends and is
+    cancelled at the run's deadline. When recording or replaying, the render
+    goes through get_stable_image instead, so it is written to or served from
+    the cassette.
+
+    Args:
+        prompt (str): Prompt for generating the image using Stable Diffusion
+        model (str): Choose from 'normal' (stable diffusion model) or the new
+            SDXL 'sdxl'
+        on_progress (callable, optional): Called with (percent, logs).
+
+    Returns:
+        str: prediction id, see get_prediction_tracker
+    """
+    if replay_mode() != OFF:
+        # Cassettes hold finished images, prediction ids would not replay
+        return _tracker.add_finished([get_stable_image(prompt, model=model)])
+    return _submit_scheduled(prompt, model, on_progress)
+
+
+@scheduled('replicate')
+def _submit_scheduled(prompt, model, on_progress):
+    prediction_id = _tracker.submit(prompt, model=model,
+                                    on_progress=on_progress,
+                                    timeout=call_timeout())
+    hold_slot_until(_tracker.future(prediction_id))
+    return prediction_id
+
+
+@recordable('replicate.image')
+# Replicate serves outputs for an hour only
+@shared('replicate.image', ttl=50 * 60)
+@scheduled('replicate')
+def get_stable_image(prompt, model='sdxl', timeout=None):
     """Get images from Replicate Stable Diffusion API
 
     Args:
         prompt (str): Prompt for generating the image using Stable Diffusion
         model (str): Choose from 'normal' (stable diffusion model) or the new
             SDXL 'sdxl'
+        timeout (float, optional): Seconds to wait before cancelling the
+            prediction. Defaults to None (wait until it finishes).
 
     Returns:
         str: url of image returned from Replicate
     """
-    logger.info(
-        f"Sending prompt to Replicate Stable Diffusion {model} model...")
-    if model == 'sdxl':
-        output = replicate.run(
-            "stability-ai/sdxl:2b017d9b67edd2ee1401238df49d75da53c523f36e363881e057f5dc3ed3c5b2",
-            input={"prompt": prompt,
-                   "num_inference_steps": 200}
-        )
-
-    elif model == 'normal':
-        output = replicate.run(
-            "stability-ai/stable-diffusion:27b93a2413e7f36cd83da926f3656280b2931564ff050bf9575f1fdf9bcd7478",
-            input={"prompt": prompt,
-                   "num_inference_steps": 150}
-        )
-
-    else:
-        ValueError(f'Model {model} not recognized')
+    timeout = call_timeout(timeout)
+    prediction_id = _tracker.submit(prompt, model=model)
+    try:
+        output = _tracker.wait(prediction_id, timeout=timeout)
+    except BaseException:
+        _tracker.cancel(prediction_id)
+        raise
 
     return output[0]
 
 
+def download_image(url):
+    """Fetch and decode an image Replicate returned as a URL, so it can be
+    post-processed like the images other services return.
+
+    Args:
+        url (str): Image url, e.g. from get_stable_image.
+
+    Returns:
+        PIL.Image: decoded image
+    """
+    response = requests.get(url, timeout=call_timeout())
+    response.raise_for_status()
+    image = Image.open(BytesIO(response.content))
+    image.load()
+    return image
+
+
 def add_details_for_stable(prompt):
     """Adds prompt details to main GPT4 generated prompt for images.
 
@@ -89,7 +376,7 @@ def add_details_for_stable(prompt):
     Returns:
         str: prompt with added details.
     """
-    logger.info("Adding additional parameters for Stable Diffusion for \
+    logger.debug("Adding additional parameters for Stable Diffusion for \
                 improved image rendering")
     details = ', 8k, soft lighting, highly detailed, digital painting by \
         Android Jones'
@@ -1,6 +1,7 @@
-import re
 from loguru import logger
 
+from src.parse_utils import parse_instagram_posts
+
 
 def parse_insta_posts(gpt4_insta_response):
     """Convert GPT4 instagram post response into a dictionary that separates\
@@ -14,25 +15,8 @@ def parse_insta_posts(gpt4_insta_response):
         list: list of dictionary, each dictionary containing an instagram post
     """
     logger.info('Parsing GPT4 response into captions and image descriptions')
-    list_insta = gpt4_insta_response.split('Caption: ')
-    list_insta = [_format_instapost(i) for i in list_insta]
-    list_insta = [i.split('Image Description: ') for i in list_insta[1:]]
-    dict_list = []
-    for i in list_insta:
-        d = {}
-        d['Caption'] = i[0]
-        d['Image Description'] = i[1]
-        dict_list.append(d)
-    return dict_list
-
-
-def _format_instapost(insta_image_desc):
-    # Regex to eliminate only the double newlines with a number from the list
-    # Returned by GPT4
-    logger.info('Formatting posts for instagram')
-    logger.info(f'{insta_image_desc}')
-    replaced = re.sub(r"\n\n\d+\.\s", '', insta_image_desc)
-    return replaced
+    return [post.to_dict()
+            for post in parse_instagram_posts(gpt4_insta_response)]
 
 
 def parse_user_input_for_gpt4(brand, tags=None):
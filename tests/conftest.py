@@ -0,0 +1,24 @@
+import contextvars
+
+import pytest
+
+from src import cache_utils
+from src.deadline_utils import Deadline, set_deadline
+
+
+@pytest.fixture(autouse=True)
+def no_shared_cache(monkeypatch):
+    # Provider calls must reach the stubbed clients, not a cache on disk
+    monkeypatch.setattr(cache_utils, 'CACHE_BACKEND', 'off')
+    monkeypatch.setattr(cache_utils, '_cache', None)
+
+
+@pytest.fixture
+def within_deadline():
+    """Run a call the way a job does, with a deadline in its context"""
+    def run(fn, *args, seconds=30, **kwargs):
+        def call():
+            set_deadline(Deadline(seconds))
+            return fn(*args, **kwargs)
+        return contextvars.copy_context().run(call)
+    return run
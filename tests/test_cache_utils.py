@@ -0,0 +1,119 @@
+import io
+import time
+
+import pandas as pd
+import pytest
+from PIL import Image
+
+from src import cache_utils
+from src.cache_utils import (DATAFRAME, IMAGE, JSON, RECORDS, RedisBackend,
+                             RespStandIn, SharedCache, SQLiteBackend, decode,
+                             encode, encode_command, read_reply, shared)
+
+
+@pytest.fixture(params=['sqlite', 'resp'])
+def backend(request, tmp_path):
+    if request.param == 'sqlite':
+        yield SQLiteBackend(tmp_path, inline_bytes=16)
+        return
+    stand_in = RespStandIn()
+    backend = RedisBackend.from_url(stand_in.url)
+    yield backend
+    backend.close()
+    stand_in.close()
+
+
+def test_backend_get_set_delete(backend):
+    assert backend.get('missing') is None
+    backend.set('small', b'value')
+    # Bigger than inline_bytes, so a blob file for SQLite
+    backend.set('large', b'x' * 100)
+    assert backend.get('small') == b'value'
+    assert backend.get('large') == b'x' * 100
+    backend.delete('large')
+    assert backend.get('large') is None
+
+
+def test_backend_expiry(backend):
+    backend.set('short', b'value', ttl=0.05)
+    backend.set('long', b'value', ttl=60)
+    time.sleep(0.1)
+    assert backend.get('short') is None
+    assert backend.get('long') == b'value'
+
+
+def test_sqlite_delete_removes_the_blob(tmp_path):
+    backend = SQLiteBackend(tmp_path, inline_bytes=16)
+    backend.set('large', b'x' * 100)
+    assert len(list(backend.blob_dir.iterdir())) == 1
+    backend.delete('large')
+    assert list(backend.blob_dir.iterdir()) == []
+
+
+def test_resp_encoding_round_trip():
+    assert encode_command(b'SET', 'key', 5) == \
+        b'*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$1\r\n5\r\n'
+    reader = io.BytesIO(b'+OK\r\n:3\r\n$-1\r\n$5\r\na\r\nbc\r\n'
+                        b'*2\r\n$1\r\nx\r\n:1\r\n')
+    assert [read_reply(reader) for _ in range(5)] == [
+        'OK', 3, None, b'a\r\nbc', [b'x', 1]]
+    with pytest.raises(cache_utils.CacheBackendError, match='WRONGTYPE'):
+        read_reply(io.BytesIO(b'-WRONGTYPE bad\r\n'))
+
+
+def test_json_codec():
+    value = {'campaign': 'Bold', 'posts': [1, 2]}
+    assert decode(encode(value, JSON)) == value
+
+
+def test_frame_codecs_keep_nested_columns():
+    # A pyarrow built for another NumPy fails with a plain ImportError
+    pytest.importorskip('pyarrow', exc_type=ImportError)
+    records = [{'id': 'a', 'location': [2.35, 48.86], 'rank': 1},
+               {'id': 'b', 'location': [0.1, 51.5], 'rank': 2}]
+    assert decode(encode(records, RECORDS)) == records
+    df = pd.DataFrame(records)
+    pd.testing.assert_frame_equal(decode(encode(df, DATAFRAME)), df)
+
+
+def test_image_codec():
+    rgb = Image.new('RGB', (8, 8), (200, 10, 10))
+    decoded = decode(encode(rgb, IMAGE))
+    assert (decoded.format, decoded.size) == ('JPEG', (8, 8))
+    # Transparency needs PNG, which is lossless
+    rgba = Image.new('RGBA', (8, 8), (200, 10, 10, 128))
+    decoded = decode(encode(rgba, IMAGE))
+    assert decoded.format == 'PNG'
+    assert decoded.getpixel((0, 0)) == (200, 10, 10, 128)
+
+
+class _BrokenBackend(cache_utils.CacheBackend):
+    def get(self, key):
+        raise cache_utils.CacheBackendError('down')
+
+    def set(self, key, value, ttl=None):
+        raise cache_utils.CacheBackendError('down')
+
+
+def test_backend_errors_count_as_misses():
+    cache = SharedCache(_BrokenBackend())
+    cache.set('key', 'value', name='call')
+    assert cache.get('key', name='call') is None
+    assert cache.stats() == {'call': {'hits': 0, 'misses': 0, 'errors': 2}}
+
+
+def test_shared_calls_are_computed_once(monkeypatch, tmp_path):
+    cache = SharedCache(SQLiteBackend(tmp_path))
+    monkeypatch.setattr(cache_utils, 'CACHE_BACKEND', 'sqlite')
+    monkeypatch.setattr(cache_utils, '_cache', cache)
+    calls = []
+
+    @shared('test.campaign')
+    def campaign(brand):
+        calls.append(brand)
+        return f'A campaign for {brand}'
+
+    assert campaign('Nike') == campaign('Nike') == 'A campaign for Nike'
+    assert calls == ['Nike']
+    assert cache.stats() == {'test.campaign': {'hits': 1, 'misses': 1,
+                                               'errors': 0}}
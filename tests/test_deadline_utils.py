@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from src.deadline_utils import (DeadlineExceeded, abandoned_calls,
+                                run_with_deadline)
+from src.scheduler_utils import get_scheduler, scheduled
+
+
+def _wait_for(condition, seconds=5):
+    end = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_abandoned_call_keeps_its_slot(within_deadline):
+    release = threading.Event()
+
+    @scheduled('test-slow-sdk')
+    def slow_call():
+        return run_with_deadline(release.wait)
+
+    scheduler = get_scheduler('test-slow-sdk')
+    with pytest.raises(DeadlineExceeded):
+        within_deadline(slow_call, seconds=1.2)
+    # Still running at the provider, so still holding the slot
+    assert scheduler.stats()['in_use'] == 1
+    assert abandoned_calls('test-slow-sdk') == 1
+    release.set()
+    _wait_for(lambda: scheduler.stats()['in_use'] == 0)
+    assert abandoned_calls('test-slow-sdk') == 0
+
+
+def test_stuck_provider_fails_fast(within_deadline):
+    release = threading.Event()
+    calls = []
+
+    @scheduled('test-stuck-sdk')
+    def stuck_call():
+        calls.append(1)
+        return run_with_deadline(release.wait)
+
+    try:
+        for _ in range(2):
+            with pytest.raises(DeadlineExceeded):
+                within_deadline(stuck_call, seconds=1.2)
+        start = time.monotonic()
+        with pytest.raises(DeadlineExceeded, match='still has 2 calls'):
+            within_deadline(stuck_call, seconds=30)
+        assert time.monotonic() - start < 0.5
+        assert len(calls) == 2
+    finally:
+        release.set()
+    _wait_for(lambda: abandoned_calls('test-stuck-sdk') == 0)
+    assert within_deadline(stuck_call, seconds=30)
@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+
+openai = pytest.importorskip('openai')
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('streamlit')
+
+from src import endpoint_utils  # noqa: E402
+
+
+def _chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(
+        delta=SimpleNamespace(content=text))])
+
+
+def _stream(*items):
+    # Chunks, and exceptions raised when the stream gets to them
+    for item in items:
+        if isinstance(item, Exception):
+            raise item
+        yield _chunk(item)
+
+
+def _pool(*streams):
+    endpoints = []
+    for n, stream in enumerate(streams):
+        endpoint = endpoint_utils.Endpoint(f'e{n}', endpoint_utils.OPENAI,
+                                           api_key='key')
+        endpoint.client = SimpleNamespace(chat=SimpleNamespace(
+            completions=SimpleNamespace(
+                create=lambda chunks=stream, **kwargs: chunks)))
+        endpoints.append(endpoint)
+    pool = endpoint_utils.EndpointPool(endpoints)
+    # Try the endpoints in order
+    pool.candidates = lambda model: list(endpoints)
+    return pool, endpoints
+
+
+def _read(stream):
+    with stream:
+        return ''.join(c.choices[0].delta.content for c in stream)
+
+
+def test_stream_stays_in_flight_until_consumed():
+    pool, (endpoint,) = _pool(_stream('a', 'b'))
+    stream = pool.chat_completion('gpt-4', stream=True)
+    assert endpoint.in_flight == 1
+    assert _read(stream) == 'ab'
+    assert endpoint.in_flight == 0
+    assert endpoint.latency is not None
+
+
+def test_stream_failing_half_way_counts_against_the_endpoint():
+    error = httpx.ReadError('connection reset')
+    pool, (first, second) = _pool(_stream('a', error), _stream('b'))
+    with pytest.raises(httpx.ReadError):
+        _read(pool.chat_completion('gpt-4', stream=True))
+    assert (first.in_flight, first.errors, first.latency) == (0, 1, None)
+    assert second.calls == 0
+
+
+def test_stream_failing_before_its_first_chunk_spills_over():
+    error = httpx.ReadError('connection reset')
+    pool, (first, second) = _pool(_stream(error), _stream('b'))
+    assert _read(pool.chat_completion('gpt-4', stream=True)) == 'b'
+    assert (first.in_flight, first.errors) == (0, 1)
+    assert (second.in_flight, second.calls) == (0, 1)
+
+
+def test_closed_stream_releases_the_endpoint():
+    pool, (endpoint,) = _pool(_stream('a', 'b'))
+    with pool.chat_completion('gpt-4', stream=True) as stream:
+        next(stream)
+    assert endpoint.in_flight == 0
+    assert endpoint.errors == 0
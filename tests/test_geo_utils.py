@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pandas as pd
+
+from src import geo_utils
+from src.geo_utils import (COVERAGE_TTL_SECONDS, EVENT_COLUMNS, INDEX_FILE,
+                           EventIndex, get_event_index)
+
+PARIS = (48.86, 2.35)
+
+
+def _events(count, latitude=PARIS[0], longitude=PARIS[1], first=0,
+            end='2030-01-02T00:00:00Z'):
+    return pd.DataFrame([{'id': str(i), 'title': f'Event {i}',
+                          'phq_attendance': i,
+                          'location': [longitude, latitude],
+                          'start': '2030-01-01T00:00:00Z',
+                          'end': end}
+                         for i in range(first, first + count)])
+
+
+def test_query_on_empty_index_keeps_the_schema():
+    result = EventIndex().query(*PARIS, 25, '2030-01-01', '2030-12-31')
+    assert len(result) == 0
+    assert list(result.columns) == EVENT_COLUMNS
+
+
+def test_query_with_no_match_keeps_the_schema():
+    index = EventIndex()
+    index.add_events(_events(3), *PARIS, 25, '2030-01-01', '2030-12-31')
+    result = index.query(-33.87, 151.21, 25)
+    assert len(result) == 0
+    assert 'phq_attendance' in result.columns
+
+
+def test_complete_search_is_covered():
+    index = EventIndex()
+    index.add_events(_events(3), *PARIS, 25, '2030-01-01', '2030-12-31')
+    assert index.covers(*PARIS, 10, '2030-02-01', '2030-03-01')
+    assert len(index.query(*PARIS, 10, '2030-01-01', '2030-12-31')) == 3
+
+
+def test_empty_or_truncated_search_is_not_covered():
+    index = EventIndex()
+    index.add_events(_events(0), *PARIS, 25, '2030-01-01', '2030-12-31')
+    index.add_events(_events(3), *PARIS, 25, '2030-01-01', '2030-12-31',
+                     complete=False)
+    assert not index.covers(*PARIS, 10, '2030-02-01', '2030-03-01')
+    # What a truncated search found is still served
+    assert len(index.query(*PARIS, 10, '2030-01-01', '2030-12-31')) == 3
+
+
+def test_expired_coverage_and_ended_events_are_pruned():
+    index = EventIndex()
+    index.add_events(_events(3), *PARIS, 25, '2030-01-01', '2030-12-31')
+    index.coverage[0]['fetched_at'] = time.time() - COVERAGE_TTL_SECONDS - 1
+    index.add_events(_events(2, first=3, end='2020-01-02T00:00:00Z'),
+                     *PARIS, 25, '2020-01-01', '2020-12-31')
+    assert len(index.coverage) == 1
+    assert len(index) == 3
+
+
+def test_stored_events_are_capped_oldest_first(monkeypatch):
+    monkeypatch.setattr(geo_utils, 'MAX_EVENTS', 4)
+    index = EventIndex()
+    index.add_events(_events(3), *PARIS, 25, '2030-01-01', '2030-12-31')
+    index.add_events(_events(3, first=3), *PARIS, 25, '2030-01-01',
+                     '2030-12-31')
+    assert list(index.events['id']) == ['2', '3', '4', '5']
+
+
+def test_concurrent_saves_round_trip(tmp_path):
+    index = EventIndex()
+    index.add_events(_events(3), *PARIS, 25, '2030-01-01', '2030-12-31')
+    threads = [threading.Thread(target=index.save, args=(tmp_path,))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [p.name for p in tmp_path.iterdir()] == [INDEX_FILE]
+    loaded = EventIndex.load(tmp_path)
+    assert len(loaded) == 3
+    assert loaded.covers(*PARIS, 10, '2030-02-01', '2030-03-01')
+
+
+def test_unreadable_index_starts_empty(tmp_path, monkeypatch):
+    (tmp_path / INDEX_FILE).write_bytes(b'torn')
+    monkeypatch.setattr(geo_utils, 'EVENTS_DIR', tmp_path)
+    monkeypatch.setattr(geo_utils, '_event_index', None)
+    assert len(get_event_index()) == 0
@@ -0,0 +1,16 @@
+from PIL import Image
+
+from src import image_utils
+
+
+def test_single_core_postprocesses_in_process(monkeypatch):
+    monkeypatch.setattr(image_utils, 'POOL_WORKERS', 1)
+    monkeypatch.setattr(image_utils, 'get_image_pool', lambda: None)
+    future = image_utils.submit_postprocess(Image.new('RGB', (64, 48)))
+    assert set(future.result()) == set(image_utils.FORMATS)
+
+
+def test_single_core_failures_land_on_the_future(monkeypatch):
+    monkeypatch.setattr(image_utils, 'POOL_WORKERS', 1)
+    future = image_utils.submit_postprocess('https://replicate.delivery/x')
+    assert isinstance(future.exception(), AttributeError)
@@ -0,0 +1,36 @@
+import threading
+
+from src.job_utils import CANCELLED, DONE, JobManager
+
+
+def _wait(job):
+    while not job.finished:
+        job._cancel_event.wait(0.01)
+    return job.status
+
+
+def test_shared_job_runs_until_every_session_moved_on():
+    manager = JobManager(max_workers=1)
+    release = threading.Event()
+
+    def pipeline(job):
+        while not (release.is_set() or job.cancelled):
+            release.wait(0.01)
+
+    job = manager.submit('key', {}, pipeline, owner='a')
+    assert manager.submit('key', {}, pipeline, owner='b') is job
+    manager.attach('key', 'c')
+    manager.detach('key', 'a')
+    manager.detach('key', 'b')
+    assert not job.cancelled
+    manager.detach('key', 'c')
+    assert job.cancelled
+    assert _wait(job) == CANCELLED
+
+
+def test_detaching_from_a_finished_job_keeps_it():
+    manager = JobManager(max_workers=1)
+    job = manager.submit('key', {}, lambda job: None, owner='a')
+    assert _wait(job) == DONE
+    manager.detach('key', 'a')
+    assert manager.get('key') is job and not job.cancelled
@@ -0,0 +1,85 @@
+import io
+import json
+
+import pytest
+from loguru import logger
+
+from src.log_utils import (BackgroundSink, handler_level, make_filter,
+                           truncate_message)
+
+LEVELS = {'src': 'WARNING', 'src.geo_utils': 'DEBUG'}
+
+
+@pytest.fixture
+def capture():
+    """Add a handler with the given filter, return the messages it kept"""
+    handler_ids, messages = [], []
+
+    def add(**kwargs):
+        handler_ids.append(logger.add(
+            lambda m: messages.append(m.record['message']), **kwargs))
+        return messages
+
+    yield add
+    for handler_id in handler_ids:
+        logger.remove(handler_id)
+
+
+def _from(module):
+    return logger.patch(lambda record: record.update(name=module))
+
+
+def test_most_specific_module_level_wins(capture):
+    messages = capture(level=handler_level('INFO', LEVELS),
+                       filter=make_filter('INFO', LEVELS, sample_rates={}))
+    _from('src.geo_utils').debug('geo debug')
+    _from('src.geo_utils_extra').info('not a submodule')
+    _from('src.pipeline_utils').warning('pipeline warning')
+    _from('src.pipeline_utils').info('pipeline info')
+    _from('httpx').info('default level')
+    _from('httpx').debug('below default')
+    assert messages == ['geo debug', 'pipeline warning', 'default level']
+
+
+def test_handler_level_is_the_lowest_in_use():
+    assert handler_level('INFO', LEVELS) == logger.level('DEBUG').no
+    assert handler_level('INFO', {'httpx': 'WARNING'}) == \
+        logger.level('INFO').no
+
+
+def test_levels_are_sampled(capture):
+    messages = capture(level='DEBUG', filter=make_filter(
+        'DEBUG', {}, sample_rates={'DEBUG': 0.0, 'INFO': 1.0}))
+    for _ in range(10):
+        logger.debug('sampled out')
+    logger.info('kept')
+    logger.warning('unlisted level')
+    assert messages == ['kept', 'unlisted level']
+
+
+def test_long_messages_are_truncated():
+    record = {'message': 'x' * 30}
+    truncate_message(record, max_chars=10)
+    assert record['message'] == 'x' * 10 + '... [20 chars truncated]'
+
+
+def test_background_sink_writes_json_lines():
+    stream = io.StringIO()
+    sink = BackgroundSink(stream)
+    handler_id = logger.add(sink, format='{message}')
+    try:
+        logger.bind(run_id='run-1').info('Parsed {} posts', 3)
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            logger.exception('Failed')
+    finally:
+        logger.remove(handler_id)
+        sink.stop()
+    first, second = (json.loads(line)
+                     for line in stream.getvalue().splitlines())
+    assert (first['level'], first['message'], first['run_id']) == (
+        'INFO', 'Parsed 3 posts', 'run-1')
+    assert first['function'] == 'test_background_sink_writes_json_lines'
+    assert second['level'] == 'ERROR'
+    assert 'ValueError: bad' in second['exception']
@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+from PIL import Image
+
+from src import memory_utils
+from src.job_utils import DONE, JobManager
+from src.memory_utils import ArtefactRef, ArtefactStore, resolve
+
+
+def _image(seed=0):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 255, (512, 512, 3),
+                                        dtype=np.uint8))
+
+
+def test_spilled_artefacts_are_read_once(tmp_path, monkeypatch):
+    store = ArtefactStore(session_budget=1, spill_dir=tmp_path)
+    ref = store.put('session', _image())
+    assert isinstance(ref, ArtefactRef)
+    reads = []
+    load = np.load
+    monkeypatch.setattr(memory_utils.np, 'load',
+                        lambda *a, **k: reads.append(1) or load(*a, **k))
+    first = store.get(ref)
+    assert store.get(ref) is first
+    assert len(reads) == 1
+
+
+def test_loaded_artefacts_stay_within_their_budget(tmp_path):
+    store = ArtefactStore(session_budget=1, spill_dir=tmp_path,
+                          loaded_bytes=1024 ** 2)
+    refs = [store.put('session', _image(seed)) for seed in range(3)]
+    for ref in refs:
+        store.get(ref)
+    assert store._loaded_usage <= 1024 ** 2
+    assert list(store._loaded) == [refs[-1].id]
+
+
+def test_encoded_files_count_against_the_budget(tmp_path):
+    store = ArtefactStore(session_budget=1, spill_dir=tmp_path)
+    formats = {'square': b'x' * 200_000, 'story': b'y' * 200_000}
+    ref = store.put('session', formats)
+    assert isinstance(ref, ArtefactRef)
+    assert store.report()['session']['encoded']['disk_bytes'] == 400_000
+    assert resolve({0: ref}, store) == {0: formats}
+
+
+def test_spills_are_written_outside_the_lock(tmp_path, monkeypatch):
+    store = ArtefactStore(session_budget=1, spill_dir=tmp_path)
+    locked = []
+    write = store._write
+    monkeypatch.setattr(store, '_write', lambda *a: locked.append(
+        store._lock.locked()) or write(*a))
+    ref = store.put('session', _image())
+    assert locked == [False]
+    assert store.report()['session']['image']['disk_bytes'] == ref.nbytes
+    assert np.array_equal(np.asarray(store.get(ref)), np.asarray(_image()))
+
+
+def test_evicted_session_jobs_run_again(tmp_path, monkeypatch):
+    store = ArtefactStore(spill_dir=tmp_path)
+    monkeypatch.setattr(memory_utils, '_artefact_store', store)
+    manager = JobManager(max_workers=1)
+    runs = []
+
+    def pipeline(job):
+        runs.append(job)
+        job.set_result('image', _image())
+
+    def submit():
+        job = manager.submit('key', {}, pipeline, owner='session')
+        while job.status != DONE:
+            time.sleep(0.01)
+        return job
+
+    first = submit()
+    assert submit() is first
+    assert store.evict_idle(idle_seconds=-1) == ['session']
+    assert manager.get('key') is None
+    second = submit()
+    assert second is not first
+    assert second.snapshot()['results']['image'] is not None
+    assert len(runs) == 2
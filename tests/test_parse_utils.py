@@ -0,0 +1,81 @@
+import pytest
+
+from src.parse_utils import find_principal_image, parse_response
+
+
+def _posts(text):
+    return [(p.caption, p.image_description)
+            for p in parse_response(text).posts]
+
+
+EXPECTED = [('Sun is out', 'A beach at dawn'),
+            ('Gear up', 'Shoes on a track')]
+
+
+@pytest.mark.parametrize('text', [
+    # Numbered fields
+    '1. Caption: Sun is out\n2. Image Description: A beach at dawn\n\n'
+    '3. Caption: Gear up\n4. Image Description: Shoes on a track\n',
+    # Bold labels
+    '**Caption:** Sun is out\n**Image Description:** A beach at dawn\n'
+    '**Caption:** Gear up\n**Image Description:** Shoes on a track\n',
+    # Post prefixes on the fields
+    'Post 1 - Caption: Sun is out\nPost 1 - Image: A beach at dawn\n'
+    'Post 2 - Caption: Gear up\nPost 2 - Image: Shoes on a track\n',
+    # Bare "Post N" lines between records
+    'Post 1\nCaption: Sun is out\nImage Description: A beach at dawn\n\n'
+    'Post 2\nCaption: Gear up\nImage Description: Shoes on a track\n',
+    # Post headings, in markdown and bold
+    '### Post 1\nCaption: Sun is out\nImage prompt: A beach at dawn\n'
+    '**Post 2:**\nCaption: Gear up\nImage prompt: Shoes on a track\n',
+    # A bold post label followed by a field on the same line
+    '**Post 1:** Caption: Sun is out\nImage: A beach at dawn\n'
+    '**Post 2:** Caption: Gear up\nImage: Shoes on a track\n',
+    # Captions right after the label, without a field name
+    'Post 1: Sun is out\nImage Description: A beach at dawn\n'
+    'Post 2: Gear up\nImage Description: Shoes on a track\n',
+    # Image first within a record
+    'Post 1\nImage: A beach at dawn\nCaption: Sun is out\n'
+    'Post 2\nImage: Shoes on a track\nCaption: Gear up\n',
+])
+def test_post_formats(text):
+    assert _posts(text) == EXPECTED
+
+
+def test_post_label_ends_the_previous_record():
+    # Without the label the second post's caption-less description would
+    # have been appended to the first post
+    text = ('Post 1\nCaption: Sun is out\nImage Description: A beach\n'
+            'Post 2\nImage Description: Shoes on a track\n'
+            'Post 3\n')
+    assert _posts(text) == [('Sun is out', 'A beach'),
+                            ('', 'Shoes on a track')]
+
+
+def test_numbers_inside_text_are_kept():
+    text = ('1. Caption: 100 years since 1923.\n'
+            '2. Image Description: Stickers from 3.5 decades.\n')
+    assert _posts(text) == [('100 years since 1923.',
+                             'Stickers from 3.5 decades.')]
+
+
+def test_campaign_sections():
+    text = ('Intro line\n\n### Visual Identity\nDeep blues.\n\n'
+            '**Promotional Tactics:**\n1. AR filters\n2. Pop-ups\n\n'
+            '**KPIs:** Reach\n\n**Principal Image:** A castle.\n\n'
+            'Post 1\nCaption: Sun is out\nImage: A beach\n')
+    parsed = parse_response(text)
+    assert parsed.campaign.intro == 'Intro line'
+    assert parsed.campaign.visual_identity == 'Deep blues.'
+    assert parsed.campaign.tactics == '1. AR filters\n2. Pop-ups'
+    assert parsed.campaign.kpis == 'Reach'
+    assert parsed.campaign.principal_image == 'A castle.'
+    assert _posts(text) == [('Sun is out', 'A beach')]
+    assert find_principal_image(text) == 'A castle.'
+
+
+def test_principal_image_while_streaming():
+    text = '**Principal Image:** A castle under a starry sky'
+    assert find_principal_image(text, complete=False) == ''
+    assert find_principal_image(text + '\n\nMore', complete=False) == (
+        'A castle under a starry sky')
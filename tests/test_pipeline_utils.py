@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip('openai')
+pytest.importorskip('streamlit')
+
+from src import pipeline_utils, predict_utils  # noqa: E402
+from src.deadline_utils import DeadlineExceeded  # noqa: E402
+from src.geo_utils import EventIndex  # noqa: E402
+from src.job_utils import Job  # noqa: E402
+from src.semantic_cache_utils import SemanticCache  # noqa: E402
+
+
+def _job():
+    return Job('0' * 64, {'brand': 'Brand', 'location': 'Paris'})
+
+
+def test_optional_stage_failing_degrades_the_run():
+    job = _job()
+
+    def failing(job):
+        raise KeyError('phq_attendance')
+
+    pipeline_utils._optional(job, 'Event recommendations', failing)
+    assert job.metadata['degraded'] == [
+        "Event recommendations left out after an error: "
+        "KeyError('phq_attendance')"]
+
+
+def test_optional_stage_running_out_of_time_degrades_the_run():
+    job = _job()
+
+    def late(job):
+        raise DeadlineExceeded('60s budget spent')
+
+    pipeline_utils._optional(job, 'Post images', late)
+    assert job.metadata['degraded'] == [
+        'Post images cut short by the time budget']
+
+
+def test_events_from_an_empty_cache(monkeypatch, within_deadline):
+    monkeypatch.setattr(predict_utils, 'get_event_index', EventIndex)
+    job = _job()
+    # Too little time left for a fresh search: cached events only
+    within_deadline(pipeline_utils._run_events, job, 'Paris', 'campaign',
+                    {'api_key': 'key'}, seconds=5)
+    assert 'recommendation' not in job.results
+    assert job.metadata['degraded'] == [
+        'A fresh PredictHQ search (cached events used) skipped to stay '
+        'within the time budget',
+        'Event recommendations (no cached events) skipped to stay within '
+        'the time budget']
+
+
+def test_combined_run_batches_the_cache_write(monkeypatch, within_deadline):
+    cache = SemanticCache()
+    saves = []
+    monkeypatch.setattr(cache, 'save', lambda *args: saves.append('now'))
+    monkeypatch.setattr(cache, 'save_later',
+                        lambda *args: saves.append('later'))
+    monkeypatch.setattr(pipeline_utils, 'get_semantic_cache', lambda: cache)
+    monkeypatch.setattr(
+        pipeline_utils, 'get_gpt4_campaign_and_insta_response',
+        lambda *args, **kwargs: ('campaign', []))
+    job = _job()
+    within_deadline(pipeline_utils._run_combined, job, 'Brand', 'tags',
+                    'query', {'api_key': 'key'}, None, '', None)
+    assert saves == ['later']
+    assert cache.lookup('Brand', 'tags')[0] == 'campaign'
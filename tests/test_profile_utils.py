@@ -0,0 +1,14 @@
+from src.profile_utils import profiling_allowed
+
+
+def test_profiling_needs_admin():
+    assert not profiling_allowed({'profile': ['1']}, token='')
+    assert profiling_allowed({'admin': ['1'], 'profile': ['1']}, token='')
+    assert not profiling_allowed({'admin': ['1']}, token='')
+
+
+def test_profiling_token_replaces_profile_1():
+    params = {'admin': ['1'], 'profile': ['1']}
+    assert not profiling_allowed(params, token='s3cret')
+    params['profile'] = ['s3cret']
+    assert profiling_allowed(params, token='s3cret')
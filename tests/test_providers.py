@@ -0,0 +1,308 @@
+"""Smoke tests: every provider call, through its decorators, against a
+stubbed client"""
+import io
+import time
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+
+def _png_bytes(size=(8, 8)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class _Prediction:
+    def __init__(self, output):
+        self.id = 'prediction-1'
+        self.status = 'succeeded'
+        self.output = output
+        self.logs = ' 100%|##########| 200/200'
+        self.error = None
+
+    def cancel(self):
+        self.status = 'canceled'
+
+
+def _stub_replicate(monkeypatch, prediction):
+    from src import stable_utils
+
+    fake = SimpleNamespace(
+        predictions=SimpleNamespace(create=lambda **kwargs: prediction,
+                                    get=lambda prediction_id: prediction),
+        models=SimpleNamespace(get=lambda name: SimpleNamespace(
+            versions=SimpleNamespace(get=lambda version: version))))
+    monkeypatch.setattr(stable_utils, 'replicate', fake)
+    stable_utils._get_version.cache_clear()
+    return stable_utils
+
+
+def test_replicate_image(monkeypatch, within_deadline):
+    pytest.importorskip('replicate')
+    prediction = _Prediction(['https://replicate.delivery/image.png'])
+    stable_utils = _stub_replicate(monkeypatch, prediction)
+
+    url = within_deadline(stable_utils.get_stable_image, 'a red square')
+    assert url == 'https://replicate.delivery/image.png'
+
+    response = SimpleNamespace(content=_png_bytes((16, 8)),
+                               raise_for_status=lambda: None)
+    monkeypatch.setattr(stable_utils.requests, 'get',
+                        lambda url, timeout: response)
+    image = within_deadline(stable_utils.download_image, url)
+    assert image.size == (16, 8)
+
+
+def test_replicate_async_holds_a_slot_until_done(monkeypatch,
+                                                within_deadline):
+    pytest.importorskip('replicate')
+    from src.scheduler_utils import get_scheduler
+
+    prediction = _Prediction(['https://replicate.delivery/image.png'])
+    prediction.status = 'processing'
+    stable_utils = _stub_replicate(monkeypatch, prediction)
+    monkeypatch.setattr(stable_utils, 'FIRST_POLL_SECONDS', 0.01)
+    scheduler = get_scheduler('replicate')
+    in_use = scheduler.stats()['in_use']
+
+    prediction_id = within_deadline(stable_utils.get_stable_image_async,
+                                    'a red square')
+    future = stable_utils.get_prediction_tracker().future(prediction_id)
+    assert scheduler.stats()['in_use'] == in_use + 1
+    prediction.status = 'succeeded'
+    assert future.result(timeout=5) == prediction.output
+    # Released by the future's done callback, just after the result is set
+    for _ in range(100):
+        if scheduler.stats()['in_use'] == in_use:
+            break
+        time.sleep(0.01)
+    assert scheduler.stats()['in_use'] == in_use
+
+
+def test_cancelled_prediction_keeps_the_poller_alive(monkeypatch):
+    pytest.importorskip('replicate')
+    prediction = _Prediction(['https://replicate.delivery/image.png'])
+    stable_utils = _stub_replicate(monkeypatch, prediction)
+    tracker = stable_utils.PredictionTracker()
+    tracked = stable_utils._TrackedPrediction(prediction, None)
+    tracked.future.cancel()
+    # The poller listed it before cancel() took it out
+    tracker._poll(prediction.id, tracked)
+    assert tracked.future.cancelled()
+
+
+def test_replicate_async_replays_from_the_cassette(monkeypatch, tmp_path):
+    pytest.importorskip('replicate')
+    from src import replay_utils
+    from src.replay_utils import RECORD, REPLAY, Cassette
+
+    prediction = _Prediction(['https://replicate.delivery/image.png'])
+    stable_utils = _stub_replicate(monkeypatch, prediction)
+    tracker = stable_utils.get_prediction_tracker()
+    for mode in (RECORD, REPLAY):
+        monkeypatch.setattr(replay_utils, '_cassette',
+                            Cassette(tmp_path / 'images.cassette'))
+        monkeypatch.setattr(replay_utils, 'REPLAY_MODE', mode)
+        prediction_id = stable_utils.get_stable_image_async('a red square')
+        assert tracker.future(prediction_id).result(timeout=5) == \
+            prediction.output
+        # Replicate is not reached when replaying
+        monkeypatch.setattr(stable_utils, 'replicate', None)
+
+
+def test_segmind_images(monkeypatch, within_deadline):
+    pytest.importorskip('segmind')
+    pytest.importorskip('streamlit')
+    from src import segmind_utils
+
+    response = SimpleNamespace(content=_png_bytes(),
+                               raise_for_status=lambda: None)
+    monkeypatch.setattr(segmind_utils.requests, 'post',
+                        lambda *args, **kwargs: response)
+
+    class FakeSDXL:
+        def __init__(self, api_key):
+            self.api_key = api_key
+
+        def generate(self, prompt):
+            return Image.new('RGB', (8, 8), 'blue')
+
+    monkeypatch.setattr(segmind_utils, 'SDXL', FakeSDXL)
+
+    preview = within_deadline(segmind_utils.get_segmind_preview_image,
+                              'a red square', api_key='key')
+    assert preview.size == (8, 8)
+    image = within_deadline(segmind_utils.get_segmind_image, 'a blue square',
+                            api_key='key')
+    assert image.getpixel((0, 0)) == (0, 0, 255)
+
+
+def _event(event_id, attendance, longitude=2.35, latitude=48.86):
+    return {'id': event_id, 'title': f'Event {event_id}',
+            'phq_attendance': attendance,
+            'location': [longitude, latitude],
+            'start': '2030-01-01T00:00:00Z', 'end': '2030-01-02T00:00:00Z'}
+
+
+def _stub_predicthq(monkeypatch, events):
+    from src import geo_utils, predict_utils
+
+    searches = []
+
+    class FakeClient:
+        def __init__(self, access_token):
+            self.events = SimpleNamespace(search=self.search)
+
+        def search(self, **params):
+            searches.append(params)
+            return [SimpleNamespace(to_dict=lambda e=e: dict(e))
+                    for e in events]
+
+    monkeypatch.setattr(predict_utils, 'Client', FakeClient)
+    monkeypatch.setattr(predict_utils, 'get_predict_creds',
+                        lambda: {'token': 'token'})
+    index = geo_utils.EventIndex()
+    monkeypatch.setattr(index, 'save', lambda *args, **kwargs: None)
+    monkeypatch.setattr(predict_utils, 'get_event_index', lambda: index)
+    return searches
+
+
+def test_predicthq_events(monkeypatch, within_deadline):
+    pytest.importorskip('predicthq')
+    pytest.importorskip('streamlit')
+    from src import predict_utils
+
+    searches = _stub_predicthq(monkeypatch, [_event('a', 10),
+                                             _event('b', 500)])
+    events_df = within_deadline(predict_utils.find_events_by_city, 'Paris',
+                                start_date='2030-01-01',
+                                end_date='2030-12-31')
+    assert list(events_df['id']) == ['b', 'a']
+    assert len(searches) == 1
+
+
+def test_predicthq_without_events(monkeypatch, within_deadline):
+    pytest.importorskip('predicthq')
+    pytest.importorskip('streamlit')
+    from src import predict_utils
+
+    searches = _stub_predicthq(monkeypatch, [])
+    # A fresh deploy with nothing cached, then a search finding nothing
+    for cached_only in (True, False, False):
+        events_df = within_deadline(predict_utils.find_events_by_city,
+                                    'Paris', cached_only=cached_only)
+        assert len(events_df) == 0
+        assert predict_utils.get_list_of_events_from_df(events_df) == []
+    # An empty result is not trusted as coverage
+    assert len(searches) == 2
+    # Unknown cities search by text
+    assert len(within_deadline(predict_utils.find_events_by_city,
+                               'Nowhere Springs')) == 0
+
+
+class _FakeCompletions:
+    def __init__(self, text):
+        self.text = text
+
+    def create(self, model, stream=False, **kwargs):
+        if not stream:
+            message = SimpleNamespace(content=self.text)
+            usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                                   usage=usage)
+        return iter([SimpleNamespace(choices=[SimpleNamespace(
+            delta=SimpleNamespace(content=line))])
+            for line in self.text.splitlines(keepends=True)])
+
+
+def _stub_openai(monkeypatch, text):
+    from src import endpoint_utils, openai_utils
+
+    endpoint = endpoint_utils.Endpoint('test', endpoint_utils.OPENAI,
+                                       api_key='key')
+    endpoint.client = SimpleNamespace(
+        chat=SimpleNamespace(completions=_FakeCompletions(text)))
+    pool = endpoint_utils.EndpointPool([endpoint])
+    monkeypatch.setattr(openai_utils, 'get_endpoint_pool',
+                        lambda creds=None: pool)
+    return endpoint
+
+
+def test_openai_calls(monkeypatch, within_deadline):
+    pytest.importorskip('openai')
+    pytest.importorskip('streamlit')
+    pytest.importorskip('tiktoken')
+    pytest.importorskip('langchain_openai')
+    from src import openai_utils
+
+    text = 'Campaign\nPrincipal image: a red square\n'
+    endpoint = _stub_openai(monkeypatch, text)
+    assert within_deadline(openai_utils.get_gpt4_campaign_response,
+                           'brand', gpt4_creds_dict='key',
+                           model='gpt-4') == text
+    seen = []
+    assert within_deadline(openai_utils.get_gpt4_campaign_response,
+                           'brand', gpt4_creds_dict='key', model='gpt-4',
+                           on_text=seen.append) == text
+    assert seen[-1] == text
+    run_metadata = {}
+    assert within_deadline(openai_utils.get_gpt4_insta_response,
+                           'brand', 'campaign', gpt4_creds_dict='key',
+                           model='gpt-4', run_metadata=run_metadata) == text
+    assert run_metadata['metrics']['insta_tokens'] == {'input': 10,
+                                                       'output': 5}
+    assert endpoint.in_flight == 0
+    assert endpoint.calls == 3
+
+
+class _FailingOnceCompletions(_FakeCompletions):
+    # gpt-4 breaks off after its first line, the fallback model answers
+    def create(self, model, stream=False, **kwargs):
+        chunks = super().create(model, stream=stream, **kwargs)
+        if model != 'gpt-4':
+            return chunks
+
+        def broken():
+            yield next(chunks)
+            raise ConnectionError('reset')
+        return broken()
+
+
+def test_streamed_campaign_restarts_on_fallback(monkeypatch,
+                                                within_deadline):
+    pytest.importorskip('openai')
+    pytest.importorskip('streamlit')
+    from src import openai_utils, routing_utils
+
+    monkeypatch.setattr(routing_utils, '_router', routing_utils.ModelRouter())
+    text = 'Campaign\nPrincipal image: a red square\n'
+    endpoint = _stub_openai(monkeypatch, text)
+    endpoint.client.chat.completions = _FailingOnceCompletions(text)
+    seen, run_metadata = [], {}
+    assert within_deadline(openai_utils.get_gpt4_campaign_response,
+                           'brand', gpt4_creds_dict='key',
+                           run_metadata=run_metadata,
+                           on_text=seen.append) == text
+    assert [d['ok'] for d in run_metadata['routing']] == [False, True]
+    # The failed model's line is cleared before the fallback streams
+    assert seen == ['Campaign\n', '', 'Campaign\n', text]
+
+
+def test_predicthq_capacity_from_secrets(monkeypatch, within_deadline):
+    pytest.importorskip('predicthq')
+    pytest.importorskip('streamlit')
+    from src import predict_utils, scheduler_utils
+
+    _stub_predicthq(monkeypatch, [])
+    monkeypatch.setattr(predict_utils, 'get_predict_creds',
+                        lambda: {'token': 'token', 'max_concurrency': 5})
+    scheduler = scheduler_utils.get_scheduler('predicthq')
+    # Both restored after the test
+    monkeypatch.setitem(scheduler_utils.PROVIDER_CAPACITY, 'predicthq', 8)
+    monkeypatch.setattr(scheduler, 'capacity', scheduler.capacity)
+    predict_utils._configure_search_capacity.cache_clear()
+    within_deadline(predict_utils.find_events_by_city, 'Paris')
+    predict_utils._configure_search_capacity.cache_clear()
+    assert scheduler.capacity == 5
@@ -0,0 +1,81 @@
+import datetime
+import inspect
+import pickle
+import zlib
+
+import pytest
+
+from src import replay_utils
+from src.replay_utils import RECORD, REPLAY, Cassette, call_key
+
+
+def _search(**params):
+    pass
+
+
+def test_dates_match_relative_to_today(monkeypatch):
+    signature = inspect.signature(_search)
+    keys = []
+    for today in (datetime.date(2030, 1, 1), datetime.date(2030, 1, 2)):
+        monkeypatch.setattr(replay_utils, '_today', lambda today=today: today)
+        keys.append(call_key(
+            'search', signature, (),
+            {'active__gte': today,
+             'active__lte': today + datetime.timedelta(days=365),
+             'q': 'Paris'}, relative_dates=True))
+    assert keys[0] == keys[1]
+    other_city = call_key('search', signature, (),
+                          {'active__gte': datetime.date(2030, 1, 2),
+                           'q': 'Lyon'}, relative_dates=True)
+    assert other_city != keys[1]
+
+
+def test_cassette_appends_records(tmp_path):
+    path = tmp_path / 'calls.cassette'
+    cassette = Cassette(path)
+    cassette.record('a', 0.1, 'first')
+    size = path.stat().st_size
+    cassette.record('a', 0.2, 'second')
+    cassette.record('b', 0.3, {'x': 1})
+    assert path.stat().st_size > size
+    replayed = Cassette(path)
+    assert len(replayed) == 3
+    assert replayed.play('a') == (0.1, 'first')
+    assert replayed.play('a') == (0.2, 'second')
+    assert replayed.play('b') == (0.3, {'x': 1})
+
+
+def test_cassette_reads_and_upgrades_the_old_format(tmp_path):
+    path = tmp_path / 'old.cassette'
+    path.write_bytes(zlib.compress(pickle.dumps(
+        {'a': [(0.1, ('pickle', 'old'))]})))
+    cassette = Cassette(path)
+    assert cassette.play('a') == (0.1, 'old')
+    cassette.record('b', 0.2, 'new')
+    upgraded = Cassette(path)
+    assert upgraded.play('a') == (0.1, 'old')
+    assert upgraded.play('b') == (0.2, 'new')
+
+
+def test_event_searches_replay_without_the_local_index(monkeypatch,
+                                                        tmp_path):
+    pytest.importorskip('predicthq')
+    pytest.importorskip('streamlit')
+    from src import predict_utils
+    from test_providers import _event, _stub_predicthq
+
+    searches = _stub_predicthq(monkeypatch, [_event('a', 10)])
+    monkeypatch.setattr(replay_utils, '_cassette',
+                        Cassette(tmp_path / 'events.cassette'))
+    monkeypatch.setattr(replay_utils, 'REPLAY_MODE', RECORD)
+    for _ in range(2):
+        assert list(predict_utils.find_events_by_city('Paris')['id']) == ['a']
+    # Both searches reach PredictHQ and the cassette
+    assert len(searches) == 2
+    assert len(predict_utils.get_event_index()) == 0
+
+    monkeypatch.setattr(replay_utils, '_cassette',
+                        Cassette(tmp_path / 'events.cassette'))
+    monkeypatch.setattr(replay_utils, 'REPLAY_MODE', REPLAY)
+    assert list(predict_utils.find_events_by_city('Paris')['id']) == ['a']
+    assert len(searches) == 2
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from src import routing_utils
+from src.routing_utils import ModelRouter, call_with_routing
+
+MODELS = {'fast': {'quality': 3}, 'slow': {'quality': 3},
+          'small': {'quality': 2}}
+TARGETS = {'campaign': {'min_quality': 3, 'max_p95_latency': None},
+           'insta': {'min_quality': 2, 'max_p95_latency': 5}}
+
+
+def _router():
+    return ModelRouter(models=MODELS, stage_targets=TARGETS)
+
+
+def _names(ranked):
+    return [name for name, _ in ranked]
+
+
+def test_unknown_models_keep_preference_order():
+    assert _names(_router().rank('campaign')) == ['fast', 'slow']
+
+
+def test_faster_p95_ranks_first_within_quality():
+    router = _router()
+    for _ in range(5):
+        router.record('fast', 3.0, ok=True)
+        router.record('slow', 1.0, ok=True)
+    assert _names(router.rank('campaign')) == ['slow', 'fast']
+
+
+def test_model_over_the_latency_target_drops_behind():
+    router = _router()
+    for _ in range(5):
+        router.record('fast', 9.0, ok=True)
+        router.record('slow', 8.0, ok=True)
+    assert router.rank('insta') == [('small', 'meets target'),
+                                    ('slow', 'fastest available'),
+                                    ('fast', 'fastest available')]
+
+
+def test_degraded_model_is_demoted_to_fallback():
+    router = _router()
+    for _ in range(routing_utils.MAX_CONSECUTIVE_FAILURES):
+        router.record('fast', 0.1, ok=False)
+    assert router.rank('campaign') == [('slow', 'meets target'),
+                                       ('fast', 'fallback (degraded)')]
+
+
+def test_call_falls_back_and_records_the_failure():
+    router = _router()
+    run_metadata = {}
+
+    def call(model):
+        if model == 'fast':
+            raise ConnectionError('reset')
+        return model
+
+    assert call_with_routing('campaign', call, run_metadata=run_metadata,
+                             router=router) == 'slow'
+    assert [(d['model'], d['ok']) for d in run_metadata['routing']] == [
+        ('fast', False), ('slow', True)]
+    assert router.stats('fast').consecutive_failures == 1
+
+
+def test_last_error_is_raised_when_every_model_fails():
+    def call(model):
+        raise ConnectionError(model)
+
+    with pytest.raises(ConnectionError, match='slow'):
+        call_with_routing('campaign', call, router=_router())
+
+
+def test_ranking_while_recording():
+    router = _router()
+    stop = threading.Event()
+
+    def record():
+        while not stop.is_set():
+            router.record('fast', 0.1, ok=True)
+
+    thread = threading.Thread(target=record)
+    thread.start()
+    try:
+        for _ in range(2000):
+            router.rank('campaign')
+    finally:
+        stop.set()
+        thread.join()
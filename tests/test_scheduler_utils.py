@@ -0,0 +1,97 @@
+import contextvars
+import threading
+import time
+
+import pytest
+
+from src.deadline_utils import DeadlineExceeded
+from src.scheduler_utils import (BATCH, INTERACTIVE, PRUNE_SESSIONS,
+                                 FairScheduler, set_request_context)
+
+
+def _wait_for(condition, seconds=5):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def _queued(scheduler):
+    return sum(scheduler.stats()['queue_depth'].values())
+
+
+def _queue_calls(scheduler, calls, granted):
+    # Each call takes its slot, notes who got it and hands it on
+    def take(session_id, priority):
+        scheduler.acquire(session_id, priority)
+        granted.append(session_id)
+        scheduler.release()
+
+    threads = []
+    for session_id, priority in calls:
+        thread = threading.Thread(target=take, args=(session_id, priority))
+        thread.start()
+        threads.append(thread)
+        _wait_for(lambda n=len(threads): _queued(scheduler) == n)
+    return threads
+
+
+def test_heavy_session_cannot_starve_a_light_one():
+    scheduler = FairScheduler('test', capacity=1)
+    scheduler.acquire('heavy', BATCH)
+    granted = []
+    threads = _queue_calls(scheduler, [('heavy', BATCH)] * 5
+                           + [('light', INTERACTIVE)], granted)
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+    # Queued last, served first: heavy's tags are already far ahead
+    assert granted == ['light'] + ['heavy'] * 5
+
+
+def test_equal_sessions_take_turns():
+    scheduler = FairScheduler('test', capacity=1)
+    scheduler.acquire('holder', INTERACTIVE)
+    granted = []
+    threads = _queue_calls(scheduler, [('a', BATCH)] * 3 + [('b', BATCH)] * 3,
+                           granted)
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+    assert granted == ['a', 'b', 'a', 'b', 'a', 'b']
+
+
+def test_slot_is_taken_for_the_context_session():
+    scheduler = FairScheduler('test', capacity=1)
+
+    def call():
+        set_request_context('session', BATCH)
+        with scheduler.slot():
+            assert scheduler.stats()['in_use'] == 1
+            assert scheduler._last_finish == {'session': 1.0}
+
+    contextvars.copy_context().run(call)
+    stats = scheduler.stats()
+    assert stats['in_use'] == 0
+    assert stats['p95_wait_seconds'][BATCH] is not None
+
+
+def test_idle_sessions_are_forgotten():
+    scheduler = FairScheduler('test', capacity=1)
+    for n in range(1000):
+        scheduler.acquire(f'session{n}', INTERACTIVE)
+        scheduler.release()
+    assert len(scheduler._last_finish) < PRUNE_SESSIONS
+    # A session coming back starts level with everyone else
+    scheduler.acquire('session0', INTERACTIVE)
+    assert scheduler._last_finish['session0'] == scheduler._virtual_time
+
+
+def test_acquire_times_out_without_a_slot():
+    scheduler = FairScheduler('test', capacity=1)
+    scheduler.acquire('holder', INTERACTIVE)
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire('late', INTERACTIVE, timeout=0.01)
+    # The abandoned waiter does not take the slot when it frees up
+    scheduler.release()
+    assert scheduler.stats()['in_use'] == 0
@@ -0,0 +1,74 @@
+import threading
+
+from src import semantic_cache_utils
+from src.semantic_cache_utils import (SemanticCache, get_semantic_cache,
+                                      measure_false_hit_rate)
+
+
+def test_different_intents_miss():
+    cache = SemanticCache()
+    cache.add('Nike', 'running for young women', 'women')
+    cache.add('Oatly', 'vegan breakfast', 'vegan')
+    cache.add('Nike', 'summer sale 2024', '2024')
+    assert cache.lookup('Nike', 'running for young men')[0] is None
+    assert cache.lookup('Oatly', 'not vegan breakfast')[0] is None
+    assert cache.lookup('Nike', 'summer sale 2025')[0] is None
+    assert cache.lookup('Nike', 'young women, running')[0] == 'women'
+
+
+def test_labelled_pairs():
+    assert measure_false_hit_rate(SemanticCache()) == {
+        'hits': 5, 'false_hits': 0, 'false_hit_rate': 0.0, 'recall': 1.0}
+
+
+def test_reworded_tags_hit():
+    cache = SemanticCache()
+    cache.add('Nike', 'Nike running, urban youth', 'campaign')
+    campaign, similarity = cache.lookup(
+        'nike', 'nike, running for urban young people')
+    assert campaign == 'campaign' and similarity > cache.threshold
+
+
+def test_brand_and_location_match_exactly():
+    cache = SemanticCache()
+    cache.add('Nike', 'urban youth running', 'paris', location='Paris')
+    assert cache.lookup('Nike', 'urban youth running',
+                        location=' paris ')[0] == 'paris'
+    assert cache.lookup('Nike', 'urban youth running',
+                        location='London')[0] is None
+    assert cache.lookup('Adidas', 'urban youth running',
+                        location='Paris')[0] is None
+
+
+def test_false_hit_withdraws_the_entry():
+    cache = SemanticCache()
+    cache.add('Nike', 'urban youth running', 'campaign')
+    assert cache.lookup('Nike', 'running, urban youth')[0] == 'campaign'
+    assert cache.report_false_hit('Nike', 'running, urban youth')
+    assert cache.lookup('Nike', 'running, urban youth')[0] is None
+    assert cache.stats['false_hits'] == 1
+    assert not cache.report_false_hit('Nike', 'running, urban youth')
+
+
+def test_concurrent_saves_round_trip(tmp_path):
+    cache = SemanticCache()
+    cache.add('Nike', 'urban youth running', 'nike', location='Paris')
+    cache.add('Oatly', 'vegan breakfast', 'oatly')
+    threads = [threading.Thread(target=cache.save, args=(tmp_path,))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [p.name for p in tmp_path.iterdir()] == ['cache.npz']
+    loaded = SemanticCache.load(tmp_path)
+    assert len(loaded) == 2
+    assert loaded.lookup('Nike', 'urban youth running', 'Paris')[0] == 'nike'
+    assert loaded.lookup('Oatly', 'vegan breakfast')[0] == 'oatly'
+
+
+def test_unreadable_cache_starts_empty(tmp_path, monkeypatch):
+    (tmp_path / 'cache.npz').write_bytes(b'not a cache')
+    monkeypatch.setattr(semantic_cache_utils, 'CACHE_DIR', tmp_path)
+    monkeypatch.setattr(semantic_cache_utils, '_semantic_cache', None)
+    assert len(get_semantic_cache()) == 0